@@ -1,20 +1,198 @@
+import datetime
+import hashlib
+import itertools
+import os
+import threading
+import time
+import zlib
+from collections import OrderedDict
+from contextlib import contextmanager
+from functools import wraps
+
+import click
 import psycopg2
+import psycopg2.extras
 
+from flask import Blueprint
 from flask import Flask
+from flask import Response
+from flask import current_app
+from flask import g
+from flask import has_app_context
+from flask import has_request_context
+from flask import json
 from flask import jsonify
+from flask import request
+from flask import stream_with_context
 from flask_cors import CORS
 from flask_sqlalchemy import SQLAlchemy
+from flask_sqlalchemy.session import Session as FlaskSession
+from sqlalchemy import Column
+from sqlalchemy import DateTime
 from sqlalchemy import ForeignKey
-from sqlalchemy.orm import relationship
-
-app = Flask(__name__)
-app.debug = True
-app.config["SQLALCHEMY_DATABASE_URI"] = ''
-db = SQLAlchemy(app)
-CORS(app)
-
-
-class Cases(db.Model):
+from sqlalchemy import MetaData
+from sqlalchemy import Table
+from sqlalchemy import Text
+from sqlalchemy import cast
+from sqlalchemy import create_engine
+from sqlalchemy import event
+from sqlalchemy import func
+from sqlalchemy import inspect
+from sqlalchemy import literal
+from sqlalchemy import select
+from sqlalchemy import text
+from sqlalchemy import tuple_
+from sqlalchemy import union_all
+from sqlalchemy.dialects.postgresql import JSONB
+from sqlalchemy.dialects.postgresql import insert as postgresql_insert
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+from sqlalchemy.engine import Engine
+from sqlalchemy.engine import make_url
+from sqlalchemy.exc import DataError
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.exc import OperationalError
+from sqlalchemy.exc import ProgrammingError
+from sqlalchemy.orm import Session, attributes, configure_mappers, relationship, selectinload, with_loader_criteria
+from sqlalchemy.pool import QueuePool
+from sqlalchemy.pool import SingletonThreadPool
+
+# In requirements.txt; without it the encoder falls back to the standard library
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+# In requirements.txt; without it ?compression=zstd answers 400
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+# Engine options read from the environment, only set when the variable is, so the
+# SQLAlchemy defaults stand otherwise
+ENGINE_ENVIRONMENT = (
+    ('DB_POOL_SIZE', 'pool_size', int),
+    ('DB_MAX_OVERFLOW', 'max_overflow', int),
+    ('DB_POOL_TIMEOUT', 'pool_timeout', float),
+    ('DB_POOL_RECYCLE', 'pool_recycle', int),
+    ('DB_POOL_PRE_PING', 'pool_pre_ping', lambda value: value.lower() in ('1', 'true', 'yes')),
+    ('DB_STATEMENT_CACHE_SIZE', 'query_cache_size', int),
+)
+
+
+def engine_options(url):
+    options = {option: convert(os.environ[name]) for name, option, convert in ENGINE_ENVIRONMENT
+               if os.environ.get(name)}
+    if os.environ.get('DB_CONNECT_TIMEOUT') and url and make_url(url).get_backend_name() == 'postgresql':
+        options['connect_args'] = {'connect_timeout': int(os.environ['DB_CONNECT_TIMEOUT'])}
+    return options
+
+
+def replica_binds():
+    urls = [url.strip() for url in os.environ.get('DATABASE_REPLICA_URLS', '').split(',') if url.strip()]
+    return {f'replica_{i}': dict(engine_options(url), url=url) for i, url in enumerate(urls)}
+
+
+class RoutingSession(FlaskSession):
+    # Reads made while serving a GET go to a healthy replica, round-robin between sessions;
+    # flushes, other methods and everything outside a request stay on the primary
+
+    def get_bind(self, mapper=None, clause=None, bind=None, **kwargs):
+        if bind is None and not self._flushing and replica_router.serves_request():
+            replica = self.replica()
+            if replica is not None:
+                return replica
+        return super().get_bind(mapper, clause=clause, bind=bind, **kwargs)
+
+    def replica(self):
+        # One replica for the life of the session, so a request does not assemble a response from
+        # replicas at different lag points. Picked again only once it is marked down
+        key = self.info.get('replica')
+        if key is None or not replica_router.is_up(key):
+            key = replica_router.choose()
+            if key is None:
+                self.info.pop('replica', None)
+                return None
+            self.info['replica'] = key
+        return db.engines[key]
+
+    def close(self):
+        # Called by remove() at the end of every request
+        self.info.pop('replica', None)
+        super().close()
+
+
+db = SQLAlchemy(session_options={'class_': RoutingSession})
+api = Blueprint('api', __name__, cli_group=None)
+
+# Settings per configuration name, applied over the ones read from the environment
+CONFIGS = {
+    'development': {
+        'DEBUG': True,
+    },
+    'production': {
+        'DEBUG': False,
+        'JSON_SORT_KEYS': True,
+        'JSONIFY_PRETTYPRINT_REGULAR': False,
+        'WARM_UP': True,
+    },
+    # Serves a file written by flask build-snapshot, named by SNAPSHOT_PATH
+    'snapshot': {
+        'DEBUG': False,
+        'JSON_SORT_KEYS': True,
+        'JSONIFY_PRETTYPRINT_REGULAR': False,
+        'READ_ONLY': True,
+    },
+}
+
+PAGE_LIMIT_MAX = 1000
+STREAM_CHUNK_SIZE = 500
+MULTI_GET_MAX = 200
+WRITE_BATCH_MAX = 1000
+FACET_INDEX_MAX_AGE = 300
+DOCUMENT_BATCH_SIZE = 100
+LATENCY_BUCKETS_MS = (5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000)
+RESPONSE_CACHE_SIZE = 256
+RESPONSE_CACHE_TTL = 300
+EXPORT_CHUNK_SIZE = 1000
+EXPORT_DOCUMENT_CHUNK_SIZE = 20
+CHANGES_LIMIT_DEFAULT = 500
+SIMILAR_INDEX_MAX_AGE = 300
+SIMILAR_K_MAX = 50
+
+
+def serialize_fields(obj, data, fields=None, expand=None):
+    # fields limits the top-level keys, expand is a tree of the relationships to follow.
+    # A relationship that is not asked for is never touched, so it is never loaded either
+    if fields is not None:
+        data = {key: value for key, value in data.items() if key in fields}
+    for name in getattr(obj, 'serialize_relationships', ()):
+        if (fields is not None and name not in fields) or (expand is not None and name not in expand):
+            continue
+        nested = None if expand is None else expand[name]
+        data[name] = [item.serialize(expand=nested) for item in getattr(obj, name)]
+    return data
+
+
+class ChangeTracking:
+    # Timestamps for the core models. A row with deleted_at set is soft-deleted: the list routes
+    # and case reads skip it and /api/changes reports it as deleted
+    created_at = db.Column(db.DateTime, default=db.func.now(), server_default=db.func.now())
+    updated_at = db.Column(db.DateTime, default=db.func.now(), onupdate=db.func.now(), server_default=db.func.now())
+    deleted_at = db.Column(db.DateTime)
+
+
+def live(model):
+    # WHERE criteria leaving out soft-deleted rows, none for models without deleted_at
+    return [model.deleted_at.is_(None)] if hasattr(model, 'deleted_at') else []
+
+
+# The same for every soft-deletable row an ORM statement loads, relationship loads included:
+# a soft-deleted patient drops out of the collections that link to it
+LIVE_ROWS = with_loader_criteria(ChangeTracking, lambda cls: cls.deleted_at.is_(None), include_aliases=True)
+
+
+class Cases(ChangeTracking, db.Model):
     __tablename__ = 'cases'
     id = db.Column(db.Integer, primary_key=True, autoincrement=True)
     patient_summary = db.Column(db.Text)
@@ -25,21 +203,19 @@ class Cases(db.Model):
     question_objects = db.relationship('QuestionType', secondary='cq_objects', backref='case')
     treatment_objects = db.relationship('Treatment', secondary='ct_objects', backref='case')
 
-    def serialize(self):
-        return {
+    serialize_relationships = ('patient_objects', 'disease_objects', 'question_objects', 'treatment_objects')
+
+    def serialize(self, fields=None, expand=None):
+        return serialize_fields(self, {
             'id': self.id,
-            'patient_summary': self.patient_summary,
-            'patient_objects': [obj.serialize() for obj in self.patient_objects],
-            'disease_objects': [obj.serialize() for obj in self.disease_objects],
-            'question_objects': [obj.serialize() for obj in self.question_objects],
-            'treatment_objects': [obj.serialize() for obj in self.treatment_objects]
-        }
+            'patient_summary': self.patient_summary
+        }, fields, expand)
 
 
-class PatientQuestion(db.Model):
+class PatientQuestion(ChangeTracking, db.Model):
     __tablename__ = 'patient_question'
     id = db.Column(db.Integer, primary_key=True)
-    case_id = db.Column(db.Integer, db.ForeignKey('cases.id'))
+    case_id = db.Column(db.Integer, db.ForeignKey('cases.id'), index=True)
     question = db.Column(db.Text)
 
     #Realtionships
@@ -48,23 +224,21 @@ class PatientQuestion(db.Model):
     question_objects = db.relationship('QuestionType', secondary='cpq_question_objects', backref='question')
     treatment_objects = db.relationship('Treatment', secondary='cpq_treatment_objects', backref='question')
 
-    def serialize(self):
-        return {
+    serialize_relationships = ('patient_objects', 'disease_objects', 'question_objects', 'treatment_objects')
+
+    def serialize(self, fields=None, expand=None):
+        return serialize_fields(self, {
             'id': self.id,
             'case_id': self.case_id,
-            'question': self.question,
-            'patient_objects': [obj.serialize() for obj in self.patient_objects],
-            'disease_objects': [obj.serialize() for obj in self.disease_objects],
-            'question_objects': [obj.serialize() for obj in self.question_objects],
-            'treatment_objects': [obj.serialize() for obj in self.treatment_objects]
-        }
+            'question': self.question
+        }, fields, expand)
 
 
-class ProcessedQuestion(db.Model):
+class ProcessedQuestion(ChangeTracking, db.Model):
     __tablename__ = 'processed_question'
     id = db.Column(db.Integer, primary_key=True)
-    case_id = db.Column(db.Integer, db.ForeignKey('cases.id'))
-    question_id = db.Column(db.Integer, db.ForeignKey('patient_question.id'))
+    case_id = db.Column(db.Integer, db.ForeignKey('cases.id'), index=True)
+    question_id = db.Column(db.Integer, db.ForeignKey('patient_question.id'), index=True)
     question = db.Column(db.Text)
     question_note = db.Column(db.Text)
 
@@ -75,25 +249,23 @@ class ProcessedQuestion(db.Model):
     treatment_objects = db.relationship('Treatment', secondary='rq_treatment_objects', backref='processed_question')
 
 
-    def serialize(self):
-        return {
+    serialize_relationships = ('patient_objects', 'disease_objects', 'question_objects', 'treatment_objects')
+
+    def serialize(self, fields=None, expand=None):
+        return serialize_fields(self, {
             'id': self.id,
             'case_id': self.case_id,
             'question_id': self.question_id,
             'question': self.question,
-            'question_note': self.question_note,
-            'patient_objects': [obj.serialize() for obj in self.patient_objects],
-            'disease_objects': [obj.serialize() for obj in self.disease_objects],
-            'question_objects': [obj.serialize() for obj in self.question_objects],
-            'treatment_objects': [obj.serialize() for obj in self.treatment_objects],
-        }
+            'question_note': self.question_note
+        }, fields, expand)
 
 
-class Enhanced(db.Model):
+class Enhanced(ChangeTracking, db.Model):
     __tablename__ = 'enhanced'
     id = db.Column(db.Integer, primary_key=True, autoincrement=True)
-    case_id = db.Column(db.Integer, db.ForeignKey('cases.id'))
-    processed_question_id = db.Column(db.Integer, db.ForeignKey('processed_question.id'))
+    case_id = db.Column(db.Integer, db.ForeignKey('cases.id'), index=True)
+    processed_question_id = db.Column(db.Integer, db.ForeignKey('processed_question.id'), index=True)
 
 
     #Relationships
@@ -102,23 +274,21 @@ class Enhanced(db.Model):
     diseases = db.relationship('Disease', secondary='enhanced_diseases', backref='enhanced')
     question_types = db.relationship('QuestionType', secondary='enhanced_question_types', backref='enhanced')
 
-    def serialize(self):
-        return {
+    serialize_relationships = ('treatments', 'patients', 'diseases', 'question_types')
+
+    def serialize(self, fields=None, expand=None):
+        return serialize_fields(self, {
             'id': self.id,
             'case_id': self.case_id,
-            'processed_question_id': self.processed_question_id,
-            'treatments': [obj.serialize() for obj in self.treatments],
-            'patients': [obj.serialize() for obj in self.patients],
-            'diseases': [obj.serialize() for obj in self.diseases],
-            'question_types': [obj.serialize() for obj in self.question_types],
-        }
+            'processed_question_id': self.processed_question_id
+        }, fields, expand)
 
 
-class Articles(db.Model):
+class Articles(ChangeTracking, db.Model):
     __tablename__ = 'articles'
     id = db.Column(db.Integer, primary_key=True)
-    case_id = db.Column(db.Integer, db.ForeignKey('cases.id'))
-    processed_question_id = db.Column(db.Integer, db.ForeignKey('processed_question.id'))
+    case_id = db.Column(db.Integer, db.ForeignKey('cases.id'), index=True)
+    processed_question_id = db.Column(db.Integer, db.ForeignKey('processed_question.id'), index=True)
     reference = db.Column(db.Text)
     highlighted_text = db.Column(db.Text)
     alternative_pubmed_link = db.Column(db.Text)
@@ -129,21 +299,19 @@ class Articles(db.Model):
     question_objects = db.relationship('QuestionType', secondary='articles_question_objects', backref='article')
     treatment_objects = db.relationship('Treatment', secondary='articles_treatment_objects', backref='article')
 
-    def serialize(self):
-        return {
+    serialize_relationships = ('patients_objects', 'diseases_objects', 'question_objects', 'treatment_objects')
+
+    def serialize(self, fields=None, expand=None):
+        return serialize_fields(self, {
             'id': self.id,
             'case_id': self.case_id,
             'processed_question_id': self.processed_question_id,
             'reference': self.reference,
             'highlighted_text': self.highlighted_text,
-            'alternative_pubmed_link': self.alternative_pubmed_link,
-            'patients_objects': [obj.serialize() for obj in self.patients_objects],
-            'diseases_objects': [obj.serialize() for obj in self.diseases_objects],
-            'question_objects': [obj.serialize() for obj in self.question_objects],
-            'treatment_objects': [obj.serialize() for obj in self.treatment_objects],
-        }
+            'alternative_pubmed_link': self.alternative_pubmed_link
+        }, fields, expand)
 
-class Patient(db.Model):
+class Patient(ChangeTracking, db.Model):
     __tablename__ = 'patient'
     id = db.Column(db.Integer, primary_key=True, autoincrement=True)
     age = db.Column(db.Integer)
@@ -161,21 +329,17 @@ class Patient(db.Model):
     patient_background_diseases = db.relationship('PatientBackgroundDiseases', backref='patient')
     patient_side_effects = db.relationship('PatientSideEffects', backref='patient')
 
-    def serialize(self):
-        return {
+    serialize_relationships = ('rq_patient_objects', 'cp_objects', 'article_patient_objects', 'cpq_patient_objects',
+                               'enhanced_patients', 'patient_symptoms', 'patient_background_diseases',
+                               'patient_side_effects')
+
+    def serialize(self, fields=None, expand=None):
+        return serialize_fields(self, {
             'id': self.id,
             'age': self.age,
             'age_range': self.age_range,
-            'gender': self.gender,
-            'rq_patient_objects': [obj.serialize() for obj in self.rq_patient_objects],
-            'cp_objects': [obj.serialize() for obj in self.cp_objects],
-            'article_patient_objects': [obj.serialize() for obj in self.article_patient_objects],
-            'cpq_patient_objects': [obj.serialize() for obj in self.cpq_patient_objects],
-            'enhanced_patients': [obj.serialize() for obj in self.enhanced_patients],
-            'patient_symptoms': [obj.serialize() for obj in self.patient_symptoms],
-            'patient_background_diseases': [obj.serialize() for obj in self.patient_background_diseases],
-            'patient_side_effects': [obj.serialize() for obj in self.patient_side_effects],
-        }
+            'gender': self.gender
+        }, fields, expand)
 
 
 class Symptom(db.Model):
@@ -185,25 +349,25 @@ class Symptom(db.Model):
     location = db.Column(db.Text)
     severity = db.Column(db.Text)
 
-    def serialize(self):
-        return {
+    def serialize(self, fields=None, expand=None):
+        return serialize_fields(self, {
             'id': self.id,
             'name': self.name,
             'location': self.location,
             'severity': self.severity
-        }
+        }, fields, expand)
 
 
 class PatientSymptoms(db.Model):
     __tablename__ = 'patient_symptoms'
     symptom_id = db.Column(db.Integer, db.ForeignKey('symptom.id'), primary_key=True)
-    patient_id = db.Column(db.Integer, db.ForeignKey('patient.id'), primary_key=True)
+    patient_id = db.Column(db.Integer, db.ForeignKey('patient.id'), primary_key=True, index=True)
 
-    def serialize(self):
-        return {
+    def serialize(self, fields=None, expand=None):
+        return serialize_fields(self, {
             'symptom_id': self.symptom_id,
             'patient_id': self.patient_id
-        }
+        }, fields, expand)
 
 
 class BackgroundDisease(db.Model):
@@ -211,23 +375,23 @@ class BackgroundDisease(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     name = db.Column(db.Text)
 
-    def serialize(self):
-        return {
+    def serialize(self, fields=None, expand=None):
+        return serialize_fields(self, {
             'id': self.id,
             'name': self.name
-        }
+        }, fields, expand)
 
 
 class PatientBackgroundDiseases(db.Model):
     __tablename__ = 'patient_background_diseases'
     back_g_disease_id = db.Column(db.Integer, db.ForeignKey('background_disease.id'), primary_key=True)
-    patient_id = db.Column(db.Integer, db.ForeignKey('patient.id'), primary_key=True)
+    patient_id = db.Column(db.Integer, db.ForeignKey('patient.id'), primary_key=True, index=True)
 
-    def serialize(self):
-        return {
+    def serialize(self, fields=None, expand=None):
+        return serialize_fields(self, {
             'back_g_disease_id': self.back_g_disease_id,
             'patient_id': self.patient_id
-        }
+        }, fields, expand)
 
 
 class SideEffect(db.Model):
@@ -235,23 +399,23 @@ class SideEffect(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     name = db.Column(db.Text)
 
-    def serialize(self):
-        return {
+    def serialize(self, fields=None, expand=None):
+        return serialize_fields(self, {
             'id': self.id,
             'name': self.name
-        }
+        }, fields, expand)
 
 
 class PatientSideEffects(db.Model):
     __tablename__ = 'patient_side_effects'
     side_effect_id = db.Column(db.Integer, db.ForeignKey('side_effect.id'), primary_key=True)
-    patient_id = db.Column(db.Integer, db.ForeignKey('patient.id'), primary_key=True)
+    patient_id = db.Column(db.Integer, db.ForeignKey('patient.id'), primary_key=True, index=True)
 
-    def serialize(self):
-        return {
+    def serialize(self, fields=None, expand=None):
+        return serialize_fields(self, {
             'side_effect_id': self.side_effect_id,
             'patient_id': self.patient_id
-        }
+        }, fields, expand)
 
 class Disease(db.Model):
     __tablename__ = 'disease'
@@ -269,12 +433,12 @@ class Disease(db.Model):
     disease_l = db.relationship('DiseaseL', backref='disease')
     disease_p = db.relationship('DiseaseP', backref='disease')
 
-    def serialize(self):
-        return {
+    def serialize(self, fields=None, expand=None):
+        return serialize_fields(self, {
             'id': self.id,
             'full_name': self.full_name,
             'shortcut': self.shortcut
-        }
+        }, fields, expand)
 
 
 class DiseaseProtein(db.Model):
@@ -282,23 +446,23 @@ class DiseaseProtein(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     name = db.Column(db.Text)
 
-    def serialize(self):
-        return {
+    def serialize(self, fields=None, expand=None):
+        return serialize_fields(self, {
             'id': self.id,
             'name': self.name
-        }
+        }, fields, expand)
 
 
 class DiseaseP(db.Model):
     __tablename__ = 'disease_p'
     disease_id = db.Column(db.Text, db.ForeignKey('disease.id'), primary_key=True)
-    protein_id = db.Column(db.Integer, db.ForeignKey('disease_protein.id'), primary_key=True)
+    protein_id = db.Column(db.Integer, db.ForeignKey('disease_protein.id'), primary_key=True, index=True)
 
-    def serialize(self):
-        return {
+    def serialize(self, fields=None, expand=None):
+        return serialize_fields(self, {
             'disease_id': self.disease_id,
             'protein_id': self.protein_id
-        }
+        }, fields, expand)
 
 
 class DiseaseLocation(db.Model):
@@ -306,23 +470,23 @@ class DiseaseLocation(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     location = db.Column(db.Text)
 
-    def serialize(self):
-        return {
+    def serialize(self, fields=None, expand=None):
+        return serialize_fields(self, {
             'id': self.id,
             'location': self.location
-        }
+        }, fields, expand)
 
 
 class DiseaseL(db.Model):
     __tablename__ = 'disease_l'
     location_id = db.Column(db.Integer, db.ForeignKey('disease_location.id'), primary_key=True)
-    disease_id = db.Column(db.Text, db.ForeignKey('disease.id'), primary_key=True)
+    disease_id = db.Column(db.Text, db.ForeignKey('disease.id'), primary_key=True, index=True)
 
-    def serialize(self):
-        return {
+    def serialize(self, fields=None, expand=None):
+        return serialize_fields(self, {
             'location_id': self.location_id,
             'disease_id': self.disease_id
-        }
+        }, fields, expand)
 
 
 class DiseaseMutation(db.Model):
@@ -331,25 +495,24 @@ class DiseaseMutation(db.Model):
     mutation = db.Column(db.Text)
     mutation_status = db.Column(db.Text)
 
-    def serialize(self):
-        return {
+    def serialize(self, fields=None, expand=None):
+        return serialize_fields(self, {
             'id': self.id,
             'mutation': self.mutation,
             'mutation_status': self.mutation_status
-        }
+        }, fields, expand)
 
 
 class DiseaseM(db.Model):
     __tablename__ = 'disease_m'
     mutation_id = db.Column(db.Integer, db.ForeignKey('disease_mutation.id'), primary_key=True)
-    disease_id = db.Column(db.Text, db.ForeignKey('disease.id'), primary_key=True)
-
+    disease_id = db.Column(db.Text, db.ForeignKey('disease.id'), primary_key=True, index=True)
 
-    def serialize(self):
-        return {
+    def serialize(self, fields=None, expand=None):
+        return serialize_fields(self, {
             'mutation_id': self.mutation_id,
             'disease_id': self.disease_id
-        }
+        }, fields, expand)
 
 
 class QuestionType(db.Model):
@@ -366,12 +529,12 @@ class QuestionType(db.Model):
     enhanced_question_types = db.relationship('EnhancedQuestionTypes', backref='question_type')
 
 
-    def serialize(self):
-        return {
+    def serialize(self, fields=None, expand=None):
+        return serialize_fields(self, {
             'id': self.id,
             'type': self.type,
             'classification': self.classification
-        }
+        }, fields, expand)
 
 
 class Treatment(db.Model):
@@ -388,13 +551,13 @@ class Treatment(db.Model):
     rq_treatment_objects = db.relationship('RQTreatmentObj', backref='treatment')
     ct_objects = db.relationship('CTObj', backref='treatment')
 
-    def serialize(self):
-        return {
+    def serialize(self, fields=None, expand=None):
+        return serialize_fields(self, {
             'id': self.id,
             'name': self.name,
             'treatment_type': self.treatment_type,
             'sub_classification': self.sub_classification
-        }
+        }, fields, expand)
 
 
 # Associated Tables for Cases
@@ -402,25 +565,31 @@ class Treatment(db.Model):
 class CPObj(db.Model):
     __tablename__ = 'cp_objects'
     case_id = db.Column(db.Integer, db.ForeignKey('cases.id'), primary_key=True)
-    p_object_id = db.Column(db.Integer, db.ForeignKey('patient.id'), primary_key=True)
+    p_object_id = db.Column(db.Integer, db.ForeignKey('patient.id'), primary_key=True, index=True)
+
+    def serialize(self, fields=None, expand=None):
+        return serialize_fields(self, {
+            'case_id': self.case_id,
+            'p_object_id': self.p_object_id
+        }, fields, expand)
 
 
 class CDObj(db.Model):
     __tablename__ = 'cd_objects'
     case_id = db.Column(db.Integer, db.ForeignKey('cases.id'), primary_key=True)
-    disease_object_id = db.Column(db.Text, db.ForeignKey('disease.id'), primary_key=True)
+    disease_object_id = db.Column(db.Text, db.ForeignKey('disease.id'), primary_key=True, index=True)
 
 
 class CQObj(db.Model):
     __tablename__ = 'cq_objects'
     case_id = db.Column(db.Integer, db.ForeignKey('cases.id'), primary_key=True)
-    question_object_id = db.Column(db.Text, db.ForeignKey('question_type.id'), primary_key=True)
+    question_object_id = db.Column(db.Text, db.ForeignKey('question_type.id'), primary_key=True, index=True)
 
 
 class CTObj(db.Model):
     __tablename__ = 'ct_objects'
     case_id = db.Column(db.Integer, db.ForeignKey('cases.id'), primary_key=True)
-    treatment_object_id = db.Column(db.Text, db.ForeignKey('treatment.id'), primary_key=True)
+    treatment_object_id = db.Column(db.Text, db.ForeignKey('treatment.id'), primary_key=True, index=True)
 
 
 # Associated Tables for Processed Question
@@ -428,24 +597,30 @@ class CTObj(db.Model):
 class RQPatientObj(db.Model):
     __tablename__ = 'rq_patient_objects'
     research_question_id = db.Column(db.Integer, db.ForeignKey('processed_question.id'), primary_key=True)
-    patient_object_id = db.Column(db.Integer, db.ForeignKey('patient.id'), primary_key=True)
+    patient_object_id = db.Column(db.Integer, db.ForeignKey('patient.id'), primary_key=True, index=True)
+
+    def serialize(self, fields=None, expand=None):
+        return serialize_fields(self, {
+            'research_question_id': self.research_question_id,
+            'patient_object_id': self.patient_object_id
+        }, fields, expand)
 
 class RQDiseaseObj(db.Model):
     __tablename__ = 'rq_disease_objects'
     research_question_id = db.Column(db.Integer, db.ForeignKey('processed_question.id'), primary_key=True)
-    disease_object_id = db.Column(db.Text, db.ForeignKey('disease.id'), primary_key=True)
+    disease_object_id = db.Column(db.Text, db.ForeignKey('disease.id'), primary_key=True, index=True)
 
 
 class RQQuestionObj(db.Model):
     __tablename__ = 'rq_question_objects'
     research_question_id = db.Column(db.Integer, db.ForeignKey('processed_question.id'), primary_key=True)
-    question_object_id = db.Column(db.Text, db.ForeignKey('question_type.id'), primary_key=True)
+    question_object_id = db.Column(db.Text, db.ForeignKey('question_type.id'), primary_key=True, index=True)
 
 
 class RQTreatmentObj(db.Model):
     __tablename__ = 'rq_treatment_objects'
     research_question_id = db.Column(db.Integer, db.ForeignKey('processed_question.id'), primary_key=True)
-    treatment_object_id = db.Column(db.Text, db.ForeignKey('treatment.id'), primary_key=True)
+    treatment_object_id = db.Column(db.Text, db.ForeignKey('treatment.id'), primary_key=True, index=True)
 
 
 # Associated Tables for Articles
@@ -453,25 +628,31 @@ class RQTreatmentObj(db.Model):
 class ArticlePatientObj(db.Model):
     __tablename__ = 'articles_patient_objects'
     article_id = db.Column(db.Integer, db.ForeignKey('articles.id'), primary_key=True)
-    patient_object_id = db.Column(db.Integer, db.ForeignKey('patient.id'), primary_key=True)
+    patient_object_id = db.Column(db.Integer, db.ForeignKey('patient.id'), primary_key=True, index=True)
+
+    def serialize(self, fields=None, expand=None):
+        return serialize_fields(self, {
+            'article_id': self.article_id,
+            'patient_object_id': self.patient_object_id
+        }, fields, expand)
 
 
 class ArticleDiseaseObj(db.Model):
     __tablename__ = 'articles_disease_objects'
     article_id = db.Column(db.Integer, db.ForeignKey('articles.id'), primary_key=True)
-    disease_object_id = db.Column(db.Text, db.ForeignKey('disease.id'), primary_key=True)
+    disease_object_id = db.Column(db.Text, db.ForeignKey('disease.id'), primary_key=True, index=True)
 
 
 class ArticleQuestionObj(db.Model):
     __tablename__ = 'articles_question_objects'
     article_id = db.Column(db.Integer, db.ForeignKey('articles.id'), primary_key=True)
-    question_object_id = db.Column(db.Text, db.ForeignKey('question_type.id'), primary_key=True)
+    question_object_id = db.Column(db.Text, db.ForeignKey('question_type.id'), primary_key=True, index=True)
 
 
 class ArticleTreatmentObj(db.Model):
     __tablename__ = 'articles_treatment_objects'
     article_id = db.Column(db.Integer, db.ForeignKey('articles.id'), primary_key=True)
-    treatment_object_id = db.Column(db.Text, db.ForeignKey('treatment.id'), primary_key=True)
+    treatment_object_id = db.Column(db.Text, db.ForeignKey('treatment.id'), primary_key=True, index=True)
 
 
 # Associated Tables for Patient Question
@@ -479,25 +660,31 @@ class ArticleTreatmentObj(db.Model):
 class CPQPatientObj(db.Model):
     __tablename__ = 'cpq_patient_objects'
     question_id = db.Column(db.Integer, db.ForeignKey('patient_question.id'), primary_key=True)
-    patient_object_id = db.Column(db.Integer, db.ForeignKey('patient.id'), primary_key=True)
+    patient_object_id = db.Column(db.Integer, db.ForeignKey('patient.id'), primary_key=True, index=True)
+
+    def serialize(self, fields=None, expand=None):
+        return serialize_fields(self, {
+            'question_id': self.question_id,
+            'patient_object_id': self.patient_object_id
+        }, fields, expand)
 
 
 class CPQDiseaseObj(db.Model):
     __tablename__ = 'cpq_disease_objects'
     question_id = db.Column(db.Integer, db.ForeignKey('patient_question.id'), primary_key=True)
-    disease_object_id = db.Column(db.Text, db.ForeignKey('disease.id'), primary_key=True)
+    disease_object_id = db.Column(db.Text, db.ForeignKey('disease.id'), primary_key=True, index=True)
 
 
 class CPQQuestionObj(db.Model):
     __tablename__ = 'cpq_question_objects'
     question_id = db.Column(db.Integer, db.ForeignKey('patient_question.id'), primary_key=True)
-    question_object_id = db.Column(db.Text, db.ForeignKey('question_type.id'), primary_key=True)
+    question_object_id = db.Column(db.Text, db.ForeignKey('question_type.id'), primary_key=True, index=True)
 
 
 class CPQTreatmentObj(db.Model):
     __tablename__ = 'cpq_treatment_objects'
     question_id = db.Column(db.Integer, db.ForeignKey('patient_question.id'), primary_key=True)
-    treatment_object_id = db.Column(db.Text, db.ForeignKey('treatment.id'), primary_key=True)
+    treatment_object_id = db.Column(db.Text, db.ForeignKey('treatment.id'), primary_key=True, index=True)
 
 
 # Associated Tables for Enhanced
@@ -505,142 +692,2700 @@ class CPQTreatmentObj(db.Model):
 class EnhancedTreatments(db.Model):
     __tablename__ = 'enhanced_treatments'
     enhanced_id = db.Column(db.Integer, db.ForeignKey('enhanced.id'), primary_key=True)
-    treatment_id = db.Column(db.Text, db.ForeignKey('treatment.id'), primary_key=True)
+    treatment_id = db.Column(db.Text, db.ForeignKey('treatment.id'), primary_key=True, index=True)
 
 
 class EnhancedPatients(db.Model):
     __tablename__ = 'enhanced_patients'
     enhanced_id = db.Column(db.Integer, db.ForeignKey('enhanced.id'), primary_key=True)
-    patient_id = db.Column(db.Integer, db.ForeignKey('patient.id'), primary_key=True)
+    patient_id = db.Column(db.Integer, db.ForeignKey('patient.id'), primary_key=True, index=True)
+
+    def serialize(self, fields=None, expand=None):
+        return serialize_fields(self, {
+            'enhanced_id': self.enhanced_id,
+            'patient_id': self.patient_id
+        }, fields, expand)
 
 
 class EnhancedDiseases(db.Model):
     __tablename__ = 'enhanced_diseases'
     enhanced_id = db.Column(db.Integer, db.ForeignKey('enhanced.id'), primary_key=True)
-    disease_id = db.Column(db.Text, db.ForeignKey('disease.id'), primary_key=True)
+    disease_id = db.Column(db.Text, db.ForeignKey('disease.id'), primary_key=True, index=True)
 
 
 class EnhancedQuestionTypes(db.Model):
     __tablename__ = 'enhanced_question_types'
     enhanced_id = db.Column(db.Integer, db.ForeignKey('enhanced.id'), primary_key=True)
-    question_type_id = db.Column(db.Text, db.ForeignKey('question_type.id'), primary_key=True)
+    question_type_id = db.Column(db.Text, db.ForeignKey('question_type.id'), primary_key=True, index=True)
+
+
+# Materialized case documents
+
+class CaseDocument(db.Model):
+    __tablename__ = 'case_document'
+    # No foreign key on purpose: rows are derived data, rebuilt or dropped after the case itself changes
+    case_id = db.Column(db.Integer, primary_key=True)
+    document = db.Column(db.JSON().with_variant(JSONB, 'postgresql'))
+    refreshed_at = db.Column(db.DateTime, default=db.func.now(), onupdate=db.func.now())
+
+
+# Change feed
+
+class ChangeLog(db.Model):
+    __tablename__ = 'change_log'
+    # The id is the /api/changes cursor
+    id = db.Column(db.Integer, primary_key=True, autoincrement=True)
+    table_name = db.Column(db.Text, nullable=False)
+    row_key = db.Column(db.JSON, nullable=False)
+    operation = db.Column(db.Enum('insert', 'update', 'delete', name='change_operation'), nullable=False)
+    changed_at = db.Column(db.DateTime, default=db.func.now())
+
+
+# Response cache
+
+# table name -> version, bumped after every commit that wrote to the table
+table_versions = {}
+
+
+def touched_tables(session):
+    tables = set()
+    for obj in session.new | session.dirty | session.deleted:
+        mapper = attributes.instance_state(obj).mapper
+        tables.add(mapper.local_table.name)
+        # Writes through a secondary= collection only show up as a change on the parent
+        for rel in mapper.relationships:
+            if rel.secondary is not None and attributes.get_history(obj, rel.key).has_changes():
+                tables.add(rel.secondary.name)
+    return tables
+
+
+def bump_versions(tables):
+    for table in tables:
+        table_versions[table] = table_versions.get(table, 0) + 1
+
+
+@event.listens_for(Session, 'after_flush')
+def collect_touched_tables(session, flush_context):
+    session.info.setdefault('touched_tables', set()).update(touched_tables(session))
+
+
+@event.listens_for(Session, 'after_commit')
+def invalidate_touched_tables(session):
+    bump_versions(session.info.pop('touched_tables', ()))
+
+
+@event.listens_for(Session, 'after_rollback')
+def forget_touched_tables(session):
+    session.info.pop('touched_tables', None)
+
+
+class ResponseCache:
+    # LRU of rendered response bodies keyed by URL, valid while the versions of the
+    # tables they were built from are unchanged and the TTL has not run out
+
+    def __init__(self, maxsize, ttl):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.not_modified = 0
+
+    def get(self, key, versions):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None or entry['versions'] != versions or entry['expires'] < time.monotonic():
+                self.misses += 1
+                return None
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return entry
+
+    def put(self, key, versions, response):
+        body = response.get_data()
+        entry = {
+            'versions': versions,
+            'expires': time.monotonic() + self.ttl,
+            'body': body,
+            'mimetype': response.mimetype,
+            'headers': [(name, value) for name, value in response.headers if name.startswith('X-')],
+            'etag': hashlib.sha1(body).hexdigest(),
+        }
+        with self.lock:
+            self.entries[key] = entry
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.maxsize:
+                self.entries.popitem(last=False)
+        return entry
+
+    def stats(self):
+        with self.lock:
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'not_modified': self.not_modified,
+                'size': len(self.entries),
+                'maxsize': self.maxsize,
+            }
+
+
+response_cache = ResponseCache(RESPONSE_CACHE_SIZE, RESPONSE_CACHE_TTL)
+
+
+def cached_response(*tables):
+    def decorator(view):
+        @wraps(view)
+        def wrapper(*args, **kwargs):
+            key = request.full_path
+            versions = tuple(table_versions.get(table, 0) for table in tables)
+            entry = response_cache.get(key, versions)
+            if entry is None:
+                response = current_app.make_response(view(*args, **kwargs))
+                if response.status_code != 200 or response.is_streamed:
+                    return response
+                entry = response_cache.put(key, versions, response)
+
+            if request.if_none_match.contains(entry['etag']):
+                with response_cache.lock:
+                    response_cache.not_modified += 1
+                # The cursor still tells the client where the next page starts
+                response = Response(status=304, headers=entry['headers'])
+            else:
+                response = Response(entry['body'], mimetype=entry['mimetype'], headers=entry['headers'])
+            response.set_etag(entry['etag'])
+            response.headers['Cache-Control'] = 'no-cache'
+            return response
+        return wrapper
+    return decorator
+
+
+# Read replicas
+
+class ReplicaRouter:
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.position = 0
+        self.up = set()
+        self.down_until = {}
+
+    def keys(self):
+        return sorted(key for key in current_app.config['SQLALCHEMY_BINDS'] if key.startswith('replica_'))
+
+    def serves_request(self):
+        return (has_request_context() and request.method in ('GET', 'HEAD')
+                and bool(current_app.config['SQLALCHEMY_BINDS']))
+
+    def healthy(self, key):
+        try:
+            with db.engines[key].connect() as connection:
+                connection.exec_driver_sql('SELECT 1')
+            return True
+        except OperationalError:
+            return False
+
+    def choose(self):
+        keys = self.keys()
+        for _ in range(len(keys)):
+            with self.lock:
+                key = keys[self.position % len(keys)]
+                self.position += 1
+                if key in self.up:
+                    return key
+                if self.down_until.get(key, 0) > time.monotonic():
+                    continue
+            # First use, or the back-off ran out: probe before sending traffic
+            if self.healthy(key):
+                with self.lock:
+                    self.up.add(key)
+                    self.down_until.pop(key, None)
+                return key
+            self.mark_down(key)
+        return None
+
+    def is_up(self, key):
+        with self.lock:
+            return key in self.up
+
+    def mark_down(self, key):
+        with self.lock:
+            self.up.discard(key)
+            self.down_until[key] = time.monotonic() + current_app.config['REPLICA_RETRY_SECONDS']
+
+    def status(self):
+        now = time.monotonic()
+        with self.lock:
+            return {key: 'up' if key in self.up else 'down' if self.down_until.get(key, 0) > now else 'unknown'
+                    for key in self.keys()}
+
+
+replica_router = ReplicaRouter()
+
+
+@event.listens_for(Engine, 'handle_error')
+def mark_replica_down(context):
+    # Lost connections and failures to connect at all, not errors in the statement itself
+    if not (context.is_disconnect or context.connection is None):
+        return
+    if not has_app_context():
+        return
+    for key in replica_router.keys():
+        if db.engines[key] is context.engine:
+            replica_router.mark_down(key)
+
+
+# Instrumentation
+
+@event.listens_for(Engine, 'before_cursor_execute')
+def start_query_timer(conn, cursor, statement, parameters, context, executemany):
+    conn.info.setdefault('query_start', []).append(time.perf_counter())
+
+
+@event.listens_for(Engine, 'after_cursor_execute')
+def record_query(conn, cursor, statement, parameters, context, executemany):
+    elapsed = time.perf_counter() - conn.info['query_start'].pop()
+    if not has_request_context():
+        return
+    g.db_time = g.get('db_time', 0) + elapsed
+    g.db_count = g.get('db_count', 0) + 1
+    if elapsed * 1000 >= current_app.config['SLOW_QUERY_MS']:
+        current_app.logger.warning('Slow query (%.1f ms) on %s: %s %.500r',
+                                   elapsed * 1000, request.endpoint, statement, parameters)
+
+
+@contextmanager
+def serialize_timer():
+    # Time spent turning rows into JSON, minus the lazy loads it triggered
+    start, db_before = time.perf_counter(), g.get('db_time', 0)
+    yield
+    g.serialize_time = g.get('serialize_time', 0) + time.perf_counter() - start - (g.get('db_time', 0) - db_before)
+
+
+class RouteMetrics:
+
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.routes = {}
+        self.lock = threading.Lock()
+
+    def record(self, route, elapsed_ms, db_ms, db_count):
+        with self.lock:
+            metrics = self.routes.setdefault(route, {
+                'count': 0, 'total_ms': 0.0, 'db_ms': 0.0, 'queries': 0,
+                'buckets': [0] * (len(self.buckets) + 1),
+            })
+            metrics['count'] += 1
+            metrics['total_ms'] += elapsed_ms
+            metrics['db_ms'] += db_ms
+            metrics['queries'] += db_count
+            metrics['buckets'][next((i for i, bound in enumerate(self.buckets) if elapsed_ms <= bound),
+                                    len(self.buckets))] += 1
+
+    def reset(self):
+        with self.lock:
+            self.routes = {}
+
+    def snapshot(self):
+        with self.lock:
+            return {
+                route: dict(metrics,
+                            buckets=dict(zip([str(bound) for bound in self.buckets] + ['+Inf'], metrics['buckets'])),
+                            avg_ms=round(metrics['total_ms'] / metrics['count'], 3),
+                            avg_queries=round(metrics['queries'] / metrics['count'], 2))
+                for route, metrics in self.routes.items()
+            }
+
+
+route_metrics = RouteMetrics(LATENCY_BUCKETS_MS)
+
+
+@api.before_app_request
+def start_request_timer():
+    g.request_start = time.perf_counter()
+
+
+@api.after_app_request
+def add_server_timing(response):
+    db_ms = g.get('db_time', 0) * 1000
+    response.headers['Server-Timing'] = ', '.join([
+        f'db;dur={db_ms:.2f}',
+        f'serialize;dur={g.get("serialize_time", 0) * 1000:.2f}',
+        f'total;dur={(time.perf_counter() - g.request_start) * 1000:.2f}',
+        f'queries;desc="{g.get("db_count", 0)}"',
+    ])
+    return response
+
+
+@api.teardown_app_request
+def record_request_metrics(exc):
+    # Runs after a streamed body is fully sent, so streams are measured end to end
+    if 'request_start' not in g:
+        return
+    db_count = g.get('db_count', 0)
+    if db_count >= current_app.config['REQUEST_QUERY_WARNING']:
+        current_app.logger.warning('%s ran %d queries', request.path, db_count)
+    route = request.url_rule.rule if request.url_rule else 'unmatched'
+    route_metrics.record(route, (time.perf_counter() - g.request_start) * 1000, g.get('db_time', 0) * 1000, db_count)
+
+
+# Admission control
+
+# Endpoints outside the 'default' class, writes are 'write' whatever the endpoint. None is never held
+ENDPOINT_CLASSES = {
+    'api.get_patient_question': 'list',
+    'api.get_processed_question': 'list',
+    'api.get_enhanced': 'list',
+    'api.get_articles': 'list',
+    'api.get_patient': 'list',
+    'api.get_changes': 'list',
+    'api.search': 'list',
+    'api.export': 'export',
+    'api.get_metrics': None,
+    'api.get_cache_stats': None,
+}
+# Per route class: requests running at once (None for no limit), requests waiting beyond that and
+# for how many seconds, the statement timeout, and the Retry-After sent with a 503. Limits are per
+# process: with gunicorn they need threaded workers to mean anything
+ROUTE_CLASSES = {
+    'default': {'concurrency': None, 'queue': 0, 'wait': 0, 'timeout_ms': 10000, 'retry_after': 1},
+    'list': {'concurrency': 4, 'queue': 8, 'wait': 1.0, 'timeout_ms': 30000, 'retry_after': 2},
+    'export': {'concurrency': 1, 'queue': 0, 'wait': 0, 'timeout_ms': None, 'retry_after': 30},
+    'write': {'concurrency': 2, 'queue': 8, 'wait': 5.0, 'timeout_ms': 60000, 'retry_after': 5},
+}
+# SQLite VM instructions between checks of the time budget
+SQLITE_PROGRESS_STEPS = 10000
+
+
+class AdmissionGate:
+
+    def __init__(self):
+        self.condition = threading.Condition()
+        self.active = 0
+        self.waiting = 0
+        self.max_waiting = 0
+        self.admitted = 0
+        self.queued = 0
+        self.rejected = 0
+        self.timeouts = 0
+
+    def enter(self, concurrency, queue, wait):
+        # True once the request may run, False if it is turned away
+        with self.condition:
+            if concurrency is None or self.active < concurrency:
+                self.active += 1
+                self.admitted += 1
+                return True
+            if self.waiting >= queue:
+                self.rejected += 1
+                return False
+            self.waiting += 1
+            self.max_waiting = max(self.max_waiting, self.waiting)
+            deadline = time.monotonic() + wait
+            try:
+                while self.active >= concurrency:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        self.rejected += 1
+                        return False
+                    self.condition.wait(remaining)
+            finally:
+                self.waiting -= 1
+            self.active += 1
+            self.admitted += 1
+            self.queued += 1
+            return True
+
+    def leave(self):
+        with self.condition:
+            self.active -= 1
+            self.condition.notify()
+
+    def snapshot(self):
+        with self.condition:
+            return {'active': self.active, 'waiting': self.waiting, 'max_waiting': self.max_waiting,
+                    'admitted': self.admitted, 'queued': self.queued, 'rejected': self.rejected,
+                    'timeouts': self.timeouts}
+
+
+admission_gates = {name: AdmissionGate() for name in ROUTE_CLASSES}
+
+
+def route_class():
+    if request.method not in ('GET', 'HEAD', 'OPTIONS'):
+        return 'write'
+    return ENDPOINT_CLASSES.get(request.endpoint, 'default')
+
+
+def busy_response(message, route_class_name):
+    response = jsonify({'message': message})
+    response.status_code = 503
+    response.headers['Retry-After'] = str(current_app.config['ROUTE_CLASSES'][route_class_name]['retry_after'])
+    return response
+
+
+@api.before_app_request
+def admit_request():
+    name = route_class()
+    if name is None:
+        return None
+    limits = current_app.config['ROUTE_CLASSES'][name]
+    if not admission_gates[name].enter(limits['concurrency'], limits['queue'], limits['wait']):
+        return busy_response('Too many requests of this kind, retry later', name)
+    g.route_class = name
+    g.statement_timeout_ms = limits['timeout_ms']
+    return None
+
+
+@api.teardown_app_request
+def release_request(exc):
+    # Like the metrics, runs once a streamed body has been sent
+    if 'route_class' in g:
+        admission_gates[g.pop('route_class')].leave()
+
+
+@event.listens_for(Session, 'after_begin')
+def set_statement_timeout(session, transaction, connection):
+    if connection.dialect.name != 'postgresql' or not has_request_context():
+        return
+    timeout = g.get('statement_timeout_ms')
+    if timeout:
+        connection.exec_driver_sql(f'SET LOCAL statement_timeout = {int(timeout)}')
+
+
+@event.listens_for(Engine, 'before_cursor_execute')
+def set_sqlite_budget(conn, cursor, statement, parameters, context, executemany):
+    # SQLite has no statement timeout: a progress handler interrupts the statement once it runs past
+    # the budget, which takes in fetching its rows. Every statement sets or clears it, the
+    # connection goes back to the pool with it
+    if conn.dialect.name != 'sqlite':
+        return
+    timeout = g.get('statement_timeout_ms') if has_request_context() else None
+    if timeout:
+        deadline = time.monotonic() + timeout / 1000
+        conn.connection.dbapi_connection.set_progress_handler(lambda: time.monotonic() > deadline,
+                                                              SQLITE_PROGRESS_STEPS)
+        conn.info['sqlite_budget'] = True
+    elif conn.info.pop('sqlite_budget', False):
+        conn.connection.dbapi_connection.set_progress_handler(None, 0)
+
+
+def is_statement_timeout(error):
+    return getattr(error.orig, 'pgcode', None) == '57014' or str(error.orig) == 'interrupted'
+
+
+@api.app_errorhandler(OperationalError)
+def statement_timeout_error(error):
+    if not is_statement_timeout(error) or 'route_class' not in g:
+        raise error
+    gate = admission_gates[g.route_class]
+    with gate.condition:
+        gate.timeouts += 1
+    return busy_response('The query ran past the time budget of this route', g.route_class)
 
 
 #routes
 
-@app.route('/api/patient_question', methods=['GET'])
+@api.route('/api/patient_question', methods=['GET'])
 def get_patient_question():
-    patient_questions = PatientQuestion.query.all()
-    return jsonify([question.serialize() for question in patient_questions])
+    return list_response(PatientQuestion)
 
-@app.route('/api/processed_question', methods=['GET'])
+@api.route('/api/processed_question', methods=['GET'])
 def get_processed_question():
-    processed_questions = ProcessedQuestion.query.all()
-    return jsonify([question.serialize() for question in processed_questions])
+    return list_response(ProcessedQuestion)
 
-@app.route('/api/enhanced', methods=['GET'])
+@api.route('/api/enhanced', methods=['GET'])
 def get_enhanced():
-    enhanced_data = Enhanced.query.all()
-    return jsonify([enhanced.serialize() for enhanced in enhanced_data])
+    return list_response(Enhanced)
 
-@app.route('/api/articles', methods=['GET'])
+@api.route('/api/articles', methods=['GET'])
 def get_articles():
-    articles = Articles.query.all()
-    return jsonify([article.serialize() for article in articles])
+    return list_response(Articles)
 
-@app.route('/api/patient', methods=['GET'])
+@api.route('/api/patient', methods=['GET'])
 def get_patient():
-    patients = Patient.query.all()
-    return jsonify([patient.serialize() for patient in patients])
+    return list_response(Patient)
 
-@app.route('/api/question_type', methods=['GET'])
+@api.route('/api/question_type', methods=['GET'])
+@cached_response('question_type')
 def get_question_type():
-    question_types = QuestionType.query.all()
-    return jsonify([question_type.serialize() for question_type in question_types])
+    return column_list_response(QuestionType)
 
-@app.route('/api/treatment', methods=['GET'])
+@api.route('/api/treatment', methods=['GET'])
+@cached_response('treatment')
 def get_treatment():
-    treatments = Treatment.query.all()
-    return jsonify([treatment.serialize() for treatment in treatments])
+    return column_list_response(Treatment)
 
-@app.route('/api/disease', methods=['GET'])
+@api.route('/api/disease', methods=['GET'])
+@cached_response('disease', 'disease_m', 'disease_mutation', 'disease_l', 'disease_location', 'disease_p',
+                 'disease_protein')
 def get_disease():
-    diseases = Disease.query.all()
-    return jsonify([disease.serialize() for disease in diseases])
+    args, profile = split_profile(request.args)
+    if not profile:
+        return column_list_response(Disease)
+    return column_list_response(Disease, args, attach=attach_profiles)
+
+@api.route('/api/_cache', methods=['GET'])
+def get_cache_stats():
+    return jsonify(response_cache.stats())
+
+@api.route('/api/_metrics', methods=['GET'])
+def get_metrics():
+    return jsonify({'buckets_ms': LATENCY_BUCKETS_MS, 'routes': route_metrics.snapshot(),
+                    'replicas': replica_router.status(),
+                    'admission': {name: gate.snapshot() for name, gate in admission_gates.items()}})
+
+
+def parse_fields(args):
+    fields = args.get('fields')
+    if fields is None:
+        return None
+    return {name for name in fields.split(',') if name}
+
+
+def parse_expand(args, *models):
+    # ?expand=patient_objects,patient_objects.cp_objects -> {'patient_objects': {'cp_objects': {}}}
+    # Every path has to exist on at least one of the models, which also bounds the depth
+    value = args.get('expand')
+    if value is None:
+        return None
+    tree = {}
+    for path in filter(None, value.split(',')):
+        names = path.split('.')
+        if not any(relationship_path_exists(model, names) for model in models):
+            raise ValueError(f'Unknown expand path {path}')
+        node = tree
+        for name in names:
+            node = node.setdefault(name, {})
+    return tree
+
+
+def relationship_path_exists(model, names):
+    for name in names:
+        if name not in getattr(model, 'serialize_relationships', ()):
+            return False
+        model = getattr(model, name).property.mapper.class_
+    return True
+
+
+def eager_options(model, fields=None, expand=None):
+    # Load the collections serialize() will walk up front, one SELECT ... IN per relationship,
+    # so the number of queries does not depend on how many rows come back. Soft-deleted rows are
+    # left out of all of them
+    return [*relationship_loads(model, fields, expand), LIVE_ROWS]
+
+
+def relationship_loads(model, fields=None, expand=None):
+    options = []
+    for name in getattr(model, 'serialize_relationships', ()):
+        if (fields is not None and name not in fields) or (expand is not None and name not in expand):
+            continue
+        attr = getattr(model, name)
+        nested = relationship_loads(attr.property.mapper.class_, expand=None if expand is None else expand[name])
+        options.append(selectinload(attr).options(*nested) if nested else selectinload(attr))
+    return options
+
+
+def with_relationships(key, obj, fields=None, expand=None):
+    # serialize() already expands the relationships, reuse them instead of serializing twice
+    data = obj.serialize(fields, expand)
+    document = {key: data}
+    for name in obj.serialize_relationships:
+        if name in data:
+            document[name] = data[name]
+    return document
+
+
+def page_statement(statement, pk, args):
+    # ?after=<pk>&limit=N pages on the primary key, raises ValueError with the message for the client
+    after = args.get('after')
+    if after is not None:
+        try:
+            statement = statement.where(pk > pk.type.python_type(after))
+        except ValueError:
+            raise ValueError('Invalid after cursor')
+
+    limit = args.get('limit')
+    if limit is not None:
+        if not limit.isdigit() or not 0 < int(limit) <= PAGE_LIMIT_MAX:
+            raise ValueError(f'limit must be between 1 and {PAGE_LIMIT_MAX}')
+        limit = int(limit)
+        statement = statement.limit(limit)
+
+    return statement, limit
+
+
+def list_statement(model, args):
+    # Shared with the async app
+    fields = parse_fields(args)
+    expand = parse_expand(args, model)
+
+    pk = model.__mapper__.primary_key[0]
+    statement = select(model).options(*eager_options(model, fields, expand)).where(*live(model)).order_by(pk)
+    statement, limit = page_statement(statement, pk, args)
+    return statement, fields, expand, limit
+
+
+def column_statement(model, args):
+    # The flat tables: select the requested columns as plain rows, no ORM instances. The primary
+    # key is always selected, last, for the cursor; keys are the names that go in the output
+    fields = parse_fields(args)
+    parse_expand(args, model)
+
+    pk = model.__mapper__.primary_key[0]
+    columns = [column for column in model.__table__.columns if fields is None or column.key in fields]
+    keys = [column.key for column in columns]
+    statement = select(*columns, pk).order_by(pk)
+    statement, limit = page_statement(statement, pk, args)
+    return statement, keys, limit
+
+
+def json_default(value):
+    # ISO 8601 dates, as orjson writes them
+    if isinstance(value, (datetime.date, datetime.datetime)):
+        return value.isoformat()
+    raise TypeError(f'{type(value).__name__} is not JSON serializable')
+
+
+def dumps_json(data):
+    # orjson when it is installed, the standard library otherwise, same bytes either way
+    if orjson is not None:
+        return orjson.dumps(data, option=orjson.OPT_SORT_KEYS)
+    return json.dumps(data, sort_keys=True, separators=(',', ':'), ensure_ascii=False,
+                      default=json_default).encode()
+
+
+def next_cursor(model, objects, limit):
+    if limit is not None and len(objects) == limit:
+        return str(getattr(objects[-1], model.__mapper__.primary_key[0].key))
+    return None
+
+
+def page_end_statement(statement, pk):
+    # A streamed page sends its headers before any row is read, so its size and last key, for
+    # X-Next-Cursor, come from a query of their own
+    page = statement.with_only_columns(pk).subquery()
+    return select(func.count(), func.max(page.c[0]))
+
+
+def page_end_cursor(page_end, limit):
+    count, last = page_end
+    return str(last) if count == limit else None
+
+
+def streamed_cursor_headers(statement, model, limit):
+    if limit is None:
+        return {}
+    cursor = page_end_cursor(db.session.execute(
+        page_end_statement(statement, model.__mapper__.primary_key[0])).one(), limit)
+    return {} if cursor is None else {'X-Next-Cursor': cursor}
+
+
+def list_response(model):
+    # ?stream=1 fetches in chunks and writes the array out as it goes
+    try:
+        statement, fields, expand, limit = list_statement(model, request.args)
+    except ValueError as e:
+        return jsonify({'message': str(e)}), 400
+
+    if request.args.get('stream') in ('1', 'true'):
+        def generate():
+            yield '['
+            rows = db.session.scalars(statement.execution_options(yield_per=STREAM_CHUNK_SIZE))
+            for i, obj in enumerate(rows):
+                yield (',' if i else '') + json.dumps(obj.serialize(fields, expand))
+            yield ']'
+
+        return Response(stream_with_context(generate()), mimetype='application/json',
+                        headers=streamed_cursor_headers(statement, model, limit))
+
+    objects = db.session.scalars(statement).all()
+    with serialize_timer():
+        response = jsonify([obj.serialize(fields, expand) for obj in objects])
+    cursor = next_cursor(model, objects, limit)
+    if cursor is not None:
+        response.headers['X-Next-Cursor'] = cursor
+    return response
+
+
+
+def column_list_response(model, args=None, attach=None):
+    # Same parameters and output as list_response, for models with no relationships to expand.
+    # attach(items, ids) adds to each chunk of output rows, given their primary keys
+    args = request.args if args is None else args
+    try:
+        statement, keys, limit = column_statement(model, args)
+    except ValueError as e:
+        return jsonify({'message': str(e)}), 400
+
+    def items(rows):
+        chunk = [dict(zip(keys, row)) for row in rows]
+        if attach is not None:
+            attach(chunk, [row[-1] for row in rows])
+        return chunk
+
+    if args.get('stream') in ('1', 'true'):
+        def generate():
+            yield b'['
+            result = db.session.execute(statement.execution_options(yield_per=STREAM_CHUNK_SIZE))
+            for i, rows in enumerate(result.partitions()):
+                yield (b',' if i else b'') + dumps_json(items(rows))[1:-1]
+            yield b']'
+
+        return Response(stream_with_context(generate()), mimetype='application/json',
+                        headers=streamed_cursor_headers(statement, model, limit))
+
+    rows = db.session.execute(statement).all()
+    with serialize_timer():
+        response = Response(dumps_json(items(rows)), mimetype='application/json')
+    if limit is not None and len(rows) == limit:
+        response.headers['X-Next-Cursor'] = str(rows[-1][-1])
+    return response
+
+
+CASE_MODELS = (Cases, PatientQuestion, ProcessedQuestion, Enhanced, Articles)
+
+
+# Disease profiles
+
+# (profile key, link model, link column to the dimension row, dimension model)
+PROFILE_LINKS = (
+    ('mutations', DiseaseM, DiseaseM.mutation_id, DiseaseMutation),
+    ('locations', DiseaseL, DiseaseL.location_id, DiseaseLocation),
+    ('proteins', DiseaseP, DiseaseP.protein_id, DiseaseProtein),
+)
+# Keys holding lists of serialized diseases in a case document: 'diseases' for the case's own,
+# and every relationship of the case models that leads to Disease
+PROFILE_DISEASE_KEYS = frozenset(('diseases',)) | frozenset(
+    name for model in CASE_MODELS for name in model.serialize_relationships
+    if getattr(model, name).property.mapper.class_ is Disease)
+
+
+def split_profile(args):
+    # ?expand=profile is not a relationship, take it out and let the rest of expand parse as
+    # usual. On its own it keeps the default expansion. Returns (args, whether it was asked for)
+    value = args.get('expand')
+    names = [] if value is None else [name for name in value.split(',') if name]
+    if 'profile' not in names:
+        return args, False
+    args = args.copy()
+    rest = [name for name in names if name != 'profile']
+    if rest:
+        args['expand'] = ','.join(rest)
+    else:
+        del args['expand']
+    return args, True
+
+
+class DimensionCache:
+    # The mutation, location and protein tables, a few hundred rows each, read whole and kept
+    # in-process: id -> serialized row, reloaded once the table is written or the TTL runs out
+
+    def __init__(self, ttl):
+        self.ttl = ttl
+        self.lock = threading.Lock()
+        self.entries = {}
+
+    def rows(self, model):
+        version = table_versions.get(model.__tablename__, 0)
+        rows = self.cached(model, version)
+        if rows is None:
+            rows = self.store(model, version, db.session.execute(self.statement(model)))
+        return rows
+
+    # The steps of rows(), for the async app to run the statement on its own session
+
+    def cached(self, model, version):
+        with self.lock:
+            entry = self.entries.get(model)
+        if entry is not None and entry['version'] == version and entry['expires'] >= time.monotonic():
+            return entry['rows']
+        return None
+
+    def statement(self, model):
+        return select(*model.__table__.columns).order_by(model.id)
+
+    def store(self, model, version, result):
+        rows = {row.id: dict(row._mapping) for row in result}
+        with self.lock:
+            self.entries[model] = {'version': version, 'expires': time.monotonic() + self.ttl, 'rows': rows}
+        return rows
+
+
+dimension_cache = DimensionCache(RESPONSE_CACHE_TTL)
+
+
+def profile_link_statement(link, column, disease_ids):
+    return select(link.disease_id, column).where(link.disease_id.in_(disease_ids)).order_by(link.disease_id, column)
+
+
+class DiseaseProfileLoader:
+    # DataLoader-style: add() the disease ids a response mentions, the first get() loads every
+    # pending profile at once, one IN query per link table whatever the number of diseases
+
+    def __init__(self):
+        self.pending = set()
+        self.profiles = {}
+
+    def add(self, disease_id):
+        if disease_id not in self.profiles:
+            self.pending.add(disease_id)
+
+    def dispatch(self):
+        ids = self.claim()
+        if not ids:
+            return
+        for key, link, column, dimension in PROFILE_LINKS:
+            rows = dimension_cache.rows(dimension)
+            self.apply(key, rows, db.session.execute(profile_link_statement(link, column, ids)))
+
+    # The steps of dispatch(), for the async app to run the statements on its own session
+
+    def claim(self):
+        # The pending ids, each given an empty profile
+        ids = sorted(self.pending)
+        self.pending.clear()
+        for disease_id in ids:
+            self.profiles[disease_id] = {key: [] for key, _, _, _ in PROFILE_LINKS}
+        return ids
+
+    def apply(self, key, rows, links):
+        for disease_id, dimension_id in links:
+            # A link to a row that is gone is left out, as a relationship load would
+            if dimension_id in rows:
+                self.profiles[disease_id][key].append(rows[dimension_id])
+
+    def get(self, disease_id):
+        self.dispatch()
+        return self.profiles[disease_id]
+
+
+def attach_profiles(items, disease_ids, loader=None):
+    # Rows of /api/disease, in place. The async app passes a loader it has already dispatched
+    if loader is None:
+        loader = disease_profile_loader(disease_ids)
+    for item, disease_id in zip(items, disease_ids):
+        item['profile'] = loader.get(disease_id)
+
+
+def disease_profile_loader(disease_ids):
+    loader = DiseaseProfileLoader()
+    for disease_id in disease_ids:
+        loader.add(disease_id)
+    return loader
+
+
+def case_diseases(value):
+    # Every serialized disease in a case document
+    if isinstance(value, dict):
+        for key, item in value.items():
+            if key in PROFILE_DISEASE_KEYS and isinstance(item, list):
+                yield from item
+            else:
+                yield from case_diseases(item)
+    elif isinstance(value, list):
+        for item in value:
+            yield from case_diseases(item)
+
+
+def with_profiles(value, loader, key=None):
+    # A copy of a case document with a profile on every disease: materialized documents come
+    # straight from case_document and are not changed in place
+    if isinstance(value, dict):
+        return {name: with_profiles(item, loader, name) for name, item in value.items()}
+    if isinstance(value, list):
+        if key in PROFILE_DISEASE_KEYS:
+            return [{**disease, 'profile': loader.get(disease['id'])} for disease in value]
+        return [with_profiles(item, loader) for item in value]
+    return value
+
+
+def case_documents_with_profiles(documents, loader=None):
+    if loader is None:
+        loader = disease_profile_loader(disease['id'] for document in documents.values()
+                                        for disease in case_diseases(document))
+    return {case_id: with_profiles(document, loader) for case_id, document in documents.items()}
+
+
+# (document key, wrapper key, model) for the children listed in a case document
+CASE_DOCUMENT_CHILDREN = (
+    ('patient_questions', 'patient_question', PatientQuestion),
+    ('processed_questions', 'processed_question', ProcessedQuestion),
+    ('enhanced_objects', 'enhanced', Enhanced),
+    ('articles', 'article', Articles),
+)
+
+
+def case_children_statement(model, case_ids, fields=None, expand=None):
+    return (select(model).options(*eager_options(model, fields, expand))
+            .where(model.case_id.in_(case_ids), *live(model)).order_by(model.id))
+
+
+def group_children(key, objects, fields=None, expand=None):
+    grouped = {}
+    for obj in objects:
+        grouped.setdefault(obj.case_id, []).append(with_relationships(key, obj, fields, expand))
+    return grouped
+
+
+def assemble_case_document(case, children, fields=None, expand=None):
+    # children: document key -> {case_id: [serialized child, ...]}
+    case_data = case.serialize(fields, expand)
+    document = {'case': case_data}
+    for key, name in (('patients', 'patient_objects'), ('diseases', 'disease_objects'),
+                      ('questions', 'question_objects'), ('treatments', 'treatment_objects')):
+        if name in case_data:
+            document[key] = case_data[name]
+    for key, _, _ in CASE_DOCUMENT_CHILDREN:
+        document[key] = children[key].get(case.id, [])
+    return document
+
+
+def build_case_documents(case_ids, fields=None, expand=None):
+    # Set-based: one IN query per model and per loaded relationship, however many cases are asked for
+    statement = (select(Cases).options(*eager_options(Cases, fields, expand))
+                 .where(Cases.id.in_(case_ids), *live(Cases)))
+    cases = db.session.scalars(statement).all()
+    if not cases:
+        return {}
+
+    found = [case.id for case in cases]
+    children = {
+        key: group_children(wrapper, db.session.scalars(case_children_statement(model, found, fields, expand)),
+                            fields, expand)
+        for key, wrapper, model in CASE_DOCUMENT_CHILDREN
+    }
+    return {case.id: assemble_case_document(case, children, fields, expand) for case in cases}
+
+
+CASE_CHILD_TABLES = ('patient_question', 'processed_question', 'enhanced', 'articles')
+CASE_ENTITY_TABLES = ('patient', 'disease', 'treatment', 'question_type')
+# Rows whose serialized form lists their links, a new link to them changes the document
+CASE_LINKED_TABLES = ('cases', 'patient') + CASE_CHILD_TABLES
+
+
+def changed_rows(session):
+    # (table, primary key) for every row the flush wrote, plus the rows whose serialized form
+    # includes the changed links: a row pointed to by a changed row, or the far end of an edge
+    # added or removed through a secondary= collection
+    keys = set()
+    for obj in session.new | session.dirty | session.deleted:
+        if isinstance(obj, CaseDocument):
+            continue
+        mapper = attributes.instance_state(obj).mapper
+        table = mapper.local_table
+        pk = mapper.primary_key_from_instance(obj)
+        # A backref append marks the far end dirty too, that alone does not change how it serializes
+        column_change = (obj not in session.dirty or table.name in CASE_LINKED_TABLES
+                         or session.is_modified(obj, include_collections=False))
+        if len(pk) == 1 and column_change:
+            keys.add((table.name, pk[0]))
+        for fk in table.foreign_keys:
+            if fk.column.table.name not in CASE_LINKED_TABLES:
+                continue
+            prop = mapper.get_property_by_column(fk.parent)
+            for value in attributes.get_history(obj, prop.key).sum():
+                if value is not None:
+                    keys.add((fk.column.table.name, value))
+        for rel in mapper.relationships:
+            if rel.secondary is None or rel.mapper.local_table.name not in CASE_LINKED_TABLES:
+                continue
+            history = attributes.get_history(obj, rel.key)
+            for item in list(history.added or ()) + list(history.deleted or ()):
+                keys.add((rel.mapper.local_table.name, rel.mapper.primary_key_from_instance(item)[0]))
+    return keys
+
+
+def case_id_selects(table_name, ids):
+    # Case ids reachable from rows of table_name, directly or through any association table
+    table = db.metadata.tables[table_name]
+    if table_name in CASE_CHILD_TABLES:
+        return [select(table.c.case_id).where(table.c.id.in_(ids))]
+
+    selects = []
+    for link in db.metadata.tables.values():
+        entity_fks = [fk for fk in link.foreign_keys if fk.column.table is table]
+        parent_fks = [fk for fk in link.foreign_keys if fk.column.table.name in ('cases',) + CASE_CHILD_TABLES]
+        if not entity_fks or not parent_fks:
+            continue
+        entity_col, parent_fk = entity_fks[0].parent, parent_fks[0]
+        if parent_fk.column.table.name == 'cases':
+            selects.append(select(parent_fk.parent).where(entity_col.in_(ids)))
+        else:
+            parent = parent_fk.column.table
+            selects.append(select(parent.c.case_id)
+                           .select_from(link.join(parent, parent_fk.parent == parent.c.id))
+                           .where(entity_col.in_(ids)))
+    return selects
+
+
+def affected_case_ids(keys):
+    ids_by_table = {}
+    for table_name, pk in keys:
+        ids_by_table.setdefault(table_name, set()).add(pk)
+
+    case_ids = set(ids_by_table.pop('cases', ()))
+    selects = []
+    for table_name in CASE_CHILD_TABLES + CASE_ENTITY_TABLES:
+        if ids_by_table.get(table_name):
+            selects.extend(case_id_selects(table_name, ids_by_table[table_name]))
+    if selects:
+        case_ids.update(case_id for case_id in db.session.execute(union_all(*selects)).scalars() if case_id is not None)
+    return case_ids
+
+
+def refresh_case_documents(case_ids):
+    case_ids = list(case_ids)
+    for start in range(0, len(case_ids), DOCUMENT_BATCH_SIZE):
+        batch = case_ids[start:start + DOCUMENT_BATCH_SIZE]
+        documents = build_case_documents(batch)
+        # Core statements, one per kind of change and batch: the ORM would send a row at a time.
+        # An upsert, since a read may store the same document first and the writer has to win
+        table = CaseDocument.__table__
+        gone = [case_id for case_id in batch if case_id not in documents]
+        if gone:
+            db.session.execute(table.delete().where(table.c.case_id.in_(gone)))
+        if documents:
+            db.session.execute(upsert_statement(table, replace=True), [
+                {'case_id': case_id, 'document': document} for case_id, document in documents.items()])
+
+
+@event.listens_for(Session, 'after_flush')
+def collect_changed_rows(session, flush_context):
+    session.info.setdefault('changed_rows', set()).update(changed_rows(session))
+
+
+@event.listens_for(Session, 'before_commit')
+def refresh_changed_case_documents(session):
+    session.flush()
+    keys = session.info.pop('changed_rows', None)
+    if keys:
+        case_ids = affected_case_ids(keys)
+        refresh_case_documents(case_ids)
+        session.flush()
+        session.info.setdefault('changed_cases', set()).update(case_ids)
+
+
+# Called with the ids of the cases a committed transaction changed
+case_change_listeners = []
+
+
+@event.listens_for(Session, 'after_commit')
+def notify_changed_cases(session):
+    case_ids = session.info.pop('changed_cases', None)
+    if case_ids:
+        for listener in case_change_listeners:
+            listener(case_ids)
+
+
+@event.listens_for(Session, 'after_rollback')
+def forget_changed_rows(session):
+    session.info.pop('changed_rows', None)
+    session.info.pop('changed_cases', None)
+
+
+def row_key(table, values):
+    return {column.key: values[column.key] for column in table.primary_key.columns}
+
+
+def edge_key(mapper, rel, obj, item):
+    # The secondary row linking obj to item through rel, as {column: value}
+    key = {}
+    for column, secondary_column in rel.synchronize_pairs:
+        key[secondary_column.key] = getattr(obj, mapper.get_property_by_column(column).key)
+    for column, secondary_column in rel.secondary_synchronize_pairs:
+        key[secondary_column.key] = getattr(item, rel.mapper.get_property_by_column(column).key)
+    return key
+
+
+def row_changes(session):
+    # (table, key, operation) for every row the flush wrote, including edges added or removed
+    # through a secondary= collection. A parent marked dirty only by such an edge is not updated
+    changes = []
+    for operation, objects in (('insert', session.new), ('update', session.dirty), ('delete', session.deleted)):
+        for obj in objects:
+            if isinstance(obj, (CaseDocument, ChangeLog)):
+                continue
+            mapper = attributes.instance_state(obj).mapper
+            table = mapper.local_table
+            key = dict(zip((column.key for column in mapper.primary_key), mapper.primary_key_from_instance(obj)))
+            if operation != 'update':
+                changes.append((table.name, key, operation))
+            elif session.is_modified(obj, include_collections=False):
+                deleted = hasattr(obj, 'deleted_at') and attributes.get_history(obj, 'deleted_at').added
+                changes.append((table.name, key, 'delete' if deleted and deleted[0] is not None else 'update'))
+            for rel in mapper.relationships:
+                if rel.secondary is None:
+                    continue
+                history = attributes.get_history(obj, rel.key)
+                for items, edge_operation in ((history.added, 'insert'), (history.deleted, 'delete')):
+                    for item in items or ():
+                        changes.append((rel.secondary.name, edge_key(mapper, rel, obj, item), edge_operation))
+    return changes
+
+
+def merge_changes(session, changes):
+    # One entry per row and transaction: insert then update stays an insert, insert then delete
+    # cancels out. Backrefs report an edge from both ends, the merge drops the repeat
+    merged = session.info.setdefault('changes', {})
+    for table_name, key, operation in changes:
+        entry = (table_name, tuple(sorted(key.items())))
+        previous = merged.pop(entry, None)
+        if previous == 'insert' and operation == 'delete':
+            continue
+        merged[entry] = 'insert' if previous == 'insert' else operation
+
+
+@event.listens_for(Session, 'after_flush')
+def collect_row_changes(session, flush_context):
+    merge_changes(session, row_changes(session))
+
+
+@event.listens_for(Session, 'before_commit')
+def write_change_log(session):
+    # Registered after the case document refresh, so its flush has happened by now
+    session.flush()
+    changes = session.info.pop('changes', None)
+    if not changes:
+        return
+    if session.connection().dialect.name == 'postgresql':
+        # Ids are handed out under a lock held until commit, so they become visible in order and
+        # a reader past id n never misses a later commit of a lower id
+        session.execute(text('LOCK TABLE change_log IN EXCLUSIVE MODE'))
+    session.execute(ChangeLog.__table__.insert(), [
+        {'table_name': table_name, 'row_key': dict(key), 'operation': operation}
+        for (table_name, key), operation in changes.items()
+    ])
+
+
+@event.listens_for(Session, 'after_rollback')
+def forget_row_changes(session):
+    session.info.pop('changes', None)
+
+
+def current_rows(table, keys):
+    # Rows of table by primary key, as {key tuple: row dict}. Selected on the leading key column
+    # and narrowed here: SQLite runs a composite (a, b) IN (...) as a full scan, a IN (...) as
+    # an index lookup
+    pk = list(table.primary_key.columns)
+    wanted = {tuple(key[column.key] for column in pk) for key in keys}
+    statement = select(table).where(pk[0].in_({key[0] for key in wanted}))
+    rows = {}
+    for row in db.session.execute(statement).mappings():
+        key = tuple(row[column.key] for column in pk)
+        if key in wanted:
+            rows[key] = dict(row)
+    return rows
+
+
+@api.route('/api/changes', methods=['GET'])
+def get_changes():
+    # ?since=<cursor>&limit=N: what was inserted, updated or deleted after the cursor, oldest
+    # first, with the current row for inserts and updates. Pass the returned cursor back as since
+    since, limit = request.args.get('since', '0'), request.args.get('limit', str(CHANGES_LIMIT_DEFAULT))
+    if not since.isdigit():
+        return jsonify({'message': 'Invalid since cursor'}), 400
+    if not limit.isdigit() or not 0 < int(limit) <= PAGE_LIMIT_MAX:
+        return jsonify({'message': f'limit must be between 1 and {PAGE_LIMIT_MAX}'}), 400
+
+    log = ChangeLog.__table__
+    entries = db.session.execute(
+        select(log).where(log.c.id > int(since)).order_by(log.c.id).limit(int(limit))).mappings().all()
+
+    # Only the latest entry per row, the row data is the current state anyway
+    latest = {}
+    for entry in entries:
+        row = (entry['table_name'], tuple(sorted(entry['row_key'].items())))
+        latest.pop(row, None)
+        latest[row] = entry
+
+    wanted = {}
+    for entry in latest.values():
+        if entry['operation'] != 'delete':
+            wanted.setdefault(entry['table_name'], []).append(entry['row_key'])
+    rows = {name: current_rows(db.metadata.tables[name], keys) for name, keys in wanted.items()}
+
+    changes = []
+    for entry in latest.values():
+        change = {'cursor': entry['id'], 'table': entry['table_name'], 'key': entry['row_key'],
+                  'operation': entry['operation'], 'changed_at': entry['changed_at']}
+        if entry['operation'] != 'delete':
+            pk = db.metadata.tables[entry['table_name']].primary_key.columns
+            change['data'] = rows[entry['table_name']].get(tuple(entry['row_key'][column.key] for column in pk))
+        changes.append(change)
+
+    with serialize_timer():
+        return Response(dumps_json({
+            'changes': changes,
+            'cursor': entries[-1]['id'] if entries else int(since),
+            'has_more': len(entries) == int(limit),
+        }), mimetype='application/json')
+
+
+@api.cli.command('backfill-case-documents')
+@click.option('--batch-size', default=100, show_default=True)
+def backfill_case_documents(batch_size):
+    db.create_all(bind_key=None)
+    case_ids = db.session.execute(select(Cases.id).order_by(Cases.id)).scalars().all()
+    for start in range(0, len(case_ids), batch_size):
+        refresh_case_documents(case_ids[start:start + batch_size])
+        db.session.commit()
+    click.echo(f'Materialized {len(case_ids)} case documents')
+
+
+def load_case_documents(case_ids, fields=None, expand=None):
+    documents = {}
+    default = fields is None and expand is None
+    if default:
+        # The default document is materialized, serve it with a primary-key lookup
+        for row in CaseDocument.query.filter(CaseDocument.case_id.in_(case_ids)):
+            documents[row.case_id] = row.document
+
+    missing = [case_id for case_id in case_ids if case_id not in documents]
+    if missing:
+        built = build_case_documents(missing, fields, expand)
+        documents.update(built)
+        if default and built and not current_app.config['READ_ONLY']:
+            # One INSERT for the whole batch, the ORM would send a row at a time. A case another
+            # request materialized first is left as it is. Bound to the primary: a GET reads from
+            # a replica
+            db.session.execute(upsert_statement(CaseDocument.__table__, replace=False), [
+                {'case_id': case_id, 'document': document} for case_id, document in built.items()],
+                bind_arguments={'bind': db.engine})
+            db.session.commit()
+    return documents
+
+
+# Faceted case search
+
+CASE_FACETS = ('disease', 'treatment', 'question_type', 'age_range', 'gender')
+
+
+def case_feature_statement(case_ids=None):
+    # (case_id, facet, value) for every facet of every case, one UNION ALL round trip
+    def restrict(statement, column):
+        return statement if case_ids is None else statement.where(column.in_(case_ids))
+
+    return union_all(
+        restrict(select(Cases.id, literal('case'), literal('')).where(*live(Cases)), Cases.id),
+        restrict(select(CDObj.case_id, literal('disease'), CDObj.disease_object_id), CDObj.case_id),
+        restrict(select(CTObj.case_id, literal('treatment'), CTObj.treatment_object_id), CTObj.case_id),
+        restrict(select(CQObj.case_id, literal('question_type'), CQObj.question_object_id), CQObj.case_id),
+        restrict(select(CPObj.case_id, literal('age_range'), cast(Patient.age_range, db.Text))
+                 .join(Patient, Patient.id == CPObj.p_object_id).where(*live(Patient)), CPObj.case_id),
+        restrict(select(CPObj.case_id, literal('gender'), cast(Patient.gender, db.Text))
+                 .join(Patient, Patient.id == CPObj.p_object_id).where(*live(Patient)), CPObj.case_id),
+    )
+
+
+def case_feature_rows(case_ids=None):
+    return db.session.execute(case_feature_statement(case_ids))
+
+
+class CaseFacetIndex:
+    # facet -> value -> bitmap of case ids, kept as Python ints (bit n set for case n) so an
+    # AND across facets is a single big-int operation and counts are popcounts
+
+    def __init__(self, max_age):
+        self.max_age = max_age
+        self.lock = threading.Lock()
+        self.built_at = None
+        self.stale = set()
+        self.postings = {}
+        self.features = {}
+        self.all_cases = 0
+
+    def invalidate(self, case_ids):
+        with self.lock:
+            self.stale.update(case_ids)
+
+    def add(self, case_id, facet, value):
+        self.features.setdefault(case_id, set()).add((facet, value))
+        if facet == 'case':
+            self.all_cases |= 1 << case_id
+        elif value is not None:
+            postings = self.postings.setdefault(facet, {})
+            postings[value] = postings.get(value, 0) | 1 << case_id
+
+    def remove(self, case_id):
+        bit = 1 << case_id
+        for facet, value in self.features.pop(case_id, ()):
+            if facet == 'case':
+                self.all_cases &= ~bit
+            elif value is not None:
+                self.postings[facet][value] &= ~bit
+                if not self.postings[facet][value]:
+                    del self.postings[facet][value]
+
+    def plan(self):
+        # Caller holds the lock. The cases whose rows have to be re-read, None for all of them.
+        # Writes in this process only mark cases stale, the age limit picks up writes made by
+        # other workers
+        if self.built_at is None or time.monotonic() - self.built_at > self.max_age:
+            self.stale.clear()
+            return None
+        case_ids = list(self.stale)
+        self.stale.clear()
+        return case_ids
+
+    def apply(self, case_ids, rows):
+        # Caller holds the lock. rows: case_feature_statement(case_ids) results
+        if case_ids is None:
+            self.postings, self.features, self.all_cases = {}, {}, 0
+            self.built_at = time.monotonic()
+        else:
+            for case_id in case_ids:
+                self.remove(case_id)
+        for case_id, facet, value in rows:
+            self.add(case_id, facet, value)
+
+    def refresh(self):
+        # Caller holds the lock
+        case_ids = self.plan()
+        if case_ids is None or case_ids:
+            self.apply(case_ids, case_feature_rows(case_ids))
+
+    def search(self, criteria):
+        with self.lock:
+            self.refresh()
+            return self.query(criteria)
+
+    def query(self, criteria):
+        # Caller holds the lock
+        matches = self.all_cases
+        for facet, values in criteria.items():
+            postings = self.postings.get(facet, {})
+            union = 0
+            for value in values:
+                union |= postings.get(value, 0)
+            matches &= union
+        facets = {
+            facet: {value: count for value, bitmap in self.postings.get(facet, {}).items()
+                    if (count := (bitmap & matches).bit_count())}
+            for facet in CASE_FACETS
+        }
+        return matches, facets
+
+
+def bitmap_ids(bitmap, offset, limit):
+    ids = []
+    position = 0
+    while bitmap and len(ids) < limit:
+        lowest = bitmap & -bitmap
+        if position >= offset:
+            ids.append(lowest.bit_length() - 1)
+        position += 1
+        bitmap ^= lowest
+    return ids
+
+
+case_facet_index = CaseFacetIndex(FACET_INDEX_MAX_AGE)
+case_change_listeners.append(case_facet_index.invalidate)
+
+
+@api.route('/api/cases/search', methods=['GET'])
+def search_cases():
+    try:
+        criteria, limit, offset = parse_case_search(request.args)
+    except ValueError as e:
+        return jsonify({'message': str(e)}), 400
+
+    matches, facets = case_facet_index.search(criteria)
+    return jsonify(case_search_result(matches, facets, limit, offset))
+
+
+def parse_case_search(args):
+    # Shared with the async app. Comma-separated values are ORed within a facet, facets are ANDed
+    criteria = {facet: [value for value in args[facet].split(',') if value]
+                for facet in CASE_FACETS if facet in args}
+    limit, offset = args.get('limit', '100'), args.get('offset', '0')
+    if not limit.isdigit() or not 0 < int(limit) <= PAGE_LIMIT_MAX or not offset.isdigit():
+        raise ValueError(f'limit must be between 1 and {PAGE_LIMIT_MAX}')
+    return criteria, int(limit), int(offset)
+
+
+def case_search_result(matches, facets, limit, offset):
+    return {
+        'cases': bitmap_ids(matches, offset, limit),
+        'total': matches.bit_count(),
+        'facets': facets,
+    }
+
+
+# Similar cases
+
+SIMILAR_METRICS = ('jaccard', 'cosine')
+
+
+class SimilarCases:
+    # Binary case x feature matrix over the CASE_FACETS values, with a table of each case's top
+    # SIMILAR_K_MAX neighbours filled as cases are asked for. Changed cases have their rows re-read
+    # before the next query and the stored lists are patched for them, not recomputed. NumPy and
+    # SciPy are imported on first use
+
+    def __init__(self, max_age):
+        self.max_age = max_age
+        self.lock = threading.Lock()
+        self.built_at = None
+        self.stale = set()
+        self.cases = set()
+        self.features = {}
+        self.columns = {}
+        # (metric, case id) -> [(score, case id), ...] best first; case id -> keys of lists holding it
+        self.top = {}
+        self.listed_in = {}
+
+    def invalidate(self, case_ids):
+        with self.lock:
+            self.stale.update(case_ids)
+
+    def load(self, case_ids=None):
+        for case_id, facet, value in case_feature_rows(case_ids):
+            if facet == 'case':
+                self.cases.add(case_id)
+            elif value is not None:
+                self.features.setdefault(case_id, set()).add(self.columns.setdefault((facet, value), len(self.columns)))
+
+    def build_matrix(self):
+        import numpy
+        from scipy import sparse
+
+        # Link rows left behind by a deleted case have no case row and are left out
+        self.case_ids = numpy.array(sorted(self.cases), dtype=numpy.int64)
+        self.rows = {case_id: row for row, case_id in enumerate(self.case_ids.tolist())}
+        rows = [self.features.get(case_id, ()) for case_id in self.case_ids.tolist()]
+        indptr = numpy.zeros(len(rows) + 1, dtype=numpy.int64)
+        numpy.cumsum([len(row) for row in rows], out=indptr[1:])
+        indices = numpy.fromiter(itertools.chain.from_iterable(rows), dtype=numpy.int64, count=indptr[-1])
+        self.matrix = sparse.csr_matrix((numpy.ones(len(indices), dtype=numpy.float32), indices, indptr),
+                                        shape=(len(self.case_ids), max(len(self.columns), 1)))
+        # Column-major copy: the cases holding a feature are one contiguous slice
+        self.postings = self.matrix.tocsc()
+        self.sizes = numpy.diff(self.matrix.indptr).astype(numpy.float32)
+
+    def refresh(self):
+        # Caller holds the lock. The age limit picks up writes made by other workers: everything is
+        # re-read and only the cases that differ count as changed
+        if self.built_at is None or time.monotonic() - self.built_at > self.max_age:
+            cases, features = self.cases, self.features
+            self.cases, self.features = set(), {}
+            self.load()
+            changed = (cases ^ self.cases) | {case_id for case_id in self.cases & cases
+                                              if features.get(case_id) != self.features.get(case_id)}
+            self.built_at = time.monotonic()
+        elif self.stale:
+            changed = set(self.stale)
+            for case_id in changed:
+                self.cases.discard(case_id)
+                self.features.pop(case_id, None)
+            self.load(changed)
+        else:
+            return
+        self.stale.clear()
+        self.build_matrix()
+        # Patching costs a full scoring per changed case, past the number of stored lists it is
+        # cheaper to drop them and let them refill
+        if len(changed) > len(self.top):
+            self.top, self.listed_in = {}, {}
+        else:
+            for case_id in changed:
+                self.patch(case_id)
+
+    def scores(self, row, metric):
+        # Scores of every case against one, from the posting lists of its features only
+        import numpy
+
+        features = self.matrix.indices[self.matrix.indptr[row]:self.matrix.indptr[row + 1]]
+        hits = [self.postings.indices[self.postings.indptr[f]:self.postings.indptr[f + 1]] for f in features]
+        shared = numpy.bincount(numpy.concatenate(hits), minlength=len(self.case_ids)).astype(numpy.float32) \
+            if hits else numpy.zeros(len(self.case_ids), dtype=numpy.float32)
+        if metric == 'jaccard':
+            union = self.sizes + self.sizes[row] - shared
+        else:
+            union = numpy.sqrt(self.sizes * self.sizes[row])
+        scores = numpy.divide(shared, union, out=numpy.zeros_like(shared), where=union > 0)
+        scores[row] = 0
+        return scores
+
+    def best(self, scores, k):
+        import numpy
+
+        candidates = numpy.flatnonzero(scores)
+        if len(candidates) > k:
+            # Every case tied with the k-th score stays in, the sort below breaks ties by id
+            threshold = numpy.partition(scores[candidates], len(candidates) - k)[len(candidates) - k]
+            candidates = candidates[scores[candidates] >= threshold]
+        order = numpy.lexsort((self.case_ids[candidates], -scores[candidates]))[:k]
+        return [(float(scores[i]), int(self.case_ids[i])) for i in candidates[order]]
+
+    def store(self, key, neighbours):
+        self.top[key] = neighbours
+        for score, case_id in neighbours:
+            self.listed_in.setdefault(case_id, set()).add(key)
+
+    def forget(self, key):
+        for score, case_id in self.top.pop(key, ()):
+            self.listed_in.get(case_id, set()).discard(key)
+
+    def patch(self, case_id):
+        import numpy
+
+        # Lists holding the case may now hold it too high, drop them; lists it now beats get it
+        for key in list(self.listed_in.pop(case_id, ())):
+            self.forget(key)
+        for metric in SIMILAR_METRICS:
+            self.forget((metric, case_id))
+        row = self.rows.get(case_id)
+        if row is None:
+            return
+        for metric in SIMILAR_METRICS:
+            scores = self.scores(row, metric)
+            for other in self.case_ids[numpy.flatnonzero(scores)].tolist():
+                neighbours = self.top.get((metric, other))
+                if neighbours is None:
+                    continue
+                score = float(scores[self.rows[other]])
+                if len(neighbours) < SIMILAR_K_MAX or (score, -case_id) > (neighbours[-1][0], -neighbours[-1][1]):
+                    self.forget((metric, other))
+                    neighbours = sorted(neighbours + [(score, case_id)], key=lambda item: (-item[0], item[1]))
+                    self.store((metric, other), neighbours[:SIMILAR_K_MAX])
+
+    def similar(self, case_id, k, metric):
+        # None when the case does not exist
+        with self.lock:
+            self.refresh()
+            row = self.rows.get(case_id)
+            if row is None:
+                return None
+            neighbours = self.top.get((metric, case_id))
+            if neighbours is None:
+                neighbours = self.best(self.scores(row, metric), SIMILAR_K_MAX)
+                self.store((metric, case_id), neighbours)
+            return neighbours[:k]
+
+    def precompute(self, metric, batch_size=64):
+        # Every case's list, a batch of rows at a time as one sparse product. The k-th best score of
+        # each row comes from one partition over the batch and only cases at or above it are sorted
+        import numpy
+
+        with self.lock:
+            self.refresh()
+            k = min(SIMILAR_K_MAX, len(self.case_ids) - 1)
+            transposed = self.matrix.T.tocsr()
+            for start in range(0, len(self.case_ids), batch_size):
+                shared = (self.matrix[start:start + batch_size] @ transposed).toarray()
+                sizes = self.sizes[start:start + batch_size, None]
+                if metric == 'jaccard':
+                    union = self.sizes[None, :] + sizes - shared
+                else:
+                    union = numpy.sqrt(self.sizes[None, :] * sizes)
+                scores = numpy.divide(shared, union, out=numpy.zeros_like(shared), where=union > 0)
+                scores[numpy.arange(len(scores)), numpy.arange(start, start + len(scores))] = 0
+                thresholds = numpy.partition(scores, -k, axis=1)[:, -k] if k > 0 else numpy.ones(len(scores))
+                rows, columns = numpy.nonzero(scores >= numpy.maximum(thresholds, 1e-9)[:, None])
+                bounds = numpy.searchsorted(rows, numpy.arange(len(scores) + 1))
+                for offset in range(len(scores)):
+                    candidates = columns[bounds[offset]:bounds[offset + 1]]
+                    order = numpy.lexsort((self.case_ids[candidates], -scores[offset, candidates]))[:k]
+                    key = (metric, int(self.case_ids[start + offset]))
+                    self.forget(key)
+                    self.store(key, [(float(scores[offset, i]), int(self.case_ids[i])) for i in candidates[order]])
+            return len(self.case_ids)
+
+
+similar_cases_index = SimilarCases(SIMILAR_INDEX_MAX_AGE)
+case_change_listeners.append(similar_cases_index.invalidate)
+
+
+@api.route('/api/cases/<int:case_id>/similar', methods=['GET'])
+def get_similar_cases(case_id):
+    k, metric = request.args.get('k', '10'), request.args.get('metric', 'jaccard')
+    if not k.isdigit() or not 0 < int(k) <= SIMILAR_K_MAX:
+        return jsonify({'message': f'k must be between 1 and {SIMILAR_K_MAX}'}), 400
+    if metric not in SIMILAR_METRICS:
+        return jsonify({'message': f"metric must be one of {', '.join(SIMILAR_METRICS)}"}), 400
+    try:
+        neighbours = similar_cases_index.similar(case_id, int(k), metric)
+    except ImportError:
+        # numpy and scipy are in requirements.txt, an install without them still serves the rest
+        return jsonify({'message': 'Similar cases need numpy and scipy installed'}), 503
+    if neighbours is None:
+        return jsonify({'message': 'Case not found'}), 404
+    return jsonify({
+        'case_id': case_id,
+        'metric': metric,
+        'similar': [{'case_id': other, 'score': round(score, 6)} for score, other in neighbours],
+    })
+
+
+def parse_case_ids(args):
+    try:
+        case_ids = list(dict.fromkeys(int(case_id) for case_id in args.get('ids', '').split(',') if case_id))
+    except ValueError:
+        raise ValueError('ids must be a comma-separated list of integers')
+    if not case_ids:
+        raise ValueError('ids parameter is required')
+    if len(case_ids) > MULTI_GET_MAX:
+        raise ValueError(f'At most {MULTI_GET_MAX} ids per request')
+    return case_ids
+
+
+def multi_case_response(case_ids, documents):
+    return {
+        'cases': [documents[case_id] for case_id in case_ids if case_id in documents],
+        'missing': [case_id for case_id in case_ids if case_id not in documents],
+    }
+
+
+@api.route('/api/cases', methods=['GET'])
+def get_cases():
+    args, profile = split_profile(request.args)
+    try:
+        case_ids = parse_case_ids(args)
+        expand = parse_expand(args, *CASE_MODELS)
+    except ValueError as e:
+        return jsonify({'message': str(e)}), 400
+
+    with serialize_timer():
+        documents = load_case_documents(case_ids, parse_fields(args), expand)
+        if profile:
+            documents = case_documents_with_profiles(documents)
+        return jsonify(multi_case_response(case_ids, documents))
 
 
 #Trying display all items related to same case id
-@app.route('/api/cases/<int:case_id>', methods=['GET'])
+@api.route('/api/cases/<int:case_id>', methods=['GET'])
 def get_case(case_id):
-    # Fetch the case by id
-    case = Cases.query.get(case_id)
-
-    if not case:
-        return jsonify({'message': 'Case not found'}), 404
-
-    # Fetch related entities for Cases
-    patients = [p.serialize() for p in case.patient_objects]
-    diseases = [d.serialize() for d in case.disease_objects]
-    questions = [q.serialize() for q in case.question_objects]
-    treatments = [t.serialize() for t in case.treatment_objects]
-
-    # Fetch related entities for each PatientQuestion related to the case
-    patient_questions_data = []
-    patient_questions = PatientQuestion.query.filter_by(case_id=case.id).all()
-    for pq in patient_questions:
-        patient_questions_data.append({
-            'patient_question': pq.serialize(),
-            'patient_objects': [po.serialize() for po in pq.patient_objects],
-            'disease_objects': [do.serialize() for do in pq.disease_objects],
-            'question_objects': [qo.serialize() for qo in pq.question_objects],
-            'treatment_objects': [to.serialize() for to in pq.treatment_objects],
-        })
-
-    # Fetch related entities for each ProcessedQuestion related to the case
-    processed_questions_data = []
-    processed_questions = ProcessedQuestion.query.filter_by(case_id=case.id).all()
-    for pq in processed_questions:
-        processed_questions_data.append({
-            'processed_question': pq.serialize(),
-            'patient_objects': [po.serialize() for po in pq.patient_objects],
-            'disease_objects': [do.serialize() for do in pq.disease_objects],
-            'question_objects': [qo.serialize() for qo in pq.question_objects],
-            'treatment_objects': [to.serialize() for to in pq.treatment_objects],
-        })
-
-    # Fetch related entities for each Enhanced related to the case
-    enhanced_data = []
-    enhanced_objects = Enhanced.query.filter_by(case_id=case.id).all()
-    for e in enhanced_objects:
-        enhanced_data.append({
-            'enhanced': e.serialize(),
-            'treatments': [t.serialize() for t in e.treatments],
-            'patients': [p.serialize() for p in e.patients],
-            'diseases': [d.serialize() for d in e.diseases],
-            'question_types': [qt.serialize() for qt in e.question_types],
-        })
-
-    # Fetch related entities for each Article related to the case
-    articles_data = []
-    articles = Articles.query.filter_by(case_id=case.id).all()
-    for a in articles:
-        articles_data.append({
-            'article': a.serialize(),
-            'patients_objects': [po.serialize() for po in a.patients_objects],
-            'diseases_objects': [do.serialize() for do in a.diseases_objects],
-            'question_objects': [qo.serialize() for qo in a.question_objects],
-            'treatment_objects': [to.serialize() for to in a.treatment_objects],
-        })
-
-    # Return the result as JSON
-    return jsonify({
-        'case': case.serialize(),
-        'patients': patients,
-        'diseases': diseases,
-        'questions': questions,
-        'treatments': treatments,
-        'patient_questions': patient_questions_data,
-        'processed_questions': processed_questions_data,
-        'enhanced_objects': enhanced_data,
-        'articles': articles_data,
-    })
\ No newline at end of file
+    args, profile = split_profile(request.args)
+    try:
+        expand = parse_expand(args, *CASE_MODELS)
+    except ValueError as e:
+        return jsonify({'message': str(e)}), 400
+
+    with serialize_timer():
+        documents = load_case_documents([case_id], parse_fields(args), expand)
+        if case_id not in documents:
+            return jsonify({'message': 'Case not found'}), 404
+        if profile:
+            documents = case_documents_with_profiles(documents)
+
+        return jsonify(documents[case_id])
+
+
+# Full-text search
+
+# (kind, table, text columns) searched by /api/search
+SEARCH_SOURCES = (
+    ('case', 'cases', ('patient_summary',)),
+    ('patient_question', 'patient_question', ('question',)),
+    ('processed_question', 'processed_question', ('question', 'question_note')),
+    ('article', 'articles', ('highlighted_text', 'reference')),
+)
+
+
+def search_body(columns, prefix=''):
+    return " || ' ' || ".join(f"coalesce({prefix}{column}, '')" for column in columns)
+
+
+def search_ddl(dialect):
+    # Postgres keeps a generated tsvector column per table, SQLite a single FTS5 shadow table
+    # maintained by triggers. Either way the index follows every insert and update by itself
+    if dialect == 'postgresql':
+        statements = []
+        for kind, table, columns in SEARCH_SOURCES:
+            statements += [
+                f"ALTER TABLE {table} ADD COLUMN IF NOT EXISTS search_vector tsvector "
+                f"GENERATED ALWAYS AS (to_tsvector('english', {search_body(columns)})) STORED",
+                f"CREATE INDEX IF NOT EXISTS ix_{table}_search_vector ON {table} USING gin (search_vector)",
+            ]
+        return statements
+
+    statements = [
+        "DROP TABLE IF EXISTS search_index",
+        "CREATE VIRTUAL TABLE search_index USING fts5(kind UNINDEXED, ref_id UNINDEXED, body, tokenize='porter')",
+    ]
+    for kind, table, columns in SEARCH_SOURCES:
+        # Only live rows are indexed: soft-deleting a row takes it out, restoring it puts it back
+        insert = (f"INSERT INTO search_index (kind, ref_id, body) SELECT '{kind}', new.id, "
+                  f"{search_body(columns, 'new.')} WHERE new.deleted_at IS NULL")
+        delete = f"DELETE FROM search_index WHERE kind = '{kind}' AND ref_id = old.id"
+        statements += [
+            f"DROP TRIGGER IF EXISTS {table}_search_insert",
+            f"DROP TRIGGER IF EXISTS {table}_search_update",
+            f"DROP TRIGGER IF EXISTS {table}_search_delete",
+            f"CREATE TRIGGER {table}_search_insert AFTER INSERT ON {table} BEGIN {insert}; END",
+            f"CREATE TRIGGER {table}_search_update AFTER UPDATE ON {table} BEGIN {delete}; {insert}; END",
+            f"CREATE TRIGGER {table}_search_delete AFTER DELETE ON {table} BEGIN {delete}; END",
+            f"INSERT INTO search_index (kind, ref_id, body) SELECT '{kind}', id, {search_body(columns)} FROM {table} "
+            f"WHERE deleted_at IS NULL",
+        ]
+    return statements
+
+
+def search_query(dialect):
+    if dialect == 'postgresql':
+        hits = ' UNION ALL '.join(
+            f"SELECT '{kind}' AS kind, id, ts_rank(search_vector, query) AS score, {search_body(columns)} AS body "
+            f"FROM {table}, query WHERE search_vector @@ query AND {table}.deleted_at IS NULL"
+            for kind, table, columns in SEARCH_SOURCES)
+        # Headlines are the expensive part, only build them for the page being returned
+        return text(
+            "WITH query AS (SELECT websearch_to_tsquery('english', :q) AS query), "
+            f"hits AS ({hits} ORDER BY score DESC, kind, id LIMIT :limit OFFSET :offset) "
+            "SELECT kind, id, score, ts_headline('english', body, query, "
+            "'StartSel=<mark>, StopSel=</mark>, MaxFragments=2') AS snippet "
+            "FROM hits, query ORDER BY score DESC, kind, id")
+
+    return text(
+        "SELECT kind, ref_id AS id, -bm25(search_index) AS score, "
+        "snippet(search_index, 2, '<mark>', '</mark>', '...', 16) AS snippet "
+        "FROM search_index WHERE search_index MATCH :q ORDER BY score DESC, kind, id LIMIT :limit OFFSET :offset")
+
+
+def fts5_phrase(q):
+    # Quote every word so user input is never parsed as FTS5 query syntax
+    return ' '.join('"{}"'.format(word.replace('"', '""')) for word in q.split())
+
+
+@api.route('/api/search', methods=['GET'])
+def search():
+    dialect = db.session.get_bind().dialect.name
+    try:
+        params = search_params(request.args, dialect)
+    except ValueError as e:
+        return jsonify({'message': str(e)}), 400
+
+    try:
+        rows = db.session.execute(search_query(dialect), params).all()
+    except (OperationalError, ProgrammingError):
+        db.session.rollback()
+        return jsonify({'message': SEARCH_INDEX_MISSING}), 503
+
+    return jsonify(search_result(rows, params))
+
+
+SEARCH_INDEX_MISSING = 'Search index missing, run flask init-search'
+
+
+def search_params(args, dialect):
+    # Shared with the async app: the bind parameters of search_query(dialect)
+    q = args.get('q', '').strip()
+    limit, offset = args.get('limit', '20'), args.get('offset', '0')
+    if not q:
+        raise ValueError('q parameter is required')
+    if not limit.isdigit() or not 0 < int(limit) <= PAGE_LIMIT_MAX or not offset.isdigit():
+        raise ValueError(f'limit must be between 1 and {PAGE_LIMIT_MAX}')
+    return {'q': q if dialect == 'postgresql' else fts5_phrase(q), 'limit': int(limit), 'offset': int(offset)}
+
+
+def search_result(rows, params):
+    return {
+        'results': [{'kind': kind, 'id': ref_id, 'score': round(score, 6), 'snippet': snippet}
+                    for kind, ref_id, score, snippet in rows],
+        'limit': params['limit'],
+        'offset': params['offset'],
+    }
+
+
+@api.cli.command('init-search')
+def init_search():
+    connection = db.session.connection()
+    for statement in search_ddl(connection.dialect.name):
+        connection.exec_driver_sql(statement)
+    db.session.commit()
+    click.echo('Search index ready')
+
+
+# Bulk ingest
+
+# POST /api/bulk/cases and flask ingest-cases take NDJSON, one case per line with its children
+# under the same keys as in the case document. Link lists take what the upserts take: ids, or
+# objects with an id, vocabulary objects being inserted when missing
+
+VOCABULARY_MODELS = (Disease, Treatment, QuestionType)
+
+
+class BulkIngestError(ValueError):
+    pass
+
+
+def secondary_link(model, name):
+    # (association table, column pointing at model, column pointing at the linked entity)
+    rel = getattr(model, name).property
+    local = next(fk.parent for fk in rel.secondary.foreign_keys if fk.column.table is model.__table__)
+    remote = next(fk.parent for fk in rel.secondary.foreign_keys if fk.column.table is rel.mapper.local_table)
+    return rel.secondary, local, remote
+
+
+# Record checks shared with the upserts, a BulkIngestError is a 400 for the client
+
+def is_id(value):
+    return isinstance(value, (int, str)) and not isinstance(value, bool)
+
+
+def record_id(model, record):
+    if not isinstance(record, dict):
+        raise BulkIngestError(f'{model.__tablename__} records must be objects')
+    if record.get('id') is None:
+        raise BulkIngestError(f'{model.__tablename__} record without an id')
+    if not is_id(record['id']):
+        raise BulkIngestError(f'{model.__tablename__} id must be a number or a string')
+    return record['id']
+
+
+def column_values(model, record):
+    # The writable columns the record gives, each a plain JSON value
+    values = {}
+    for column in writable_columns(model.__table__):
+        if column.key in record:
+            if isinstance(record[column.key], (dict, list)):
+                raise BulkIngestError(f'{model.__tablename__}.{column.key} must be a plain value')
+            values[column.key] = record[column.key]
+    return values
+
+
+def link_items(model, name, items):
+    # A link list as the GET output writes it: ids, or objects with an id. Yields (linked id, the
+    # vocabulary columns the object gives or None). An object with nothing but its id, or linking
+    # anything but vocabulary, is a reference like a bare id
+    if items is None:
+        return
+    if not isinstance(items, list):
+        raise BulkIngestError(f'{model.__tablename__}.{name} must be a list of ids or objects')
+    target = getattr(model, name).property.mapper.class_
+    for item in items:
+        if isinstance(item, dict):
+            linked_id = record_id(target, item)
+            given = column_values(target, item) if target in VOCABULARY_MODELS else {}
+            yield linked_id, given if given.keys() - {'id'} else None
+        elif is_id(item):
+            yield item, None
+        else:
+            raise BulkIngestError(f'{model.__tablename__}.{name} must be a list of ids or objects')
+
+
+def collect_rows(model, record, rows, vocabulary, **defaults):
+    # The record's row and edges into rows, the vocabulary given as objects into vocabulary
+    record_id(model, record)
+    values = {**defaults, **column_values(model, record)}
+    # The timestamps are left to their defaults, an explicit None would override them
+    rows.setdefault(model.__table__, []).append({column.key: values.get(column.key)
+                                                 for column in writable_columns(model.__table__)})
+
+    for name in model.serialize_relationships:
+        table, local, remote = secondary_link(model, name)
+        target = getattr(model, name).property.mapper.class_
+        for linked_id, given in link_items(model, name, record.get(name)):
+            if given is not None:
+                vocabulary.setdefault(target.__table__, {}).setdefault(linked_id, {}).update(given)
+            rows.setdefault(table, []).append({local.key: record['id'], remote.key: linked_id})
+
+
+def parse_case_lines(lines):
+    rows = {}
+    vocabulary = {}
+    case_ids = []
+    for number, line in enumerate(lines, 1):
+        if not line.strip():
+            continue
+        try:
+            record = json.loads(line)
+        except ValueError:
+            raise BulkIngestError(f'line {number} is not valid JSON')
+        try:
+            collect_rows(Cases, record, rows, vocabulary)
+            # Children sit under the same keys as in the case document
+            for key, _, model in CASE_DOCUMENT_CHILDREN:
+                children = record.get(key) or []
+                if not isinstance(children, list):
+                    raise BulkIngestError(f'{key} must be a list of objects')
+                for child in children:
+                    collect_rows(model, child, rows, vocabulary, case_id=record['id'])
+        except BulkIngestError as e:
+            raise BulkIngestError(f'line {number}: {e}')
+        case_ids.append(record['id'])
+    return rows, vocabulary, case_ids
+
+
+def check_vocabulary(rows):
+    # Every disease/treatment/question type id referenced anywhere, resolved in one round trip
+    wanted = {model.__table__: set() for model in VOCABULARY_MODELS}
+    for table, table_rows in rows.items():
+        for fk in table.foreign_keys:
+            if fk.column.table in wanted:
+                wanted[fk.column.table].update(row[fk.parent.key] for row in table_rows)
+
+    selects = [select(literal(vocabulary.name).label('kind'), vocabulary.c.id).where(vocabulary.c.id.in_(ids))
+               for vocabulary, ids in wanted.items() if ids]
+    if not selects:
+        return
+    found = {(kind, vocabulary_id) for kind, vocabulary_id in db.session.execute(union_all(*selects))}
+    missing = sorted(f'{vocabulary.name}:{vocabulary_id}' for vocabulary, ids in wanted.items()
+                     for vocabulary_id in ids if (vocabulary.name, vocabulary_id) not in found)
+    if missing:
+        raise BulkIngestError(f'unknown ids {", ".join(missing)}')
+
+
+def insert_rows(table, rows):
+    connection = db.session.connection()
+    if connection.dialect.name != 'postgresql':
+        connection.execute(table.insert(), rows)
+        return
+
+    columns = list(rows[0])
+    statement = f'INSERT INTO {table.name} ({", ".join(columns)}) VALUES %s'
+    with connection.connection.cursor() as cursor:
+        psycopg2.extras.execute_values(cursor, statement, [tuple(row[c] for c in columns) for row in rows],
+                                       page_size=1000)
+
+
+def reset_sequences(tables):
+    # Rows came in with explicit ids, move the serial sequences past them
+    connection = db.session.connection()
+    if connection.dialect.name != 'postgresql':
+        return
+    for table in tables:
+        if 'id' in table.c and table.c.id.autoincrement in (True, 'auto'):
+            connection.exec_driver_sql(
+                f"SELECT setval(pg_get_serial_sequence('{table.name}', 'id'), max(id)) FROM {table.name}")
+
+
+def record_bulk_write(rows, changes=None):
+    # Core inserts skip the ORM flush events, feed the same bookkeeping by hand so the
+    # response cache and the materialized case documents see the write at commit. changes
+    # defaults to every row being an insert
+    keys = set()
+    for table, table_rows in rows.items():
+        for row in table_rows:
+            if len(table.primary_key.columns) == 1:
+                keys.add((table.name, row[table.primary_key.columns[0].key]))
+            for fk in table.foreign_keys:
+                if fk.column.table.name in CASE_LINKED_TABLES:
+                    keys.add((fk.column.table.name, row[fk.parent.key]))
+    db.session.info.setdefault('touched_tables', set()).update(table.name for table in rows)
+    db.session.info.setdefault('changed_rows', set()).update(keys)
+    if changes is None:
+        changes = [(table.name, row_key(table, row), 'insert') for table, table_rows in rows.items() for row in table_rows]
+    merge_changes(db.session, changes)
+
+
+def ingest_cases(lines):
+    started = time.perf_counter()
+    rows, vocabulary, case_ids = parse_case_lines(lines)
+    try:
+        # Vocabulary given as objects goes in first, as POST /api/cases writes it: rows already
+        # there are left alone
+        tracked, changes = {}, []
+        for table, table_rows in vocabulary.items():
+            write_rows(table, table_rows, False, tracked, changes)
+        check_vocabulary(rows)
+        for table in db.metadata.sorted_tables:
+            if rows.get(table):
+                insert_rows(table, rows[table])
+        reset_sequences(rows)
+        record_bulk_write(tracked, changes)
+        record_bulk_write(rows)
+        db.session.commit()
+    except Exception:
+        db.session.rollback()
+        raise
+
+    elapsed = time.perf_counter() - started
+    total = sum(len(table_rows) for table_rows in rows.values())
+    return {
+        'cases': len(case_ids),
+        'rows': total,
+        'seconds': round(elapsed, 3),
+        'rows_per_second': round(total / elapsed) if elapsed else total,
+    }
+
+
+@api.route('/api/bulk/cases', methods=['POST'])
+def bulk_cases():
+    try:
+        return jsonify(ingest_cases(request.get_data(as_text=True).splitlines()))
+    except BulkIngestError as e:
+        return jsonify({'message': str(e)}), 400
+    except (DataError, IntegrityError) as e:
+        return jsonify({'message': str(e.orig)}), 400
+
+
+@api.cli.command('ingest-cases')
+@click.argument('source', type=click.File('r'))
+def ingest_cases_command(source):
+    try:
+        stats = ingest_cases(source)
+    except (BulkIngestError, DataError, IntegrityError) as e:
+        raise click.ClickException(str(e))
+    click.echo(f"Ingested {stats['cases']} cases, {stats['rows']} rows in {stats['seconds']}s "
+               f"({stats['rows_per_second']} rows/s)")
+
+
+# Upserts
+
+# Routes taking POST (insert, rows already there are left alone) and PUT (insert or replace) of
+# a JSON array of records, shaped like the GET output: the columns plus each link list, as ids
+# or as objects. Linked diseases, treatments and question types given as objects are upserted too,
+# with the columns the object holds; one holding only its id is a reference like a bare id
+WRITE_MODELS = {
+    'cases': Cases,
+    'patient_question': PatientQuestion,
+    'processed_question': ProcessedQuestion,
+    'articles': Articles,
+    'enhanced': Enhanced,
+}
+# Set by the database, never taken from a record
+WRITE_SKIPPED_COLUMNS = ('created_at', 'updated_at', 'deleted_at')
+
+
+def writable_columns(table):
+    return [column for column in table.columns if column.key not in WRITE_SKIPPED_COLUMNS]
+
+
+def upsert_statement(table, replace):
+    # One INSERT ... ON CONFLICT for any number of rows; DO UPDATE replaces every writable column
+    dialect = db.session.connection().dialect.name
+    if dialect == 'postgresql':
+        statement = postgresql_insert(table)
+    elif dialect == 'sqlite':
+        statement = sqlite_insert(table)
+    else:
+        raise BulkIngestError(f'Upserts are not supported on {dialect}')
+    pk = [column.key for column in table.primary_key.columns]
+    updated = {column.key: statement.excluded[column.key] for column in writable_columns(table)
+               if not column.primary_key}
+    if not replace or not updated:
+        return statement.on_conflict_do_nothing(index_elements=pk)
+    if 'updated_at' in table.c:
+        updated['updated_at'] = func.now()
+    return statement.on_conflict_do_update(index_elements=pk, set_=updated)
+
+
+def parse_write_records(model, records):
+    # Rows by table and primary key: the records and the vocabulary given as objects, deduplicated
+    # with the last one winning. A vocabulary row has only the columns its object gave. Per
+    # association table: its two columns, the ids whose list was given and the edges by (id, linked id)
+    if not isinstance(records, list):
+        raise BulkIngestError('Expected a JSON array of records')
+    if len(records) > WRITE_BATCH_MAX:
+        raise BulkIngestError(f'At most {WRITE_BATCH_MAX} records per request')
+
+    table = model.__table__
+    rows = {table: {}}
+    links = {}
+    for record in records:
+        parent_id = record_id(model, record)
+        given = column_values(model, record)
+        rows[table][parent_id] = {column.key: given.get(column.key) for column in writable_columns(table)}
+        for name in model.serialize_relationships:
+            if name not in record:
+                continue
+            link, local, remote = secondary_link(model, name)
+            target = getattr(model, name).property.mapper.class_
+            local, remote, parent_ids, edges = links.setdefault(link, (local, remote, set(), {}))
+            parent_ids.add(parent_id)
+            for linked_id, given in link_items(model, name, record[name]):
+                if given is not None:
+                    rows.setdefault(target.__table__, {}).setdefault(linked_id, {}).update(given)
+                edges[(parent_id, linked_id)] = {local.key: parent_id, remote.key: linked_id}
+    return rows, links
+
+
+def write_rows(table, rows, replace, tracked, changes):
+    # Upserts the rows, skipping those already stored as given. Columns a row leaves out keep
+    # their stored value, or are NULL on insert. Returns (inserted, updated)
+    current = current_rows(table, [row_key(table, row) for row in rows.values()])
+    written = []
+    inserted = updated = 0
+    for key, given in rows.items():
+        before = current.get((key,))
+        row = {column.key: given.get(column.key, None if before is None else before[column.key])
+               for column in writable_columns(table)}
+        if before is not None and (not replace or all(
+                row[column.key] == before[column.key] for column in writable_columns(table))):
+            continue
+        written.append(row)
+        changes.append((table.name, row_key(table, row), 'insert' if before is None else 'update'))
+        # An update can move a child to another case, both documents change
+        tracked.setdefault(table, []).extend([row] if before is None else [row, before])
+        if before is None:
+            inserted += 1
+        else:
+            updated += 1
+    if written:
+        db.session.execute(upsert_statement(table, replace), written)
+    return inserted, updated
+
+
+def write_links(link, local, remote, parent_ids, edges, replace, tracked, changes):
+    # Adds the missing edges; on replace also drops the stored ones the records no longer list.
+    # Returns (added, removed)
+    stored = set(db.session.execute(select(local, remote).where(local.in_(parent_ids))).all())
+    added = [row for pair, row in edges.items() if pair not in stored]
+    removed = [{local.key: parent_id, remote.key: linked_id} for parent_id, linked_id in stored
+               if (parent_id, linked_id) not in edges] if replace else []
+    if removed:
+        # The leading column lets the delete use its index, the pairs narrow it
+        db.session.execute(link.delete().where(
+            local.in_({row[local.key] for row in removed}),
+            tuple_(local, remote).in_([(row[local.key], row[remote.key]) for row in removed])))
+    if added:
+        db.session.execute(upsert_statement(link, False), added)
+    for rows, operation in ((added, 'insert'), (removed, 'delete')):
+        changes.extend((link.name, row_key(link, row), operation) for row in rows)
+        tracked.setdefault(link, []).extend(rows)
+    return len(added), len(removed)
+
+
+def write_records(model, records, replace):
+    rows, links = parse_write_records(model, records)
+    tracked = {}
+    changes = []
+    counts = dict.fromkeys(('inserted', 'updated', 'unchanged', 'vocabulary_inserted', 'vocabulary_updated',
+                            'links_added', 'links_removed'), 0)
+    try:
+        # Every table costs a read of what is stored and one batched write, whatever the number of
+        # records or links. Vocabulary goes first so edges to it can be checked, the records follow
+        for table in db.metadata.sorted_tables:
+            if table in rows:
+                inserted, updated = write_rows(table, rows[table], replace, tracked, changes)
+                if table is model.__table__:
+                    counts.update(inserted=inserted, updated=updated,
+                                  unchanged=len(rows[table]) - inserted - updated)
+                else:
+                    counts['vocabulary_inserted'] += inserted
+                    counts['vocabulary_updated'] += updated
+        check_vocabulary({link: list(edges.values()) for link, (*_, edges) in links.items()})
+        for link, link_values in links.items():
+            added, removed = write_links(link, *link_values, replace, tracked, changes)
+            counts['links_added'] += added
+            counts['links_removed'] += removed
+        reset_sequences([model.__table__])
+        record_bulk_write(tracked, changes)
+        db.session.commit()
+    except Exception:
+        db.session.rollback()
+        raise
+    return counts
+
+
+def write_view(model):
+    def view():
+        try:
+            return jsonify(write_records(model, request.get_json(silent=True), request.method == 'PUT'))
+        except BulkIngestError as e:
+            return jsonify({'message': str(e)}), 400
+        except (DataError, IntegrityError) as e:
+            return jsonify({'message': str(e.orig)}), 400
+    return view
+
+
+for name, model in WRITE_MODELS.items():
+    api.add_url_rule(f'/api/{name}', f'write_{name}', write_view(model), methods=['POST', 'PUT'])
+
+
+# Export
+
+EXPORT_MIMETYPES = {'gzip': 'application/gzip', 'zstd': 'application/zstd', 'none': 'application/x-ndjson'}
+EXPORT_SUFFIXES = {'gzip': '.gz', 'zstd': '.zst', 'none': ''}
+
+
+def export_tables(names=None):
+    # Parents before children, so the output loads back in order
+    if names is None:
+        return list(db.metadata.sorted_tables)
+    unknown = [name for name in names if name not in db.metadata.tables]
+    if unknown:
+        raise ValueError(f"Unknown table {unknown[0]}")
+    return [table for table in db.metadata.sorted_tables if table.name in names]
+
+
+@contextmanager
+def consistent_reads(engine):
+    # A connection whose reads all see one snapshot of the database, for reading every table
+    with engine.connect() as connection:
+        if connection.dialect.name == 'postgresql':
+            connection.execution_options(isolation_level='REPEATABLE READ', postgresql_readonly=True)
+        elif connection.dialect.name == 'sqlite':
+            # pysqlite does not open a transaction for SELECTs by itself
+            connection.exec_driver_sql('BEGIN')
+        yield connection
+        connection.rollback()
+
+
+def table_chunks(connection, table):
+    # The rows of table as (keys, rows) chunks, through a server-side cursor so memory stays flat.
+    # A decoded case document is tens of KB, fetch those a few at a time
+    chunk_size = EXPORT_DOCUMENT_CHUNK_SIZE if table is CaseDocument.__table__ else EXPORT_CHUNK_SIZE
+    statement = select(table).order_by(*table.primary_key.columns)
+    result = connection.execute(statement.execution_options(yield_per=chunk_size))
+    keys = list(result.keys())
+    for rows in result.partitions():
+        yield keys, rows
+
+
+def export_lines(engine, tables):
+    # One {"table": ..., "row": ...} line per row, every table read from the same snapshot
+    with consistent_reads(engine) as connection:
+        for table in tables:
+            for keys, rows in table_chunks(connection, table):
+                yield b''.join(dumps_json({'table': table.name, 'row': dict(zip(keys, row))}) + b'\n'
+                               for row in rows)
+
+
+def compressor(compression):
+    if compression == 'gzip':
+        return zlib.compressobj(6, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    if compression == 'zstd':
+        if zstandard is None:
+            raise ValueError('zstd compression needs the zstandard package')
+        return zstandard.ZstdCompressor().compressobj()
+    if compression == 'none':
+        return None
+    raise ValueError(f"Unknown compression {compression}")
+
+
+def compress_lines(lines, compress):
+    if compress is None:
+        yield from lines
+        return
+    for chunk in lines:
+        data = compress.compress(chunk)
+        if data:
+            yield data
+    yield compress.flush()
+
+
+@api.route('/api/export', methods=['GET'])
+def export():
+    # ?tables=disease,cd_objects&format=ndjson&compression=gzip|zstd|none
+    tables = request.args.get('tables')
+    compression = request.args.get('compression', 'gzip')
+    if request.args.get('format', 'ndjson') != 'ndjson':
+        return jsonify({'message': 'Only format=ndjson is supported'}), 400
+    try:
+        tables = export_tables(None if tables is None else [name for name in tables.split(',') if name])
+        compress = compressor(compression)
+    except ValueError as e:
+        return jsonify({'message': str(e)}), 400
+
+    replica = replica_router.choose() if replica_router.serves_request() else None
+    engine = db.engine if replica is None else db.engines[replica]
+    response = Response(stream_with_context(compress_lines(export_lines(engine, tables), compress)),
+                        mimetype=EXPORT_MIMETYPES[compression])
+    response.headers['Content-Disposition'] = f'attachment; filename=export.ndjson{EXPORT_SUFFIXES[compression]}'
+    return response
+
+
+@api.cli.command('export')
+@click.option('--tables', help='Comma separated table names, all tables by default.')
+@click.option('--compression', type=click.Choice(['gzip', 'zstd', 'none']), default='gzip', show_default=True)
+@click.option('--output', type=click.File('wb'), default='-', help='Defaults to stdout.')
+def export_command(tables, compression, output):
+    try:
+        tables = export_tables(None if tables is None else [name for name in tables.split(',') if name])
+        compress = compressor(compression)
+    except ValueError as e:
+        raise click.ClickException(str(e))
+    for chunk in compress_lines(export_lines(db.engine, tables), compress):
+        output.write(chunk)
+    click.echo(f'Exported {len(tables)} tables', err=True)
+
+
+# Stats
+
+# (name, tables read, statement) for the /api/stats/<name> rollups. They go through the response
+# cache, so a rollup is computed once and again only after a write to one of its tables, or
+# when RESPONSE_CACHE_TTL runs out
+STATS = (
+    ('patients', ('patient',), lambda: (
+        select(Patient.age_range, Patient.gender, func.count().label('patients'))
+        .where(*live(Patient))
+        .group_by(Patient.age_range, Patient.gender)
+        .order_by(Patient.age_range, Patient.gender))),
+    ('cases-per-disease', ('cd_objects', 'disease', 'cases'), lambda: (
+        select(Disease.id.label('disease_id'), Disease.full_name, func.count().label('cases'))
+        .join(CDObj, CDObj.disease_object_id == Disease.id)
+        .join(Cases, Cases.id == CDObj.case_id).where(*live(Cases))
+        .group_by(Disease.id, Disease.full_name)
+        .order_by(func.count().desc(), Disease.id))),
+    ('cases-per-treatment', ('ct_objects', 'treatment', 'cases'), lambda: (
+        select(Treatment.id.label('treatment_id'), Treatment.name, func.count().label('cases'))
+        .join(CTObj, CTObj.treatment_object_id == Treatment.id)
+        .join(Cases, Cases.id == CTObj.case_id).where(*live(Cases))
+        .group_by(Treatment.id, Treatment.name)
+        .order_by(func.count().desc(), Treatment.id))),
+    ('cases-per-question-type', ('cq_objects', 'question_type', 'cases'), lambda: (
+        select(QuestionType.id.label('question_type_id'), QuestionType.type, func.count().label('cases'))
+        .join(CQObj, CQObj.question_object_id == QuestionType.id)
+        .join(Cases, Cases.id == CQObj.case_id).where(*live(Cases))
+        .group_by(QuestionType.id, QuestionType.type)
+        .order_by(func.count().desc(), QuestionType.id))),
+    ('disease-treatment', ('cd_objects', 'ct_objects', 'cases'), lambda: (
+        select(CDObj.disease_object_id.label('disease_id'), CTObj.treatment_object_id.label('treatment_id'),
+               func.count().label('cases'))
+        .join(CTObj, CTObj.case_id == CDObj.case_id)
+        .join(Cases, Cases.id == CDObj.case_id).where(*live(Cases))
+        .group_by(CDObj.disease_object_id, CTObj.treatment_object_id)
+        .order_by(func.count().desc(), CDObj.disease_object_id, CTObj.treatment_object_id))),
+    ('articles-per-processed-question', ('articles',), lambda: (
+        select(Articles.processed_question_id, func.count().label('articles'))
+        .where(Articles.processed_question_id.isnot(None), *live(Articles))
+        .group_by(Articles.processed_question_id)
+        .order_by(func.count().desc(), Articles.processed_question_id))),
+)
+
+
+def stats_view(statement):
+    def view():
+        result = db.session.execute(statement())
+        keys = list(result.keys())
+        rows = result.all()
+        with serialize_timer():
+            return Response(dumps_json([dict(zip(keys, row)) for row in rows]), mimetype='application/json')
+    return view
+
+
+for name, tables, statement in STATS:
+    api.add_url_rule(f'/api/stats/{name}', f'stats_{name}', cached_response(*tables)(stats_view(statement)),
+                     methods=['GET'])
+
+
+@api.route('/api/stats', methods=['GET'])
+def list_stats():
+    return jsonify([{'name': name, 'url': f'/api/stats/{name}'} for name, tables, statement in STATS])
+
+
+# Usage
+
+# name -> (model, paths): where a vocabulary row is referenced, as (kind, association column holding
+# the vocabulary id, association column holding the referencing id, referencing model)
+USAGE = {
+    'treatment': (Treatment, (
+        ('cases', CTObj.treatment_object_id, CTObj.case_id, Cases),
+        ('patient_question', CPQTreatmentObj.treatment_object_id, CPQTreatmentObj.question_id, PatientQuestion),
+        ('processed_question', RQTreatmentObj.treatment_object_id, RQTreatmentObj.research_question_id,
+         ProcessedQuestion),
+        ('articles', ArticleTreatmentObj.treatment_object_id, ArticleTreatmentObj.article_id, Articles),
+        ('enhanced', EnhancedTreatments.treatment_id, EnhancedTreatments.enhanced_id, Enhanced),
+    )),
+    'disease': (Disease, (
+        ('cases', CDObj.disease_object_id, CDObj.case_id, Cases),
+        ('patient_question', CPQDiseaseObj.disease_object_id, CPQDiseaseObj.question_id, PatientQuestion),
+        ('processed_question', RQDiseaseObj.disease_object_id, RQDiseaseObj.research_question_id,
+         ProcessedQuestion),
+        ('articles', ArticleDiseaseObj.disease_object_id, ArticleDiseaseObj.article_id, Articles),
+        ('enhanced', EnhancedDiseases.disease_id, EnhancedDiseases.enhanced_id, Enhanced),
+    )),
+    'question_type': (QuestionType, (
+        ('cases', CQObj.question_object_id, CQObj.case_id, Cases),
+        ('patient_question', CPQQuestionObj.question_object_id, CPQQuestionObj.question_id, PatientQuestion),
+        ('processed_question', RQQuestionObj.question_object_id, RQQuestionObj.research_question_id,
+         ProcessedQuestion),
+        ('articles', ArticleQuestionObj.question_object_id, ArticleQuestionObj.article_id, Articles),
+        ('enhanced', EnhancedQuestionTypes.question_type_id, EnhancedQuestionTypes.enhanced_id, Enhanced),
+    )),
+}
+USAGE_EXPAND = ('cases', 'articles')
+
+# Expanded articles carry their direct links only, one SELECT ... IN each
+ARTICLE_USAGE_EXPAND = {name: {} for name in Articles.serialize_relationships}
+
+
+def usage_statement(model, paths, entity_id):
+    # One round trip: a row per live referencing record, plus a marker row when the vocabulary
+    # row itself exists so an unknown id is told apart from an unused one
+    return union_all(
+        select(literal('').label('kind'), literal(0).label('id')).where(model.id == entity_id),
+        *(select(literal(kind), referencing).join(owner, owner.id == referencing)
+          .where(column == entity_id, *live(owner))
+          for kind, column, referencing, owner in paths),
+    ).order_by('kind', 'id')
+
+
+def load_usage_objects(kind, ids):
+    # Expansion covers the first MULTI_GET_MAX ids of a kind, batched: the stored case documents,
+    # or the articles with their direct links eager loaded
+    ids = ids[:MULTI_GET_MAX]
+    if kind == 'cases':
+        documents = load_case_documents(ids)
+        return [documents[case_id] for case_id in ids if case_id in documents]
+    statement = (select(Articles).options(*eager_options(Articles, expand=ARTICLE_USAGE_EXPAND))
+                 .where(Articles.id.in_(ids)).order_by(Articles.id))
+    return [article.serialize(expand=ARTICLE_USAGE_EXPAND) for article in db.session.scalars(statement)]
+
+
+def usage_view(model, paths):
+    def view(**values):
+        (entity_id,) = values.values()
+        expand = [kind for kind in request.args.get('expand', '').split(',') if kind]
+        if any(kind not in USAGE_EXPAND for kind in expand):
+            return jsonify({'message': f"expand must be a comma-separated list of {', '.join(USAGE_EXPAND)}"}), 400
+
+        rows = db.session.execute(usage_statement(model, paths, entity_id)).all()
+        if not rows or rows[0].kind != '':
+            return jsonify({'message': f'{model.__tablename__} not found'}), 404
+        ids = {kind: [] for kind, column, referencing, owner in paths}
+        for kind, referencing_id in rows[1:]:
+            ids[kind].append(referencing_id)
+
+        with serialize_timer():
+            usage = {kind: {'count': len(kind_ids), 'ids': kind_ids} for kind, kind_ids in ids.items()}
+            for kind in dict.fromkeys(expand):
+                usage[kind]['objects'] = load_usage_objects(kind, ids[kind]) if ids[kind] else []
+            return jsonify({'id': entity_id, 'usage': usage})
+    return view
+
+
+for name, (model, paths) in USAGE.items():
+    api.add_url_rule(f'/api/{name}/<{name}_id>/usage', f'usage_{name}', usage_view(model, paths), methods=['GET'])
+
+
+# Schema migrations
+
+# Applied migrations are recorded here. Kept out of db.metadata so create_all and the export
+# never see it
+migration_table = Table(
+    'schema_migration', MetaData(),
+    Column('id', Text, primary_key=True),
+    Column('applied_at', DateTime, server_default=func.now()),
+)
+
+
+def create_missing_indexes(connection):
+    # Every index declared on the models, for databases created before it was declared
+    existing = inspect(connection)
+    for table in db.metadata.sorted_tables:
+        if not existing.has_table(table.name):
+            continue
+        names = {index['name'] for index in existing.get_indexes(table.name)}
+        for index in table.indexes:
+            if index.name not in names:
+                index.create(connection)
+                click.echo(f'  created {index.name}')
+
+
+def add_change_tracking(connection):
+    # The ChangeTracking columns on existing tables, and the change_log table. SQLite cannot add a
+    # column with a non-constant default, existing rows are stamped once instead
+    existing = inspect(connection)
+    for table in db.metadata.sorted_tables:
+        if 'deleted_at' not in table.c or not existing.has_table(table.name):
+            continue
+        present = {column['name'] for column in existing.get_columns(table.name)}
+        for name in ('created_at', 'updated_at', 'deleted_at'):
+            if name in present:
+                continue
+            ddl = f'ALTER TABLE {table.name} ADD COLUMN {name} {table.c[name].type.compile(connection.dialect)}'
+            if name != 'deleted_at' and connection.dialect.name == 'postgresql':
+                ddl += ' DEFAULT now()'
+            connection.exec_driver_sql(ddl)
+            if name != 'deleted_at' and connection.dialect.name != 'postgresql':
+                connection.exec_driver_sql(f'UPDATE {table.name} SET {name} = CURRENT_TIMESTAMP')
+            click.echo(f'  added {table.name}.{name}')
+    ChangeLog.__table__.create(connection, checkfirst=True)
+
+
+def materialize_missing_documents(connection):
+    # Builds and stores the document of every live case that has none, reading through
+    # connection. Returns how many were built
+    missing = connection.execute(
+        select(Cases.id).where(*live(Cases), Cases.id.notin_(select(CaseDocument.case_id)))
+        .order_by(Cases.id)).scalars().all()
+    db.session.registry.set(Session(bind=connection))
+    try:
+        for start in range(0, len(missing), DOCUMENT_BATCH_SIZE):
+            documents = build_case_documents(missing[start:start + DOCUMENT_BATCH_SIZE])
+            connection.execute(CaseDocument.__table__.insert(), [
+                {'case_id': case_id, 'document': document} for case_id, document in documents.items()])
+    finally:
+        db.session.remove()
+    return len(missing)
+
+
+def add_case_documents(connection):
+    # The case_document table the reads and the write hooks expect, filled for every case
+    CaseDocument.__table__.create(connection, checkfirst=True)
+    click.echo(f'  materialized {materialize_missing_documents(connection)} case documents')
+
+
+# (id, function taking a connection) in the order they are applied. Append only
+MIGRATIONS = (
+    ('0001_foreign_key_indexes', create_missing_indexes),
+    ('0002_change_tracking', add_change_tracking),
+    ('0003_case_document', add_case_documents),
+)
+
+
+@api.cli.command('db-upgrade')
+def db_upgrade():
+    with db.engine.begin() as connection:
+        migration_table.create(connection, checkfirst=True)
+        applied = set(connection.execute(select(migration_table.c.id)).scalars())
+    for migration_id, migrate in MIGRATIONS:
+        if migration_id in applied:
+            continue
+        click.echo(f'Applying {migration_id}')
+        with db.engine.begin() as connection:
+            migrate(connection)
+            connection.execute(migration_table.insert().values(id=migration_id))
+    click.echo('Database is up to date')
+
+
+# Snapshots
+
+# Bytes of the snapshot file SQLite maps into memory, past that it reads through the page cache
+SNAPSHOT_MMAP_SIZE = 1 << 34
+# Threads that keep their own snapshot connection
+SNAPSHOT_CONNECTIONS = 64
+
+
+def build_snapshot(source, path):
+    # Copies every table of source, read from one snapshot, into a new SQLite file with the same
+    # indexes, plus the documents of cases that have none and the full-text index. Written next
+    # to path and moved over it once complete
+    partial = f'{path}.partial'
+    if os.path.exists(partial):
+        os.remove(partial)
+    target = create_engine(f'sqlite:///{partial}')
+    with target.connect() as connection:
+        # A throwaway file until it is complete, no journal needed
+        connection.exec_driver_sql('PRAGMA journal_mode = OFF')
+        connection.exec_driver_sql('PRAGMA synchronous = OFF')
+        db.metadata.create_all(connection)
+        migration_table.create(connection)
+        connection.execute(migration_table.insert(), [{'id': migration_id} for migration_id, _ in MIGRATIONS])
+        with consistent_reads(source) as reads:
+            for table in db.metadata.sorted_tables:
+                for keys, rows in table_chunks(reads, table):
+                    connection.execute(table.insert(), [dict(zip(keys, row)) for row in rows])
+        connection.commit()
+
+        # Build the missing documents from the copy itself, so they match the rows it holds
+        built = materialize_missing_documents(connection)
+
+        for statement in search_ddl('sqlite'):
+            connection.exec_driver_sql(statement)
+        connection.commit()
+        connection.exec_driver_sql('ANALYZE')
+        connection.commit()
+        connection.exec_driver_sql('PRAGMA journal_mode = DELETE')
+        connection.exec_driver_sql('VACUUM')
+    target.dispose()
+    os.replace(partial, path)
+    return built
+
+
+def snapshot_url(path):
+    # immutable=1: no locks and no change detection, any number of readers at no cost
+    return f'sqlite:///file:{os.path.abspath(path)}?mode=ro&immutable=1&uri=true'
+
+
+def snapshot_engine_options():
+    # A connection per thread, kept for the life of the thread, instead of checkouts from a pool
+    return {'poolclass': SingletonThreadPool, 'pool_size': SNAPSHOT_CONNECTIONS,
+            'connect_args': {'check_same_thread': False}}
+
+
+def set_snapshot_pragmas(dbapi_connection, connection_record):
+    cursor = dbapi_connection.cursor()
+    cursor.execute(f'PRAGMA mmap_size = {SNAPSHOT_MMAP_SIZE}')
+    cursor.execute('PRAGMA query_only = ON')
+    cursor.close()
+
+
+@api.before_app_request
+def refuse_writes():
+    if current_app.config['READ_ONLY'] and request.method not in ('GET', 'HEAD', 'OPTIONS'):
+        return jsonify({'message': 'This server is read-only'}), 405
+    return None
+
+
+@api.cli.command('build-snapshot')
+@click.argument('path', type=click.Path(dir_okay=False))
+def build_snapshot_command(path):
+    started = time.perf_counter()
+    built = build_snapshot(db.engine, path)
+    click.echo(f'Wrote {path} ({os.path.getsize(path) / 1e6:.1f} MB, {built} case documents built) '
+               f'in {time.perf_counter() - started:.1f}s')
+
+
+# App factory
+
+# Responses primed by the warm-up: the cached reference tables and rollups, and the facet index
+WARM_UP_URLS = ('/api/disease', '/api/treatment', '/api/question_type', '/api/cases/search') + tuple(
+    f'/api/stats/{name}' for name, tables, statement in STATS)
+
+
+def fill_pools():
+    # Check out pool_size connections on every engine at once so all of them get opened, then
+    # hand them back
+    for key, engine in db.engines.items():
+        if not isinstance(engine.pool, QueuePool):
+            continue
+        connections = []
+        try:
+            for _ in range(engine.pool.size()):
+                connections.append(engine.connect())
+        except OperationalError as e:
+            current_app.logger.warning('Could not fill the %s pool: %s', key or 'primary', e.orig)
+        for connection in connections:
+            connection.close()
+
+
+def warm_up(app):
+    # Everything the first request in a worker would otherwise pay for
+    started = time.perf_counter()
+    configure_mappers()
+    with app.app_context():
+        fill_pools()
+        client = app.test_client()
+        for url in WARM_UP_URLS:
+            client.get(url).get_data()
+        for metric in app.config['PRECOMPUTE_SIMILAR']:
+            try:
+                similar_cases_index.precompute(metric)
+            except ImportError:
+                app.logger.warning('Similar cases need numpy and scipy installed, not precomputed')
+                break
+    route_metrics.reset()
+    app.logger.info('Warmed up in %.1f ms', (time.perf_counter() - started) * 1000)
+
+
+def create_app(config=None):
+    # config: a name from CONFIGS or a dict of settings
+    app = Flask(__name__)
+    app.config['SQLALCHEMY_DATABASE_URI'] = os.environ.get('DATABASE_URL', '')
+    app.config['REPLICA_RETRY_SECONDS'] = float(os.environ.get('REPLICA_RETRY_SECONDS', 30))
+    app.config['SLOW_QUERY_MS'] = 200
+    app.config['REQUEST_QUERY_WARNING'] = 100
+    app.config['WARM_UP'] = False
+    # Metrics whose similar-case lists warm-up fills for every case
+    app.config['PRECOMPUTE_SIMILAR'] = ()
+    app.config['ROUTE_CLASSES'] = {name: dict(limits) for name, limits in ROUTE_CLASSES.items()}
+    app.config['READ_ONLY'] = False
+    app.config['SNAPSHOT_PATH'] = os.environ.get('SNAPSHOT_PATH')
+    app.config.update(CONFIGS[config] if isinstance(config, str) else config or {})
+    if app.config['SNAPSHOT_PATH']:
+        app.config['SQLALCHEMY_DATABASE_URI'] = snapshot_url(app.config['SNAPSHOT_PATH'])
+        app.config['SQLALCHEMY_ENGINE_OPTIONS'] = snapshot_engine_options()
+        app.config['SQLALCHEMY_BINDS'] = {}
+        app.config['READ_ONLY'] = True
+    app.config.setdefault('SQLALCHEMY_ENGINE_OPTIONS', engine_options(app.config['SQLALCHEMY_DATABASE_URI']))
+    app.config.setdefault('SQLALCHEMY_BINDS', replica_binds())
+    if not app.debug and hasattr(app, 'json'):
+        # Flask 2.2+ takes the JSON settings from app.json rather than the config
+        app.json.compact = True
+
+    db.init_app(app)
+    if app.config['SNAPSHOT_PATH']:
+        with app.app_context():
+            event.listen(db.engine, 'connect', set_snapshot_pragmas)
+    CORS(app)
+    app.register_blueprint(api)
+    if app.config['WARM_UP']:
+        warm_up(app)
+    return app
+
+
+app = create_app(os.environ.get('APP_CONFIG', 'development'))
@@ -0,0 +1,325 @@
+# Async serving mode for the read routes, on an AsyncSession and an async driver (asyncpg for
+# Postgres, aiosqlite for SQLite). Responses match the Flask routes byte for byte in shape.
+#
+#   DATABASE_URL=postgresql://... uvicorn asgi:application --workers 4
+#
+# ASYNC_DATABASE_URL overrides the URL derived from DATABASE_URL.
+#
+# Served: the list routes, the reference tables, /api/cases/<id>, /api/cases?ids=,
+# /api/cases/search and /api/search, with ?expand=profile where the Flask routes take it. The
+# other GET routes of the Flask app (stats, changes, export, similar cases, usage, metrics)
+# answer 501 here, run them on the WSGI app.
+
+import asyncio
+import os
+import re
+from urllib.parse import parse_qs
+
+from sqlalchemy import select
+from sqlalchemy.engine import make_url
+from sqlalchemy.exc import OperationalError, ProgrammingError
+from sqlalchemy.ext.asyncio import async_sessionmaker, create_async_engine
+from werkzeug.exceptions import HTTPException
+
+from app import (app, Articles, CASE_DOCUMENT_CHILDREN, CASE_MODELS, CaseDocument, Cases, Disease, Enhanced, Patient,
+                 PROFILE_LINKS, PatientQuestion, ProcessedQuestion, QuestionType, SEARCH_INDEX_MISSING,
+                 STREAM_CHUNK_SIZE, Treatment, assemble_case_document, attach_profiles, case_children_statement,
+                 case_diseases, case_documents_with_profiles, case_facet_index, case_feature_statement,
+                 case_search_result, column_statement, dimension_cache, disease_profile_loader, dumps_json,
+                 eager_options, engine_options, group_children, list_statement, live, multi_case_response,
+                 next_cursor, page_end_cursor, page_end_statement, parse_case_ids, parse_case_search, parse_expand,
+                 parse_fields, profile_link_statement, search_params, search_query, search_result, split_profile,
+                 table_versions)
+
+ASYNC_DRIVERS = {'postgresql': 'postgresql+asyncpg', 'sqlite': 'sqlite+aiosqlite'}
+
+LIST_ROUTES = {
+    '/api/patient_question': PatientQuestion,
+    '/api/processed_question': ProcessedQuestion,
+    '/api/enhanced': Enhanced,
+    '/api/articles': Articles,
+    '/api/patient': Patient,
+}
+COLUMN_ROUTES = {
+    '/api/question_type': QuestionType,
+    '/api/treatment': Treatment,
+    '/api/disease': Disease,
+}
+CASE_ROUTE = re.compile(r'^/api/cases/(\d+)$')
+
+
+def async_url(url):
+    url = make_url(url)
+    return url.set(drivername=ASYNC_DRIVERS.get(url.get_backend_name(), url.drivername))
+
+
+class HTTPError(Exception):
+
+    def __init__(self, status, message):
+        super().__init__(message)
+        self.status = status
+        self.message = message
+
+
+async def build_case_documents(Session, case_ids, fields, expand):
+    # The case and its four kinds of children are independent queries, run them side by side,
+    # each on its own session since a session cannot run two statements at once
+    async def load_cases():
+        async with Session() as session:
+            statement = (select(Cases).options(*eager_options(Cases, fields, expand))
+                         .where(Cases.id.in_(case_ids), *live(Cases)))
+            return (await session.scalars(statement)).all()
+
+    async def load_children(key, wrapper, model):
+        async with Session() as session:
+            objects = await session.scalars(case_children_statement(model, case_ids, fields, expand))
+            return key, group_children(wrapper, objects, fields, expand)
+
+    cases, *children = await asyncio.gather(
+        load_cases(), *(load_children(*child) for child in CASE_DOCUMENT_CHILDREN))
+    children = dict(children)
+    return {case.id: assemble_case_document(case, children, fields, expand) for case in cases}
+
+
+async def load_case_documents(Session, case_ids, fields, expand):
+    # Read-only: documents missing from case_document are built, not stored
+    documents = {}
+    if fields is None and expand is None:
+        async with Session() as session:
+            rows = await session.execute(
+                select(CaseDocument.case_id, CaseDocument.document).where(CaseDocument.case_id.in_(case_ids)))
+            documents.update(rows.all())
+
+    missing = [case_id for case_id in case_ids if case_id not in documents]
+    if missing:
+        documents.update(await build_case_documents(Session, missing, fields, expand))
+    return documents
+
+
+async def dispatch_profiles(Session, loader):
+    # DiseaseProfileLoader.dispatch on the async session: the dimension rows from the shared
+    # cache, read on a miss, and one IN query per link table
+    disease_ids = loader.claim()
+    if not disease_ids:
+        return loader
+    async with Session() as session:
+        for key, link, column, dimension in PROFILE_LINKS:
+            version = table_versions.get(dimension.__tablename__, 0)
+            rows = dimension_cache.cached(dimension, version)
+            if rows is None:
+                rows = dimension_cache.store(
+                    dimension, version, (await session.execute(dimension_cache.statement(dimension))).all())
+            loader.apply(key, rows, (await session.execute(profile_link_statement(link, column, disease_ids))).all())
+    return loader
+
+
+async def with_case_profiles(Session, documents):
+    loader = disease_profile_loader(disease['id'] for document in documents.values()
+                                    for disease in case_diseases(document))
+    return case_documents_with_profiles(documents, await dispatch_profiles(Session, loader))
+
+
+async def streamed_cursor_headers(Session, statement, model, limit):
+    if limit is None:
+        return {}
+    async with Session() as session:
+        page_end = (await session.execute(page_end_statement(statement, model.__mapper__.primary_key[0]))).one()
+    cursor = page_end_cursor(page_end, limit)
+    return {} if cursor is None else {'X-Next-Cursor': cursor}
+
+
+def parse_case_args(args):
+    try:
+        return parse_fields(args), parse_expand(args, *CASE_MODELS)
+    except ValueError as e:
+        raise HTTPError(400, str(e))
+
+
+async def list_route(Session, model, args):
+    try:
+        statement, fields, expand, limit = list_statement(model, args)
+    except ValueError as e:
+        raise HTTPError(400, str(e))
+
+    if args.get('stream') in ('1', 'true'):
+        async def body():
+            async with Session() as session:
+                yield b'['
+                rows = await session.stream_scalars(statement.execution_options(yield_per=STREAM_CHUNK_SIZE))
+                first = True
+                async for obj in rows:
+                    yield (b'' if first else b',') + dumps_json(obj.serialize(fields, expand))
+                    first = False
+                yield b']'
+        return body(), await streamed_cursor_headers(Session, statement, model, limit)
+
+    async with Session() as session:
+        objects = (await session.scalars(statement)).all()
+        payload = dumps_json([obj.serialize(fields, expand) for obj in objects])
+    cursor = next_cursor(model, objects, limit)
+    return payload, {} if cursor is None else {'X-Next-Cursor': cursor}
+
+
+async def column_list_route(Session, model, args):
+    profile = False
+    if model is Disease:
+        args, profile = split_profile(args)
+    try:
+        statement, keys, limit = column_statement(model, args)
+    except ValueError as e:
+        raise HTTPError(400, str(e))
+
+    async def items(rows):
+        chunk = [dict(zip(keys, row)) for row in rows]
+        if profile:
+            disease_ids = [row[-1] for row in rows]
+            attach_profiles(chunk, disease_ids, await dispatch_profiles(Session, disease_profile_loader(disease_ids)))
+        return chunk
+
+    if args.get('stream') in ('1', 'true'):
+        async def body():
+            async with Session() as session:
+                yield b'['
+                result = await session.stream(statement.execution_options(yield_per=STREAM_CHUNK_SIZE))
+                first = True
+                async for rows in result.partitions():
+                    yield (b'' if first else b',') + dumps_json(await items(rows))[1:-1]
+                    first = False
+                yield b']'
+        return body(), await streamed_cursor_headers(Session, statement, model, limit)
+
+    async with Session() as session:
+        rows = (await session.execute(statement)).all()
+    cursor = str(rows[-1][-1]) if limit is not None and len(rows) == limit else None
+    return dumps_json(await items(rows)), {} if cursor is None else {'X-Next-Cursor': cursor}
+
+
+async def search_cases_route(Session, args):
+    try:
+        criteria, limit, offset = parse_case_search(args)
+    except ValueError as e:
+        raise HTTPError(400, str(e))
+
+    # The index is shared with the Flask routes and guarded by a thread lock, which is never held
+    # across an await: claim the stale cases, read their rows, then apply them
+    with case_facet_index.lock:
+        case_ids = case_facet_index.plan()
+    if case_ids is None or case_ids:
+        async with Session() as session:
+            rows = (await session.execute(case_feature_statement(case_ids))).all()
+        with case_facet_index.lock:
+            case_facet_index.apply(case_ids, rows)
+    with case_facet_index.lock:
+        matches, facets = case_facet_index.query(criteria)
+    return dumps_json(case_search_result(matches, facets, limit, offset)), {}
+
+
+async def search_route(Session, args):
+    async with Session() as session:
+        dialect = session.bind.dialect.name
+        try:
+            params = search_params(args, dialect)
+        except ValueError as e:
+            raise HTTPError(400, str(e))
+        try:
+            rows = (await session.execute(search_query(dialect), params)).all()
+        except (OperationalError, ProgrammingError):
+            raise HTTPError(503, SEARCH_INDEX_MISSING)
+    return dumps_json(search_result(rows, params)), {}
+
+
+def served_by_flask(path):
+    try:
+        app.url_map.bind('').match(path, 'GET')
+    except HTTPException:
+        return False
+    return True
+
+
+async def route(Session, path, args):
+    if path in LIST_ROUTES:
+        return await list_route(Session, LIST_ROUTES[path], args)
+    if path in COLUMN_ROUTES:
+        return await column_list_route(Session, COLUMN_ROUTES[path], args)
+
+    if path == '/api/cases':
+        args, profile = split_profile(args)
+        try:
+            case_ids = parse_case_ids(args)
+        except ValueError as e:
+            raise HTTPError(400, str(e))
+        documents = await load_case_documents(Session, case_ids, *parse_case_args(args))
+        if profile:
+            documents = await with_case_profiles(Session, documents)
+        return dumps_json(multi_case_response(case_ids, documents)), {}
+
+    if path == '/api/cases/search':
+        return await search_cases_route(Session, args)
+    if path == '/api/search':
+        return await search_route(Session, args)
+
+    match = CASE_ROUTE.match(path)
+    if match:
+        case_id = int(match.group(1))
+        args, profile = split_profile(args)
+        documents = await load_case_documents(Session, [case_id], *parse_case_args(args))
+        if case_id not in documents:
+            raise HTTPError(404, 'Case not found')
+        if profile:
+            documents = await with_case_profiles(Session, documents)
+        return dumps_json(documents[case_id]), {}
+
+    if served_by_flask(path):
+        raise HTTPError(501, 'Not served in async mode, use the WSGI app')
+    raise HTTPError(404, 'Not found')
+
+
+async def send_response(send, status, body, headers):
+    headers = [(b'content-type', b'application/json'), (b'access-control-allow-origin', b'*')] + [
+        (name.lower().encode(), value.encode()) for name, value in headers.items()]
+    await send({'type': 'http.response.start', 'status': status, 'headers': headers})
+    if isinstance(body, bytes):
+        await send({'type': 'http.response.body', 'body': body})
+        return
+    async for chunk in body:
+        await send({'type': 'http.response.body', 'body': chunk, 'more_body': True})
+    await send({'type': 'http.response.body', 'body': b''})
+
+
+def create_async_app(url=None):
+    url = url or os.environ.get('ASYNC_DATABASE_URL') or app.config['SQLALCHEMY_DATABASE_URI']
+    # Same pool settings as the sync app, connect_args are driver specific and do not carry over
+    options = {option: value for option, value in engine_options(url).items() if option != 'connect_args'}
+    engine = create_async_engine(async_url(url), **options)
+    Session = async_sessionmaker(engine, expire_on_commit=False)
+
+    async def application(scope, receive, send):
+        if scope['type'] == 'lifespan':
+            while True:
+                message = await receive()
+                if message['type'] == 'lifespan.startup':
+                    await send({'type': 'lifespan.startup.complete'})
+                elif message['type'] == 'lifespan.shutdown':
+                    await engine.dispose()
+                    await send({'type': 'lifespan.shutdown.complete'})
+                    return
+        if scope['type'] != 'http':
+            return
+
+        if scope['method'] not in ('GET', 'HEAD'):
+            await send_response(send, 405, dumps_json({'message': 'Method not allowed'}), {})
+            return
+        args = {key: values[0] for key, values in
+                parse_qs(scope['query_string'].decode(), keep_blank_values=True).items()}
+        try:
+            body, headers = await route(Session, scope['path'], args)
+            status = 200
+        except HTTPError as e:
+            body, headers, status = dumps_json({'message': e.message}), {}, e.status
+        await send_response(send, status, body, headers)
+
+    application.engine = engine
+    return application
+
+
+application = create_async_app()
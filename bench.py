@@ -0,0 +1,590 @@
+# Synthetic dataset generator and per-endpoint benchmark.
+#
+#   DATABASE_URL=sqlite:///bench.sqlite python bench.py generate --database sqlite:///bench.sqlite --cases 1000
+#   DATABASE_URL=sqlite:///bench.sqlite python bench.py run --output after.json --baseline before.json
+#   DATABASE_URL=sqlite:///bench.sqlite python bench.py concurrency --clients 32
+#   DATABASE_URL=sqlite:///bench.sqlite python bench.py advise
+#   DATABASE_URL=sqlite:///bench.sqlite python bench.py startup
+
+import argparse
+import asyncio
+import json
+import os
+import random
+import re
+import subprocess
+import sys
+import threading
+import time
+import tracemalloc
+from concurrent.futures import ThreadPoolExecutor
+
+from sqlalchemy import event
+from sqlalchemy import select
+from sqlalchemy.engine import make_url
+
+from app import (app, db, ArticleDiseaseObj, ArticlePatientObj, ArticleQuestionObj, ArticleTreatmentObj, Articles,
+                 BackgroundDisease, CDObj, CPObj, CPQDiseaseObj, CPQPatientObj, CPQQuestionObj, CPQTreatmentObj, CQObj,
+                 CTObj, Cases, Disease, DiseaseL, DiseaseLocation, DiseaseM, DiseaseMutation, DiseaseP, DiseaseProtein,
+                 Enhanced, EnhancedDiseases, EnhancedPatients, EnhancedQuestionTypes, EnhancedTreatments, Patient,
+                 PatientBackgroundDiseases, PatientQuestion, PatientSideEffects, PatientSymptoms, ProcessedQuestion,
+                 QuestionType, RQDiseaseObj, RQPatientObj, RQQuestionObj, RQTreatmentObj, SideEffect, Symptom,
+                 Treatment, create_app, refresh_case_documents, search_ddl)
+
+INSERT_CHUNK_SIZE = 5000
+AGE_RANGES = Patient.__table__.c.age_range.type.enums
+GENDERS = Patient.__table__.c.gender.type.enums
+
+
+def insert(model, rows):
+    for start in range(0, len(rows), INSERT_CHUNK_SIZE):
+        db.session.execute(model.__table__.insert(), rows[start:start + INSERT_CHUNK_SIZE])
+
+
+def links(rng, model, left, right, left_ids, right_ids, fanout):
+    right = right or next(column.key for column in model.__table__.c if column.key != left)
+    rows = []
+    for left_id in left_ids:
+        for right_id in rng.sample(right_ids, min(rng.randint(0, fanout), len(right_ids))):
+            rows.append({left: left_id, right: right_id})
+    insert(model, rows)
+
+
+def generate(cases, questions_per_case, articles_per_question, fanout, vocabulary, seed, documents):
+    rng = random.Random(seed)
+    db.drop_all(bind_key=None)
+    db.create_all(bind_key=None)
+
+    disease_ids = [f'D{i}' for i in range(vocabulary)]
+    treatment_ids = [f'T{i}' for i in range(vocabulary)]
+    question_type_ids = [f'Q{i}' for i in range(max(vocabulary // 10, 1))]
+    small = range(1, max(vocabulary // 4, 1) + 1)
+    insert(Disease, [{'id': i, 'full_name': f'Disease {i}', 'shortcut': i} for i in disease_ids])
+    insert(Treatment, [{'id': i, 'name': f'Treatment {i}', 'treatment_type': rng.choice('ABC'),
+                        'sub_classification': rng.choice('xyz')} for i in treatment_ids])
+    insert(QuestionType, [{'id': i, 'type': f'Type {i}', 'classification': rng.choice('ABC')}
+                          for i in question_type_ids])
+    insert(Symptom, [{'id': i, 'name': f'Symptom {i}', 'location': 'chest', 'severity': 'mild'} for i in small])
+    insert(BackgroundDisease, [{'id': i, 'name': f'Background {i}'} for i in small])
+    insert(SideEffect, [{'id': i, 'name': f'Side effect {i}'} for i in small])
+    insert(DiseaseProtein, [{'id': i, 'name': f'Protein {i}'} for i in small])
+    insert(DiseaseLocation, [{'id': i, 'location': f'Location {i}'} for i in small])
+    insert(DiseaseMutation, [{'id': i, 'mutation': f'Mutation {i}', 'mutation_status': 'positive'} for i in small])
+    links(rng, DiseaseP, 'disease_id', 'protein_id', disease_ids, list(small), fanout)
+    links(rng, DiseaseL, 'disease_id', 'location_id', disease_ids, list(small), fanout)
+    links(rng, DiseaseM, 'disease_id', 'mutation_id', disease_ids, list(small), fanout)
+
+    patient_ids = list(range(1, cases + 1))
+    insert(Patient, [{'id': i, 'age': rng.randint(1, 90), 'age_range': rng.choice(AGE_RANGES),
+                      'gender': rng.choice(GENDERS)} for i in patient_ids])
+    links(rng, PatientSymptoms, 'patient_id', 'symptom_id', patient_ids, list(small), fanout)
+    links(rng, PatientBackgroundDiseases, 'patient_id', 'back_g_disease_id', patient_ids, list(small), fanout)
+    links(rng, PatientSideEffects, 'patient_id', 'side_effect_id', patient_ids, list(small), fanout)
+
+    case_ids = list(range(1, cases + 1))
+    insert(Cases, [{'id': i, 'patient_summary': f'Summary of case {i}'} for i in case_ids])
+    insert(CPObj, [{'case_id': i, 'p_object_id': i} for i in case_ids])
+    links(rng, CDObj, 'case_id', 'disease_object_id', case_ids, disease_ids, fanout)
+    links(rng, CQObj, 'case_id', 'question_object_id', case_ids, question_type_ids, fanout)
+    links(rng, CTObj, 'case_id', 'treatment_object_id', case_ids, treatment_ids, fanout)
+
+    questions, processed, enhanced, articles = [], [], [], []
+    for case_id in case_ids:
+        for _ in range(questions_per_case):
+            question_id = len(questions) + 1
+            questions.append({'id': question_id, 'case_id': case_id, 'question': f'Question {question_id}'})
+            processed.append({'id': question_id, 'case_id': case_id, 'question_id': question_id,
+                              'question': f'Processed {question_id}', 'question_note': 'note'})
+            enhanced.append({'id': question_id, 'case_id': case_id, 'processed_question_id': question_id})
+            for _ in range(articles_per_question):
+                articles.append({'id': len(articles) + 1, 'case_id': case_id, 'processed_question_id': question_id,
+                                 'reference': f'Reference {len(articles)}', 'highlighted_text': 'highlighted',
+                                 'alternative_pubmed_link': 'https://pubmed.ncbi.nlm.nih.gov/'})
+    insert(PatientQuestion, questions)
+    insert(ProcessedQuestion, processed)
+    insert(Enhanced, enhanced)
+    insert(Articles, articles)
+
+    question_ids = [row['id'] for row in questions]
+    article_ids = [row['id'] for row in articles]
+    for model, left, left_ids in ((CPQPatientObj, 'question_id', question_ids),
+                                  (RQPatientObj, 'research_question_id', question_ids),
+                                  (EnhancedPatients, 'enhanced_id', question_ids),
+                                  (ArticlePatientObj, 'article_id', article_ids)):
+        links(rng, model, left, None, left_ids, patient_ids, 1)
+    for model, left, left_ids, right_ids in (
+            (CPQDiseaseObj, 'question_id', question_ids, disease_ids),
+            (CPQQuestionObj, 'question_id', question_ids, question_type_ids),
+            (CPQTreatmentObj, 'question_id', question_ids, treatment_ids),
+            (RQDiseaseObj, 'research_question_id', question_ids, disease_ids),
+            (RQQuestionObj, 'research_question_id', question_ids, question_type_ids),
+            (RQTreatmentObj, 'research_question_id', question_ids, treatment_ids),
+            (EnhancedDiseases, 'enhanced_id', question_ids, disease_ids),
+            (EnhancedQuestionTypes, 'enhanced_id', question_ids, question_type_ids),
+            (EnhancedTreatments, 'enhanced_id', question_ids, treatment_ids),
+            (ArticleDiseaseObj, 'article_id', article_ids, disease_ids),
+            (ArticleQuestionObj, 'article_id', article_ids, question_type_ids),
+            (ArticleTreatmentObj, 'article_id', article_ids, treatment_ids)):
+        links(rng, model, left, None, left_ids, right_ids, fanout)
+    db.session.commit()
+
+    if documents:
+        for start in range(0, len(case_ids), 100):
+            refresh_case_documents(case_ids[start:start + 100])
+            db.session.commit()
+
+    # The full-text index, so /api/search has something to search
+    connection = db.session.connection()
+    for statement in search_ddl(connection.dialect.name):
+        connection.exec_driver_sql(statement)
+    db.session.commit()
+
+
+def sample_args():
+    # Values for the URL parameters of the routes, taken from the data actually in the database
+    return {
+        'case_id': db.session.execute(select(Cases.id).order_by(Cases.id).limit(20)).scalars().all(),
+        'treatment_id': db.session.execute(select(Treatment.id).order_by(Treatment.id).limit(20)).scalars().all(),
+        'disease_id': db.session.execute(select(Disease.id).order_by(Disease.id).limit(20)).scalars().all(),
+        'question_type_id': db.session.execute(
+            select(QuestionType.id).order_by(QuestionType.id).limit(20)).scalars().all(),
+        'search_text': db.session.execute(
+            select(Cases.patient_summary).order_by(Cases.id).limit(20)).scalars().all(),
+    }
+
+
+# Query parameters of the routes that answer 400 without any: (samples needed, parameters from them)
+QUERY_SAMPLES = {
+    '/api/cases': (('case_id',), lambda samples, rng: {
+        'ids': ','.join(str(case_id) for case_id in rng.sample(samples['case_id'], min(10, len(samples['case_id']))))}),
+    '/api/cases/search': (('disease_id',), lambda samples, rng: {'disease': rng.choice(samples['disease_id'])}),
+    '/api/search': (('search_text',), lambda samples, rng: {'q': rng.choice(samples['search_text'])}),
+}
+
+
+def benchmark_urls(samples, rng):
+    urls = []
+    for rule in app.url_map.iter_rules():
+        if 'GET' not in rule.methods or not rule.rule.startswith('/api/') or rule.rule.startswith('/api/_'):
+            continue
+        needed, query = QUERY_SAMPLES.get(rule.rule, ((), lambda samples, rng: {}))
+        if any(not samples.get(argument) for argument in (*rule.arguments, *needed)):
+            print(f'skipping {rule.rule}: no sample values', file=sys.stderr)
+            continue
+        # Values that are not rule arguments go in the query string
+        urls.append((rule.rule, lambda rule=rule, query=query: rule.build(
+            {**query(samples, rng), **{argument: rng.choice(samples[argument]) for argument in rule.arguments}})[1]))
+    return urls
+
+
+def succeeded(status):
+    return 200 <= status < 300
+
+
+def percentile(values, fraction):
+    ordered = sorted(values)
+    return ordered[min(int(len(ordered) * fraction), len(ordered) - 1)]
+
+
+def query_count(response):
+    match = re.search(r'queries;desc="(\d+)"', response.headers.get('Server-Timing', ''))
+    return int(match.group(1)) if match else None
+
+
+def run(iterations, seed):
+    rng = random.Random(seed)
+    client = app.test_client()
+    with app.app_context():
+        samples = sample_args()
+
+    results = {}
+    for rule, build_url in benchmark_urls(samples, rng):
+        response = client.get(build_url())
+        response.get_data()
+        latencies, queries = [], []
+        for _ in range(iterations):
+            if not succeeded(response.status_code):
+                break
+            start = time.perf_counter()
+            response = client.get(build_url())
+            response.get_data()
+            latencies.append((time.perf_counter() - start) * 1000)
+            queries.append(query_count(response))
+        if not succeeded(response.status_code):
+            # An error response says nothing about how fast the route is, keep only its status
+            results[rule] = {'status': response.status_code}
+            print(f'{rule:45} status {response.status_code}, not timed', file=sys.stderr)
+            continue
+
+        # Separate pass, tracemalloc slows everything down too much to time under it
+        tracemalloc.start()
+        client.get(build_url()).get_data()
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+
+        results[rule] = {
+            'status': response.status_code,
+            'p50_ms': round(percentile(latencies, 0.50), 3),
+            'p95_ms': round(percentile(latencies, 0.95), 3),
+            'p99_ms': round(percentile(latencies, 0.99), 3),
+            'max_queries': max(q for q in queries if q is not None) if any(q is not None for q in queries) else None,
+            'peak_memory_kb': round(peak / 1024, 1),
+        }
+        print(f"{rule:45} p50 {results[rule]['p50_ms']:9.2f} ms  p95 {results[rule]['p95_ms']:9.2f} ms  "
+              f"queries {results[rule]['max_queries']}  peak {results[rule]['peak_memory_kb']} kB")
+    return results
+
+
+def regressions(results, baseline, threshold, floor_ms):
+    # A route whose status changed, or that does not succeed, is a regression whatever its timings:
+    # an error response can easily be faster than the real one
+    found = []
+    for rule, before in baseline.get('routes', {}).items():
+        after = results.get(rule)
+        if after is None:
+            continue
+        if after['status'] != before['status']:
+            found.append(f"{rule}: status {before['status']} -> {after['status']}")
+            continue
+        if not succeeded(after['status']):
+            found.append(f"{rule}: status {after['status']}")
+            continue
+        if after['p95_ms'] > max(before['p95_ms'] * threshold, before['p95_ms'] + floor_ms):
+            found.append(f"{rule}: p95 {before['p95_ms']} ms -> {after['p95_ms']} ms")
+        if None not in (before['max_queries'], after['max_queries']) and after['max_queries'] > before['max_queries']:
+            found.append(f"{rule}: queries {before['max_queries']} -> {after['max_queries']}")
+    return found
+
+
+def concurrency_urls(rng, count):
+    # Materialized reads, the full fan-out build (any ?expand= skips the stored document) and a page
+    # of a list route
+    with app.app_context():
+        case_ids = sample_args()['case_id']
+    fan_out = '?expand=patient_objects,disease_objects,question_objects,treatment_objects'
+    return [rng.choice([f'/api/cases/{rng.choice(case_ids)}', f'/api/cases/{rng.choice(case_ids)}{fan_out}',
+                        '/api/articles?limit=50']) for _ in range(count)]
+
+
+def sync_throughput(urls, clients):
+    def worker(chunk):
+        client = app.test_client()
+        for url in chunk:
+            client.get(url).get_data()
+
+    started = time.perf_counter()
+    with ThreadPoolExecutor(clients) as pool:
+        list(pool.map(worker, [urls[i::clients] for i in range(clients)]))
+    return len(urls) / (time.perf_counter() - started)
+
+
+async def asgi_get(application, url):
+    path, _, query = url.partition('?')
+    scope = {'type': 'http', 'method': 'GET', 'path': path, 'query_string': query.encode(), 'headers': []}
+    body = []
+
+    async def receive():
+        return {'type': 'http.request', 'body': b'', 'more_body': False}
+
+    async def send(message):
+        if message['type'] == 'http.response.body':
+            body.append(message['body'])
+
+    await application(scope, receive, send)
+    return b''.join(body)
+
+
+async def async_throughput(urls, clients):
+    from asgi import create_async_app
+    application = create_async_app()
+
+    async def worker(chunk):
+        for url in chunk:
+            await asgi_get(application, url)
+
+    started = time.perf_counter()
+    await asyncio.gather(*(worker(urls[i::clients]) for i in range(clients)))
+    elapsed = time.perf_counter() - started
+    await application.engine.dispose()
+    return len(urls) / elapsed
+
+
+def compare_modes(requests, clients, seed):
+    urls = concurrency_urls(random.Random(seed), requests)
+    results = {'requests': requests, 'clients': clients,
+               'sync_rps': round(sync_throughput(urls, clients), 1),
+               'async_rps': round(asyncio.run(async_throughput(urls, clients)), 1)}
+    print(f"{clients} clients: sync {results['sync_rps']} req/s, async {results['async_rps']} req/s")
+    return results
+
+
+def contention(seconds, clients, seed):
+    # Latency of single-case reads while clients threads pull whole list tables, first with the route
+    # class limits lifted, then as configured
+    rng = random.Random(seed)
+    with app.app_context():
+        case_ids = sample_args()['case_id']
+    heavy_urls = ['/api/articles', '/api/patient', '/api/patient_question', '/api/processed_question']
+    configured = app.config['ROUTE_CLASSES']
+    results = {'seconds': seconds, 'clients': clients}
+    for label, limits in (('unlimited', {name: dict(limits, concurrency=None) for name, limits in configured.items()}),
+                          ('limited', configured)):
+        app.config['ROUTE_CLASSES'] = limits
+        stop = threading.Event()
+        statuses = {}
+
+        def heavy():
+            client = app.test_client()
+            while not stop.is_set():
+                response = client.get(rng.choice(heavy_urls))
+                response.get_data()
+                statuses[response.status_code] = statuses.get(response.status_code, 0) + 1
+                if response.status_code == 503:
+                    stop.wait(0.05)
+
+        threads = [threading.Thread(target=heavy) for _ in range(clients)]
+        for thread in threads:
+            thread.start()
+        client = app.test_client()
+        latencies = []
+        deadline = time.perf_counter() + seconds
+        while time.perf_counter() < deadline:
+            started = time.perf_counter()
+            client.get(f'/api/cases/{rng.choice(case_ids)}').get_data()
+            latencies.append((time.perf_counter() - started) * 1000)
+        stop.set()
+        for thread in threads:
+            thread.join()
+
+        results[label] = {'requests': len(latencies), 'p50_ms': round(percentile(latencies, 0.5), 2),
+                          'p99_ms': round(percentile(latencies, 0.99), 2), 'list_statuses': statuses}
+        print(f"{label:9} /api/cases/<id> p50 {results[label]['p50_ms']:8.2f} ms  "
+              f"p99 {results[label]['p99_ms']:8.2f} ms  list responses {statuses}")
+    app.config['ROUTE_CLASSES'] = configured
+    return results
+
+
+# A full scan in the plan: Postgres Seq Scan, SQLite SCAN (SEARCH is an index lookup, and so is
+# SCAN ... VIRTUAL TABLE INDEX, a full-text MATCH)
+SCAN_PATTERNS = {
+    'postgresql': re.compile(r'Seq Scan on (\w+)'),
+    'sqlite': re.compile(r'^SCAN (\w+)\b(?! VIRTUAL TABLE INDEX)'),
+}
+# The soft-delete predicate alone does not make a statement a lookup
+SOFT_DELETE_FILTER = re.compile(r'\b\w+\.DELETED_AT\s+IS\s+NULL(\s+AND\b)?')
+PREDICATE = re.compile(r'\bWHERE\s+(?!ORDER\b|GROUP\b|LIMIT\b|UNION\b|\)|$)')
+
+
+def captured_statements(seed):
+    # The SELECTs each GET route runs, with their parameters
+    rng = random.Random(seed)
+    client = app.test_client()
+    with app.app_context():
+        samples = sample_args()
+        engine = db.engine
+
+    captured = []
+
+    def capture(conn, cursor, statement, parameters, context, executemany):
+        if statement.lstrip().upper().startswith(('SELECT', 'WITH')):
+            captured.append((statement, parameters))
+
+    statements = {}
+    event.listen(engine, 'before_cursor_execute', capture)
+    try:
+        for rule, build_url in benchmark_urls(samples, rng):
+            del captured[:]
+            client.get(build_url()).get_data()
+            statements[rule] = list({statement: parameters for statement, parameters in captured}.items())
+    finally:
+        event.remove(engine, 'before_cursor_execute', capture)
+    return statements
+
+
+def explain(connection, statement, parameters):
+    if connection.dialect.name == 'postgresql':
+        return [line for (line,) in connection.exec_driver_sql('EXPLAIN ' + statement, parameters)]
+    return [row[-1] for row in connection.exec_driver_sql('EXPLAIN QUERY PLAN ' + statement, parameters)]
+
+
+def advise(seed):
+    # EXPLAIN every statement the routes run and report the full scans. A scan in a statement with
+    # a WHERE clause is a lookup with no index to use; unfiltered scans are listed for information.
+    # Postgres runs with seq scans disabled, so on small data a Seq Scan still means no usable index
+    statements = captured_statements(seed)
+    findings = []
+    with app.app_context(), db.engine.connect() as connection:
+        pattern = SCAN_PATTERNS.get(connection.dialect.name)
+        if pattern is None:
+            raise SystemExit(f'No plan reader for {connection.dialect.name}')
+        if connection.dialect.name == 'postgresql':
+            connection.exec_driver_sql('SET enable_seqscan = off')
+        for rule, captured in statements.items():
+            for statement, parameters in captured:
+                normalized = ' '.join(SOFT_DELETE_FILTER.sub('', statement.upper()).split())
+                filtered = bool(PREDICATE.search(normalized))
+                for line in explain(connection, statement, parameters):
+                    match = pattern.search(line.strip())
+                    if match:
+                        findings.append({'route': rule, 'table': match.group(1), 'filtered': filtered,
+                                         'plan': line.strip(), 'statement': ' '.join(statement.split())})
+        connection.rollback()
+
+    for finding in sorted(findings, key=lambda finding: (not finding['filtered'], finding['route'])):
+        label = 'SEQ SCAN' if finding['filtered'] else 'full scan'
+        print(f"{label:9} {finding['route']:45} {finding['table']:30} {finding['plan']}")
+    return findings
+
+
+# Run in a fresh interpreter per measurement, a warm process would hide the cold start
+STARTUP_SCRIPT = """
+import json, sys, time
+started = time.perf_counter()
+import app as module
+imported = time.perf_counter()
+application = module.create_app(dict(module.CONFIGS['production'], WARM_UP=sys.argv[1] == '1'))
+created = time.perf_counter()
+client = application.test_client()
+timings = {'import_ms': imported - started, 'create_app_ms': created - imported}
+for url in sys.argv[2:]:
+    request_started = time.perf_counter()
+    client.get(url).get_data()
+    timings[url] = time.perf_counter() - request_started
+print(json.dumps({key: round(value * 1000, 2) for key, value in timings.items()}))
+"""
+
+
+def startup(runs):
+    # Cold start and first-request latency with and without the warm-up
+    with app.app_context():
+        case_id = sample_args()['case_id'][0]
+    urls = [f'/api/cases/{case_id}', '/api/disease', '/api/articles?limit=50']
+    results = {}
+    for label, warm in (('cold', '0'), ('warm', '1')):
+        samples = []
+        for _ in range(runs):
+            output = subprocess.run([sys.executable, '-c', STARTUP_SCRIPT, warm, *urls],
+                                    capture_output=True, text=True, check=True).stdout
+            samples.append(json.loads(output.splitlines()[-1]))
+        results[label] = {key: round(sorted(sample[key] for sample in samples)[len(samples) // 2], 2)
+                          for key in samples[0]}
+        print(f'{label}: ' + ', '.join(f'{key} {value} ms' for key, value in results[label].items()))
+    return results
+
+
+def generate_target(database, confirmed):
+    # generate drops every table: the database has to be named, or the drop confirmed, and the one
+    # a production app is configured with always needs the confirmation
+    configured = app.config['SQLALCHEMY_DATABASE_URI']
+    if database is None and not confirmed:
+        raise SystemExit('generate drops every table: name the database with --database, or pass --yes '
+                         'to use DATABASE_URL')
+    same = database is None or make_url(database) == make_url(configured)
+    if same and os.environ.get('APP_CONFIG') == 'production' and not confirmed:
+        raise SystemExit('refusing to drop the tables of the production database without --yes')
+    if same:
+        return app
+    return create_app({'SQLALCHEMY_DATABASE_URI': database, 'SQLALCHEMY_BINDS': {}})
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Generate synthetic data and benchmark the API routes.')
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    generate_parser = commands.add_parser('generate', help='drop, recreate and fill every table')
+    generate_parser.add_argument('--cases', type=int, default=1000)
+    generate_parser.add_argument('--questions-per-case', type=int, default=3)
+    generate_parser.add_argument('--articles-per-question', type=int, default=3)
+    generate_parser.add_argument('--fanout', type=int, default=3, help='max links per association row')
+    generate_parser.add_argument('--vocabulary', type=int, default=200, help='diseases and treatments')
+    generate_parser.add_argument('--seed', type=int, default=0)
+    generate_parser.add_argument('--no-documents', action='store_true', help='skip materializing case documents')
+    generate_parser.add_argument('--database', help='URL of the database to drop and fill')
+    generate_parser.add_argument('--yes', action='store_true', help='drop the tables without a --database or '
+                                 'of the database a production app is configured with')
+
+    run_parser = commands.add_parser('run', help='benchmark every GET route')
+    run_parser.add_argument('--iterations', type=int, default=50)
+    run_parser.add_argument('--seed', type=int, default=0)
+    run_parser.add_argument('--output', help='write results as JSON')
+    run_parser.add_argument('--baseline', help='earlier results to compare against')
+    run_parser.add_argument('--threshold', type=float, default=1.25, help='allowed p95 slowdown factor')
+    run_parser.add_argument('--floor-ms', type=float, default=1.0, help='ignore p95 changes below this')
+
+    concurrency_parser = commands.add_parser('concurrency', help='compare sync and async throughput')
+    concurrency_parser.add_argument('--requests', type=int, default=500)
+    concurrency_parser.add_argument('--clients', type=int, default=16)
+    concurrency_parser.add_argument('--seed', type=int, default=0)
+    concurrency_parser.add_argument('--output', help='write results as JSON')
+
+    advise_parser = commands.add_parser('advise', help='EXPLAIN the queries of every GET route, report full scans')
+    advise_parser.add_argument('--seed', type=int, default=0)
+    advise_parser.add_argument('--output', help='write findings as JSON')
+
+    contention_parser = commands.add_parser('contention', help='single-case latency under heavy list traffic')
+    contention_parser.add_argument('--seconds', type=float, default=10)
+    contention_parser.add_argument('--clients', type=int, default=16)
+    contention_parser.add_argument('--seed', type=int, default=0)
+    contention_parser.add_argument('--output', help='write results as JSON')
+
+    startup_parser = commands.add_parser('startup', help='measure cold start and first-request latency')
+    startup_parser.add_argument('--runs', type=int, default=5)
+    startup_parser.add_argument('--output', help='write results as JSON')
+
+    args = parser.parse_args()
+    if args.command == 'startup':
+        results = startup(args.runs)
+        if args.output:
+            with open(args.output, 'w') as f:
+                json.dump(results, f, indent=2)
+        return 0
+
+    if args.command == 'advise':
+        findings = advise(args.seed)
+        if args.output:
+            with open(args.output, 'w') as f:
+                json.dump(findings, f, indent=2)
+        return 1 if any(finding['filtered'] for finding in findings) else 0
+
+    if args.command == 'contention':
+        results = contention(args.seconds, args.clients, args.seed)
+        if args.output:
+            with open(args.output, 'w') as f:
+                json.dump(results, f, indent=2)
+        return 0
+
+    if args.command == 'concurrency':
+        results = compare_modes(args.requests, args.clients, args.seed)
+        if args.output:
+            with open(args.output, 'w') as f:
+                json.dump(results, f, indent=2)
+        return 0
+
+    if args.command == 'generate':
+        target = generate_target(args.database, args.yes)
+        url = make_url(target.config['SQLALCHEMY_DATABASE_URI'])
+        print(f'dropping and filling {url.render_as_string(hide_password=True)}')
+        started = time.perf_counter()
+        with target.app_context():
+            generate(args.cases, args.questions_per_case, args.articles_per_question, args.fanout,
+                     args.vocabulary, args.seed, not args.no_documents)
+        print(f'generated in {time.perf_counter() - started:.1f}s')
+        return 0
+
+    results = run(args.iterations, args.seed)
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump({'database': make_url(app.config['SQLALCHEMY_DATABASE_URI']).render_as_string(hide_password=True),
+                       'iterations': args.iterations, 'routes': results}, f, indent=2)
+    failed = [rule for rule, result in results.items() if not succeeded(result['status'])]
+    if args.baseline:
+        with open(args.baseline) as f:
+            found = regressions(results, json.load(f), args.threshold, args.floor_ms)
+        for line in found:
+            print(f'REGRESSION {line}', file=sys.stderr)
+        return 1 if found or failed else 0
+    return 1 if failed else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
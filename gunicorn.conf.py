@@ -0,0 +1,31 @@
+# gunicorn -c gunicorn.conf.py app:app
+#
+# The app is imported and warmed up once in the master (mappers configured, reference responses
+# cached), then forked. Connections must not cross the fork: the master closes its own before
+# the workers start, and each worker opens a fresh pool.
+
+import os
+
+os.environ.setdefault('APP_CONFIG', 'production')
+
+bind = os.environ.get('BIND', '0.0.0.0:8000')
+workers = int(os.environ.get('WEB_CONCURRENCY', 4))
+# Threaded workers, so the per-process route class limits apply: the list, export and write limits
+# add up to fewer than this many threads, which leaves room for the cheap reads
+threads = int(os.environ.get('WEB_THREADS', 8))
+preload_app = True
+
+
+def when_ready(server):
+    from app import app, db
+    with app.app_context():
+        for engine in db.engines.values():
+            engine.dispose()
+
+
+def post_fork(server, worker):
+    from app import app, db, fill_pools
+    with app.app_context():
+        for engine in db.engines.values():
+            engine.dispose(close=False)
+        fill_pools()
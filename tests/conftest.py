@@ -0,0 +1,55 @@
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+# app.py builds a module-level app from DATABASE_URL on import, give it something to open
+os.environ.setdefault('DATABASE_URL', 'sqlite://')
+
+import app as app_module  # noqa: E402
+import bench  # noqa: E402
+from app import create_app, db  # noqa: E402
+
+
+@pytest.fixture
+def app(tmp_path):
+    app = create_app({
+        'TESTING': True,
+        'SQLALCHEMY_DATABASE_URI': f'sqlite:///{tmp_path / "test.sqlite"}',
+        'SQLALCHEMY_BINDS': {},
+    })
+    # Process-wide caches outlive an app, start every test from empty ones
+    app_module.response_cache.entries.clear()
+    app_module.table_versions.clear()
+    app_module.dimension_cache.entries.clear()
+    # The in-memory indexes reload everything once built_at is unset
+    app_module.case_facet_index.built_at = None
+    app_module.similar_cases_index.built_at = None
+    app_module.similar_cases_index.top, app_module.similar_cases_index.listed_in = {}, {}
+    with app.app_context():
+        db.create_all(bind_key=None)
+    # Requests push their own app context, so per-request state such as the query count in g
+    # starts fresh. Tests push one around their own database work
+    yield app
+    with app.app_context():
+        db.engine.dispose()
+
+
+@pytest.fixture
+def client(app):
+    return app.test_client()
+
+
+@pytest.fixture
+def generate(app):
+    # bench.py's synthetic dataset, small and without materialized case documents by default
+    def generate(cases=3, questions_per_case=1, articles_per_question=1, fanout=3, vocabulary=20, seed=1,
+                 documents=False):
+        with app.app_context():
+            bench.generate(cases, questions_per_case, articles_per_question, fanout, vocabulary, seed, documents)
+    return generate
+
+
+def query_count(response):
+    return bench.query_count(response)
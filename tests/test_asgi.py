@@ -0,0 +1,98 @@
+import asyncio
+import json
+
+import pytest
+
+import app as app_module
+import bench
+
+
+def asgi_get(application, url):
+    # (status, parsed body) of a GET through the ASGI app
+    status, headers, body = asgi_response(application, url)
+    return status, body
+
+
+def asgi_response(application, url):
+    # (status, headers, parsed body)
+    path, _, query = url.partition('?')
+    scope = {'type': 'http', 'method': 'GET', 'path': path, 'query_string': query.encode(), 'headers': []}
+    messages = []
+
+    async def receive():
+        return {'type': 'http.request', 'body': b'', 'more_body': False}
+
+    async def send(message):
+        messages.append(message)
+
+    async def get():
+        await application(scope, receive, send)
+        await application.engine.dispose()
+
+    asyncio.run(get())
+    start = next(message for message in messages if message['type'] == 'http.response.start')
+    headers = {name.decode(): value.decode() for name, value in start['headers']}
+    return start['status'], headers, json.loads(b''.join(message.get('body', b'') for message in messages
+                                       if message['type'] == 'http.response.body'))
+
+
+@pytest.fixture
+def application(app, generate):
+    pytest.importorskip('aiosqlite')
+    from asgi import create_async_app
+    generate(cases=10, questions_per_case=2)
+    return create_async_app(app.config['SQLALCHEMY_DATABASE_URI'])
+
+
+@pytest.mark.parametrize('url', [
+    '/api/cases/3',
+    '/api/cases?ids=1,2,99',
+    '/api/articles?limit=3&after=2',
+    '/api/disease?fields=full_name',
+    '/api/disease?expand=profile',
+    '/api/disease?expand=profile&limit=5&after=D3',
+    '/api/disease?expand=profile&stream=1',
+    '/api/cases/3?expand=profile',
+    '/api/cases/3?expand=profile,patient_objects',
+    '/api/cases?ids=1,2,99&expand=profile',
+    '/api/cases/search',
+    f'/api/cases/search?gender={bench.GENDERS[0]},{bench.GENDERS[1]}&limit=2',
+    '/api/cases/search?limit=0',
+    '/api/search?q=question',
+    '/api/search?q=summary%20case&limit=2&offset=1',
+    '/api/search',
+])
+def test_async_matches_flask(client, application, url):
+    # Rebuilt by whichever app reads it first, make the async app build it itself
+    app_module.case_facet_index.built_at = None
+    app_module.dimension_cache.entries.clear()
+    status, body = asgi_get(application, url)
+    response = client.get(url)
+    assert status == response.status_code
+    assert body == response.json
+
+
+def test_async_rejects_routes_it_does_not_serve(application):
+    assert asgi_get(application, '/api/stats/patients')[0] == 501
+    assert asgi_get(application, '/api/changes')[0] == 501
+    assert asgi_get(application, '/api/nothing')[0] == 404
+
+
+def test_async_profiles(application):
+    status, body = asgi_get(application, '/api/disease?expand=profile')
+    assert status == 200
+    assert all(set(disease['profile']) == {'mutations', 'locations', 'proteins'} for disease in body)
+    assert any(disease['profile']['mutations'] for disease in body)
+    status, body = asgi_get(application, '/api/cases/3?expand=profile')
+    assert status == 200
+    assert body['diseases'] and all('profile' in disease for disease in body['diseases'])
+    assert asgi_get(application, '/api/cases/99?expand=profile')[0] == 404
+
+
+@pytest.mark.parametrize('url', ['/api/articles?limit=3', '/api/articles?limit=3&stream=1',
+                                 '/api/disease?limit=3&stream=1', '/api/disease?limit=1000&stream=1'])
+def test_async_cursor_matches_flask(client, application, url):
+    status, headers, body = asgi_response(application, url)
+    response = client.get(url)
+    assert body == response.json
+    assert headers.get('x-next-cursor') == response.headers.get('X-Next-Cursor')
@@ -0,0 +1,52 @@
+import random
+
+import pytest
+
+import bench
+
+
+def test_generate_needs_a_named_database_or_confirmation(tmp_path):
+    with pytest.raises(SystemExit, match='--database'):
+        bench.generate_target(None, False)
+    assert bench.generate_target(None, True) is bench.app
+    target = bench.generate_target(f'sqlite:///{tmp_path / "bench.sqlite"}', False)
+    assert target.config['SQLALCHEMY_DATABASE_URI'] == f'sqlite:///{tmp_path / "bench.sqlite"}'
+
+
+def test_generate_refuses_the_production_database(monkeypatch, tmp_path):
+    monkeypatch.setenv('APP_CONFIG', 'production')
+    configured = bench.app.config['SQLALCHEMY_DATABASE_URI']
+    with pytest.raises(SystemExit, match='production'):
+        bench.generate_target(configured, False)
+    assert bench.generate_target(configured, True) is bench.app
+    assert bench.generate_target(f'sqlite:///{tmp_path / "bench.sqlite"}', False) is not bench.app
+
+
+def test_benchmark_urls_succeed(app, client, generate):
+    # A route timed on its 400 says nothing, every sampled URL has to be answered
+    generate(cases=5, documents=True)
+    with app.app_context():
+        samples = bench.sample_args()
+    urls = [build_url() for rule, build_url in bench.benchmark_urls(samples, random.Random(0))]
+    assert any(url.startswith('/api/cases?ids=') for url in urls)
+    assert any(url.startswith('/api/search?q=') for url in urls)
+    for url in urls:
+        assert client.get(url).status_code == 200, url
+
+
+def timed(status=200, p95_ms=10.0, max_queries=3):
+    return {'status': status, 'p50_ms': p95_ms, 'p95_ms': p95_ms, 'p99_ms': p95_ms, 'max_queries': max_queries,
+            'peak_memory_kb': 1.0}
+
+
+def test_regressions():
+    baseline = {'routes': {'/api/a': timed(), '/api/b': timed(), '/api/c': timed(), '/api/d': timed(400),
+                           '/api/e': timed()}}
+    results = {'/api/a': timed(p95_ms=10.5), '/api/b': {'status': 500}, '/api/c': timed(p95_ms=30.0),
+               '/api/d': timed(400, p95_ms=1.0), '/api/e': timed(max_queries=4)}
+    assert bench.regressions(results, baseline, 1.25, 1.0) == [
+        '/api/b: status 200 -> 500',
+        '/api/c: p95 10.0 ms -> 30.0 ms',
+        '/api/d: status 400',
+        '/api/e: queries 3 -> 4',
+    ]
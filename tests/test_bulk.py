@@ -0,0 +1,63 @@
+import json
+
+import pytest
+
+from app import Cases, Disease, PatientQuestion, db
+
+
+def test_bulk_ingest_sets_timestamps(app, client, generate):
+    generate(cases=1)
+    lines = [json.dumps({'id': 10, 'patient_summary': 'Ingested', 'disease_objects': ['D1'],
+                         'patient_questions': [{'id': 10, 'question': 'Why?'}]})]
+    response = client.post('/api/bulk/cases', data='\n'.join(lines))
+    assert response.status_code == 200, response.json
+    assert response.json['cases'] == 1
+
+    with app.app_context():
+        for obj in (db.session.get(Cases, 10), db.session.get(PatientQuestion, 10)):
+            assert obj.created_at is not None
+            assert obj.updated_at is not None
+            assert obj.deleted_at is None
+    assert client.get('/api/cases/10').json['case']['disease_objects'][0]['id'] == 'D1'
+
+
+@pytest.mark.parametrize('line, message', [
+    ('[1]', 'line 2: cases records must be objects'),
+    ('"x"', 'line 2: cases records must be objects'),
+    ('{"patient_summary": "No id"}', 'line 2: cases record without an id'),
+    ('{"id": 11, "disease_objects": "D1"}', 'line 2: cases.disease_objects must be a list of ids or objects'),
+    ('{"id": 11, "disease_objects": [["D1"]]}', 'line 2: cases.disease_objects must be a list of ids or objects'),
+    ('{"id": 11, "disease_objects": [{"full_name": "No id"}]}', 'line 2: disease record without an id'),
+    ('{"id": 11, "patient_summary": {"text": "x"}}', 'line 2: cases.patient_summary must be a plain value'),
+    ('{"id": 11, "patient_questions": {"id": 1}}', 'line 2: patient_questions must be a list of objects'),
+    ('{"id": 11, "patient_questions": [7]}', 'line 2: patient_question records must be objects'),
+])
+def test_bulk_ingest_rejects_malformed_lines(client, generate, line, message):
+    generate(cases=1)
+    response = client.post('/api/bulk/cases', data='\n'.join([json.dumps({'id': 10}), line]))
+    assert response.status_code == 400
+    assert response.json['message'] == message
+    assert client.get('/api/cases/10').status_code == 404
+
+
+def test_bulk_ingest_takes_link_objects_like_the_upserts(app, client, generate):
+    generate(cases=1)
+    line = {'id': 10, 'disease_objects': [{'id': 'D1'}, {'id': 'D900', 'full_name': 'New disease'}],
+            'patient_questions': [{'id': 10, 'disease_objects': [{'id': 'D900'}]}]}
+    with app.app_context():
+        full_name = db.session.get(Disease, 'D1').full_name
+    response = client.post('/api/bulk/cases', data=json.dumps(line))
+    assert response.status_code == 200, response.json
+
+    with app.app_context():
+        # A reference leaves the stored row alone, a new one is inserted
+        assert db.session.get(Disease, 'D1').full_name == full_name
+        assert db.session.get(Disease, 'D900').full_name == 'New disease'
+    document = client.get('/api/cases/10').json
+    assert [disease['id'] for disease in document['case']['disease_objects']] == ['D1', 'D900']
+    assert client.get('/api/disease?limit=1000').json[-1]['id'] == 'D900'
+
+    # An id-only object has to exist, as a bare id does
+    response = client.post('/api/bulk/cases', data=json.dumps({'id': 11, 'disease_objects': [{'id': 'D901'}]}))
+    assert response.status_code == 400
+    assert 'disease:D901' in response.json['message']
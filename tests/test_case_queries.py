@@ -0,0 +1,126 @@
+import pytest
+
+import app as app_module
+from app import (ArticleDiseaseObj, ArticlePatientObj, Articles, CDObj, CPObj, CPQDiseaseObj, CPQPatientObj,
+                 CaseDocument, Cases, Disease, Enhanced, EnhancedDiseases, EnhancedPatients, Patient, PatientQuestion,
+                 ProcessedQuestion, RQDiseaseObj, RQPatientObj, db, upsert_statement)
+from conftest import query_count
+
+
+def add_case(questions):
+    # One case, its patient and disease linked from every question, processed question,
+    # enhanced row and article, so every relationship of the document has rows to load
+    db.session.add_all([Disease(id='D1', full_name='Disease 1', shortcut='D1'), Patient(id=1, age=40),
+                        Cases(id=1, patient_summary='Summary')])
+    db.session.add_all([CPObj(case_id=1, p_object_id=1), CDObj(case_id=1, disease_object_id='D1')])
+    for i in range(1, questions + 1):
+        db.session.add_all([
+            PatientQuestion(id=i, case_id=1, question=f'Question {i}'),
+            ProcessedQuestion(id=i, case_id=1, question_id=i, question=f'Processed {i}'),
+            Enhanced(id=i, case_id=1, processed_question_id=i),
+            Articles(id=i, case_id=1, processed_question_id=i, reference=f'Reference {i}'),
+        ])
+        db.session.flush()
+        db.session.add_all([
+            CPQPatientObj(question_id=i, patient_object_id=1), CPQDiseaseObj(question_id=i, disease_object_id='D1'),
+            RQPatientObj(research_question_id=i, patient_object_id=1),
+            RQDiseaseObj(research_question_id=i, disease_object_id='D1'),
+            EnhancedPatients(enhanced_id=i, patient_id=1), EnhancedDiseases(enhanced_id=i, disease_id='D1'),
+            ArticlePatientObj(article_id=i, patient_object_id=1), ArticleDiseaseObj(article_id=i, disease_object_id='D1'),
+        ])
+    db.session.commit()
+    # Writes materialize the document, drop it so the request builds it
+    CaseDocument.query.delete()
+    db.session.commit()
+
+
+@pytest.mark.parametrize('expand', [None, 'patient_objects,disease_objects'])
+def test_case_query_count_does_not_grow_with_questions(app, client, expand):
+    counts = []
+    for questions in (1, 5, 20):
+        with app.app_context():
+            db.drop_all(bind_key=None)
+            db.create_all(bind_key=None)
+            add_case(questions)
+        url = '/api/cases/1' if expand is None else f'/api/cases/1?expand={expand}'
+        response = client.get(url)
+        assert response.status_code == 200
+        assert len(response.json['patient_questions']) == questions
+        assert len(response.json['articles']) == questions
+        counts.append(query_count(response))
+    assert counts[0] == counts[1] == counts[2]
+
+
+def test_materialized_case_is_one_query(app, client, generate):
+    generate(cases=2, questions_per_case=5, documents=True)
+    response = client.get('/api/cases/2')
+    assert response.status_code == 200
+    assert query_count(response) == 1
+    with app.app_context():
+        assert response.json == db.session.get(CaseDocument, 2).document
+
+
+def test_unknown_case(client, generate):
+    generate(cases=1)
+    assert client.get('/api/cases/5').status_code == 404
+
+
+@pytest.mark.parametrize('expand', ['', '&expand=patient_objects,disease_objects'])
+def test_multi_get_query_count_does_not_grow_with_ids(app, client, generate, expand):
+    generate(cases=40, questions_per_case=2)
+    with app.app_context():
+        CaseDocument.query.delete()
+        db.session.commit()
+    few = client.get(f'/api/cases?ids=1,2,3,4,5{expand}')
+    many = client.get(f'/api/cases?ids={",".join(str(i) for i in range(6, 41))},999{expand}')
+    assert few.status_code == many.status_code == 200
+    assert len(few.json['cases']) == 5
+    assert len(many.json['cases']) == 35
+    assert many.json['missing'] == [999]
+    assert query_count(few) == query_count(many)
+
+
+def test_multi_get_rejects_bad_ids(client, generate):
+    generate(cases=1)
+    assert client.get('/api/cases').status_code == 400
+    assert client.get('/api/cases?ids=1,x').status_code == 400
+
+
+
+def test_usage_expand_query_count_does_not_grow_with_articles(app, client):
+    counts = []
+    for questions in (1, 5, 20):
+        with app.app_context():
+            db.drop_all(bind_key=None)
+            db.create_all(bind_key=None)
+            add_case(questions)
+        # Materialize the case document, so the count below is the usage query and the expansion
+        assert client.get('/api/cases/1').status_code == 200
+        response = client.get('/api/disease/D1/usage?expand=cases,articles')
+        assert response.status_code == 200
+        articles = response.json['usage']['articles']['objects']
+        assert len(articles) == questions
+        # Direct links only, the linked patient is not expanded any further
+        assert articles[0]['patients_objects'] == [{'id': 1, 'age': 40, 'age_range': None, 'gender': None}]
+        counts.append(query_count(response))
+    # The usage query, the stored documents and the articles with one SELECT ... IN per link
+    assert counts == [7, 7, 7]
+
+
+def test_write_replaces_a_document_stored_by_a_read(app, client, monkeypatch):
+    with app.app_context():
+        add_case(1)
+    build = app_module.build_case_documents
+
+    def build_while_a_read_stores(case_ids, *args):
+        documents = build(case_ids, *args)
+        # What a GET building the same document in between stores
+        db.session.execute(upsert_statement(CaseDocument.__table__, replace=False),
+                           [{'case_id': case_id, 'document': {'stale': True}} for case_id in case_ids])
+        return documents
+
+    monkeypatch.setattr(app_module, 'build_case_documents', build_while_a_read_stores)
+    assert client.put('/api/cases', json=[{'id': 1, 'patient_summary': 'Changed'}]).status_code == 200
+    monkeypatch.undo()
+    with app.app_context():
+        assert db.session.get(CaseDocument, 1).document['case']['patient_summary'] == 'Changed'
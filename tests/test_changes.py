@@ -0,0 +1,77 @@
+from sqlalchemy import event
+
+from app import db
+
+
+def changes(client, since=0, limit=100):
+    response = client.get(f'/api/changes?since={since}&limit={limit}')
+    assert response.status_code == 200
+    return response.json
+
+
+def test_change_feed_reports_rows_and_links(client, generate):
+    generate(cases=3)
+    cursor = changes(client)['cursor']
+
+    response = client.post('/api/cases', json=[{'id': 10, 'patient_summary': 'New', 'disease_objects': ['D1', 'D2']}])
+    assert response.status_code == 200, response.json
+    feed = changes(client, cursor)
+    by_key = {(change['table'], tuple(sorted(change['key'].items()))): change for change in feed['changes']}
+    case = by_key[('cases', (('id', 10),))]
+    assert case['operation'] == 'insert'
+    assert case['data']['patient_summary'] == 'New'
+    for disease_id in ('D1', 'D2'):
+        edge = by_key[('cd_objects', (('case_id', 10), ('disease_object_id', disease_id)))]
+        assert edge['operation'] == 'insert'
+        assert edge['data'] == {'case_id': 10, 'disease_object_id': disease_id}
+
+    # PUT replaces the link list: D1 goes, D2 stays, the case is updated
+    response = client.put('/api/cases', json=[{'id': 10, 'patient_summary': 'Edited', 'disease_objects': ['D2']}])
+    assert response.status_code == 200, response.json
+    feed = changes(client, feed['cursor'])
+    operations = {(change['table'], change['key'].get('disease_object_id')): change['operation']
+                  for change in feed['changes']}
+    assert operations[('cases', None)] == 'update'
+    assert operations[('cd_objects', 'D1')] == 'delete'
+    assert ('cd_objects', 'D2') not in operations
+    assert not feed['has_more']
+    assert changes(client, feed['cursor'])['changes'] == []
+
+
+def test_change_feed_pages_with_the_cursor(client, generate):
+    generate(cases=1)
+    since = changes(client)['cursor']
+    client.post('/api/cases', json=[{'id': case_id, 'patient_summary': 'Paged'} for case_id in range(10, 15)])
+    seen = []
+    while True:
+        page = changes(client, since, limit=2)
+        seen += [change['key']['id'] for change in page['changes'] if change['table'] == 'cases']
+        since = page['cursor']
+        if not page['has_more']:
+            break
+    assert sorted(seen) == [10, 11, 12, 13, 14]
+
+
+def test_change_feed_reads_rows_through_indexes(app, client, generate):
+    generate(cases=20, fanout=5)
+    since = changes(client)['cursor']
+    client.put('/api/cases', json=[{'id': case_id, 'patient_summary': 'Relinked', 'disease_objects': ['D3', 'D4']}
+                                   for case_id in range(1, 11)])
+
+    statements = []
+    with app.app_context():
+        engine = db.engine
+    record = lambda conn, cursor, statement, parameters, context, executemany: statements.append(
+        (statement, parameters))
+    event.listen(engine, 'before_cursor_execute', record)
+    try:
+        changes(client, since, limit=1000)
+    finally:
+        event.remove(engine, 'before_cursor_execute', record)
+
+    with engine.connect() as connection:
+        for statement, parameters in statements:
+            plan = connection.exec_driver_sql(f'EXPLAIN QUERY PLAN {statement}', parameters).all()
+            # The change log is read from the cursor on, the current rows by key
+            scans = [row[-1] for row in plan if row[-1].startswith('SCAN')]
+            assert not scans, (statement, scans)
@@ -0,0 +1,24 @@
+import datetime
+
+import pytest
+
+import app as app_module
+from app import dumps_json
+
+
+def test_orjson_and_fallback_write_the_same_bytes(monkeypatch):
+    pytest.importorskip('orjson')
+    data = [{'b': 1, 'a': 'Ünïcode', 'c': [None, True, 1.5]},
+            {'created_at': datetime.datetime(2024, 5, 1, 12, 30, 15), 'day': datetime.date(2024, 5, 1)}]
+    fast = dumps_json(data)
+    monkeypatch.setattr(app_module, 'orjson', None)
+    assert dumps_json(data) == fast
+
+
+def test_disease_list_is_the_same_without_orjson(client, generate, monkeypatch):
+    pytest.importorskip('orjson')
+    generate(cases=2)
+    fast = client.get('/api/disease').data
+    app_module.response_cache.entries.clear()
+    monkeypatch.setattr(app_module, 'orjson', None)
+    assert client.get('/api/disease').data == fast
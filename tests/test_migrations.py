@@ -0,0 +1,34 @@
+from sqlalchemy import inspect, select
+
+from app import CaseDocument, MIGRATIONS, db, migration_table
+
+
+def test_upgrade_from_baseline_schema(app, client, generate):
+    generate(cases=4, questions_per_case=2)
+    with app.app_context():
+        # The tables the baseline schema did not have
+        with db.engine.begin() as connection:
+            connection.exec_driver_sql('DROP TABLE case_document')
+            connection.exec_driver_sql('DROP TABLE change_log')
+
+    result = app.test_cli_runner().invoke(args=['db-upgrade'])
+    assert result.exit_code == 0, result.output
+    assert 'Database is up to date' in result.output
+
+    with app.app_context():
+        tables = inspect(db.engine).get_table_names()
+        assert {'case_document', 'change_log'} <= set(tables)
+        assert db.session.scalars(select(CaseDocument.case_id).order_by(CaseDocument.case_id)).all() == [1, 2, 3, 4]
+        with db.engine.connect() as connection:
+            applied = set(connection.execute(select(migration_table.c.id)).scalars())
+        assert applied == {migration_id for migration_id, _ in MIGRATIONS}
+
+    assert client.get('/api/cases/1').status_code == 200
+    response = client.put('/api/cases', json=[{'id': 1, 'patient_summary': 'Rewritten'}])
+    assert response.status_code == 200, response.json
+    assert client.get('/api/cases/1').json['case']['patient_summary'] == 'Rewritten'
+
+    # Nothing left to apply the second time
+    result = app.test_cli_runner().invoke(args=['db-upgrade'])
+    assert result.exit_code == 0
+    assert 'Applying' not in result.output
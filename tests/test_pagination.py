@@ -0,0 +1,23 @@
+import pytest
+
+
+@pytest.mark.parametrize('route', ['/api/articles', '/api/patient_question', '/api/disease', '/api/treatment'])
+def test_streamed_page_has_the_cursor(client, generate, route):
+    generate(cases=5, questions_per_case=2)
+    page = client.get(f'{route}?limit=3')
+    streamed = client.get(f'{route}?limit=3&stream=1')
+    assert streamed.json == page.json
+    assert page.headers['X-Next-Cursor'] == streamed.headers['X-Next-Cursor'] == str(page.json[-1]['id'])
+
+    # The last page has no cursor, streamed or not
+    everything = client.get(f'{route}?limit=1000')
+    assert 'X-Next-Cursor' not in everything.headers
+    assert 'X-Next-Cursor' not in client.get(f'{route}?limit=1000&stream=1').headers
+
+
+def test_not_modified_page_has_the_cursor(client, generate):
+    generate(cases=1)
+    page = client.get('/api/disease?limit=3')
+    response = client.get('/api/disease?limit=3', headers={'If-None-Match': page.headers['ETag']})
+    assert response.status_code == 304
+    assert response.headers['X-Next-Cursor'] == page.headers['X-Next-Cursor']
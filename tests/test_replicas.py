@@ -0,0 +1,84 @@
+import shutil
+
+import pytest
+from sqlalchemy import event
+
+import app as app_module
+from app import create_app, db
+
+
+@pytest.fixture
+def replicated(tmp_path, app, generate):
+    # Two SQLite copies of the primary stand in for streaming replicas
+    generate(cases=5, questions_per_case=2, documents=True)
+    primary = tmp_path / 'test.sqlite'
+    for name in ('r0', 'r1'):
+        shutil.copy(primary, tmp_path / f'{name}.sqlite')
+    replicated = create_app({
+        'TESTING': True,
+        'SQLALCHEMY_DATABASE_URI': f'sqlite:///{primary}',
+        'SQLALCHEMY_BINDS': {f'replica_{i}': {'url': f'sqlite:///{tmp_path / name}.sqlite'}
+                             for i, name in enumerate(('r0', 'r1'))},
+    })
+    app_module.replica_router.up.clear()
+    app_module.replica_router.down_until.clear()
+    with replicated.app_context():
+        engines = {engine: key for key, engine in db.engines.items()}
+    yield replicated, engines
+    app_module.replica_router.up.clear()
+    app_module.replica_router.down_until.clear()
+
+
+def statement_binds(replicated, engines, url):
+    # The bind key of every statement the request ran
+    used = []
+
+    def record(conn, cursor, statement, parameters, context, executemany):
+        used.append(engines.get(conn.engine))
+
+    with replicated.app_context():
+        for engine in engines:
+            event.listen(engine, 'before_cursor_execute', record)
+    try:
+        assert replicated.test_client().get(url).status_code == 200
+    finally:
+        with replicated.app_context():
+            for engine in engines:
+                event.remove(engine, 'before_cursor_execute', record)
+    return used
+
+
+def test_request_reads_from_one_replica(replicated):
+    replicated, engines = replicated
+    picked = []
+    for _ in range(4):
+        used = statement_binds(replicated, engines, '/api/cases?ids=1,2&expand=patient_objects,disease_objects')
+        assert len(used) > 1
+        assert len(set(used)) == 1
+        picked.append(used[0])
+    # Round-robin between requests
+    assert set(picked) == {'replica_0', 'replica_1'}
+
+
+def test_replica_marked_down_is_replaced(replicated):
+    replicated, engines = replicated
+    first = statement_binds(replicated, engines, '/api/cases/1?expand=disease_objects')[0]
+    with replicated.app_context():
+        app_module.replica_router.mark_down(first)
+    for _ in range(3):
+        assert set(statement_binds(replicated, engines, '/api/cases/1?expand=disease_objects')) == (
+            {'replica_0', 'replica_1'} - {first})
+
+
+def test_documents_built_on_a_read_are_stored_on_the_primary(replicated):
+    replicated, engines = replicated
+    with replicated.app_context():
+        for engine in engines:
+            with engine.begin() as connection:
+                connection.exec_driver_sql('DELETE FROM case_document')
+    assert replicated.test_client().get('/api/cases/1').status_code == 200
+    with replicated.app_context():
+        for engine, key in engines.items():
+            with engine.connect() as connection:
+                stored = connection.exec_driver_sql('SELECT count(*) FROM case_document').scalar()
+            assert stored == (1 if key is None else 0)
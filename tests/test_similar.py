@@ -0,0 +1,50 @@
+import math
+
+import pytest
+
+from app import case_feature_rows
+
+pytest.importorskip('scipy')
+
+
+def expected_neighbours(case_id, metric, k):
+    # Brute force over the same features the index uses
+    features = {}
+    for row_case_id, facet, value in case_feature_rows():
+        features.setdefault(row_case_id, set())
+        if facet != 'case' and value is not None:
+            features[row_case_id].add((facet, value))
+    mine = features[case_id]
+    scored = []
+    for other, theirs in features.items():
+        if other == case_id:
+            continue
+        shared = len(mine & theirs)
+        if metric == 'jaccard':
+            union = len(mine | theirs)
+            score = shared / union if union else 0.0
+        else:
+            score = shared / math.sqrt(len(mine) * len(theirs)) if mine and theirs else 0.0
+        scored.append((-round(score, 6), other))
+    return {other: -score for score, other in scored}, [-score for score, _ in sorted(scored)[:k]]
+
+
+@pytest.mark.parametrize('metric', ['jaccard', 'cosine'])
+def test_similar_matches_brute_force(app, client, generate, metric):
+    generate(cases=30, fanout=4)
+    for case_id in (1, 7, 30):
+        response = client.get(f'/api/cases/{case_id}/similar?k=5&metric={metric}')
+        assert response.status_code == 200
+        got = [(row['case_id'], row['score']) for row in response.json['similar']]
+        with app.app_context():
+            scores, best = expected_neighbours(case_id, metric, 5)
+        # Ties at the k-th score may come back in either order, so compare scores
+        assert [score for _, score in got] == pytest.approx(best, abs=1e-6)
+        assert all(scores[other] == pytest.approx(score, abs=1e-6) for other, score in got)
+
+
+def test_similar_arguments(client, generate):
+    generate(cases=3)
+    assert client.get('/api/cases/1/similar?k=0').status_code == 400
+    assert client.get('/api/cases/1/similar?metric=euclid').status_code == 400
+    assert client.get('/api/cases/99/similar').status_code == 404
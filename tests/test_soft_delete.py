@@ -0,0 +1,80 @@
+import datetime
+
+from app import Cases, Patient, db, search_ddl
+
+PATIENT_KEYS = ('patients', 'patient_objects', 'patients_objects')
+
+
+def linked_patient_ids(value):
+    # Ids of every patient listed anywhere in a case document
+    ids = set()
+    if isinstance(value, dict):
+        for key, item in value.items():
+            if key in PATIENT_KEYS:
+                ids.update(patient['id'] for patient in item)
+            else:
+                ids |= linked_patient_ids(item)
+    elif isinstance(value, list):
+        for item in value:
+            ids |= linked_patient_ids(item)
+    return ids
+
+
+def soft_delete(app, model, row_id, deleted=True):
+    with app.app_context():
+        db.session.get(model, row_id).deleted_at = datetime.datetime.now() if deleted else None
+        db.session.commit()
+
+
+def test_soft_deleted_patient_leaves_case_documents(app, client, generate):
+    generate(cases=6, questions_per_case=3, fanout=4, documents=True)
+    # bench.py links patient n to case n, and every question to one random patient
+    victim = next(patient_id for patient_id in linked_patient_ids(client.get('/api/cases/2').json)
+                  if patient_id != 2)
+    urls = [f'/api/cases/{case_id}' for case_id in range(1, 7)] + [
+        '/api/cases/2?expand=patient_objects,disease_objects', '/api/cases?ids=1,2,3,4,5,6']
+    assert any(victim in linked_patient_ids(client.get(url).json) for url in urls)
+
+    soft_delete(app, Patient, victim)
+    for url in urls:
+        assert victim not in linked_patient_ids(client.get(url).json)
+    assert victim not in {patient['id'] for patient in client.get('/api/patient').json}
+
+    soft_delete(app, Patient, victim, deleted=False)
+    assert any(victim in linked_patient_ids(client.get(url).json) for url in urls)
+
+
+def test_stats_facets_and_search_skip_soft_deleted_rows(app, client, generate):
+    generate(cases=5, questions_per_case=1)
+    with app.app_context():
+        connection = db.session.connection()
+        for statement in search_ddl('sqlite'):
+            connection.exec_driver_sql(statement)
+        db.session.commit()
+
+    def patients():
+        return sum(row['patients'] for row in client.get('/api/stats/patients').json)
+
+    def cases_per_disease():
+        return sum(row['cases'] for row in client.get('/api/stats/cases-per-disease').json)
+
+    def genders():
+        return sum(client.get('/api/cases/search').json['facets']['gender'].values())
+
+    def found(q):
+        return {(hit['kind'], hit['id']) for hit in client.get(f'/api/search?q={q}&limit=100').json['results']}
+
+    before = patients(), cases_per_disease(), genders()
+    assert ('case', 3) in found('summary')
+    with app.app_context():
+        linked_diseases = len(db.session.get(Cases, 3).disease_objects)
+
+    soft_delete(app, Patient, 3)
+    soft_delete(app, Cases, 3)
+    assert patients() == before[0] - 1
+    assert cases_per_disease() == before[1] - linked_diseases
+    assert genders() == before[2] - 1
+    assert ('case', 3) not in found('summary')
+
+    soft_delete(app, Cases, 3, deleted=False)
+    assert ('case', 3) in found('summary')
@@ -0,0 +1,78 @@
+import pytest
+
+from app import Disease, Patient, db
+from conftest import query_count
+
+
+@pytest.fixture
+def vocabulary(app):
+    with app.app_context():
+        db.session.add_all([Disease(id='D1', full_name='Disease 1', shortcut='D1'),
+                            Disease(id='D2', full_name='Disease 2', shortcut='D2'),
+                            Patient(id=1, age=40), Patient(id=2, age=50)])
+        db.session.commit()
+
+
+def case_records(first, count, patient_id):
+    return [{'id': case_id, 'patient_summary': f'Summary {case_id}', 'patient_objects': [patient_id],
+             'disease_objects': ['D1', {'id': 'D2', 'full_name': 'Disease 2'}]}
+            for case_id in range(first, first + count)]
+
+
+@pytest.mark.parametrize('method', ['post', 'put'])
+def test_write_query_count_does_not_grow_with_records(client, vocabulary, method):
+    # A patient per batch, so the second one has no stored documents of the first to refresh
+    few = getattr(client, method)('/api/cases', json=case_records(1, 2, 1))
+    many = getattr(client, method)('/api/cases', json=case_records(100, 50, 2))
+    assert few.status_code == many.status_code == 200
+    assert few.json['inserted'] == 2
+    assert many.json['inserted'] == 50
+    assert many.json['links_added'] == 150
+    assert query_count(few) == query_count(many)
+
+
+def test_vocabulary_object_writes_only_its_columns(app, client, vocabulary):
+    records = [{'id': 1, 'disease_objects': [{'id': 'D1'}, {'id': 'D2', 'shortcut': 'X'}]}]
+    response = client.put('/api/cases', json=records)
+    assert response.status_code == 200
+    assert response.json['vocabulary_inserted'] == 0
+    assert response.json['vocabulary_updated'] == 1
+    assert response.json['links_added'] == 2
+    with app.app_context():
+        assert (db.session.get(Disease, 'D1').full_name, db.session.get(Disease, 'D1').shortcut) == ('Disease 1', 'D1')
+        assert (db.session.get(Disease, 'D2').full_name, db.session.get(Disease, 'D2').shortcut) == ('Disease 2', 'X')
+
+
+def test_vocabulary_object_inserts_and_references(app, client, vocabulary):
+    response = client.put('/api/cases', json=[{'id': 1, 'disease_objects': [{'id': 'D3', 'full_name': 'Disease 3'}]}])
+    assert response.status_code == 200
+    assert response.json['vocabulary_inserted'] == 1
+    with app.app_context():
+        assert db.session.get(Disease, 'D3').full_name == 'Disease 3'
+    # An object with only its id refers to a stored row, like a bare id
+    response = client.put('/api/cases', json=[{'id': 2, 'disease_objects': [{'id': 'D9'}]}])
+    assert response.status_code == 400
+    assert 'disease:D9' in response.json['message']
+
+
+def test_put_replaces_links(client, vocabulary):
+    assert client.put('/api/cases', json=[{'id': 1, 'disease_objects': ['D1', 'D2']}]).status_code == 200
+    response = client.put('/api/cases', json=[{'id': 1, 'disease_objects': ['D2']}])
+    assert response.json['links_removed'] == 1
+    assert response.json['unchanged'] == 1
+    assert [disease['id'] for disease in client.get('/api/cases/1').json['case']['disease_objects']] == ['D2']
+
+
+@pytest.mark.parametrize('record, message', [
+    ({'id': 1, 'disease_objects': 'D1'}, 'cases.disease_objects must be a list of ids or objects'),
+    ({'id': 1, 'disease_objects': [['D1']]}, 'cases.disease_objects must be a list of ids or objects'),
+    ({'id': 1, 'disease_objects': [True]}, 'cases.disease_objects must be a list of ids or objects'),
+    ({'id': 1, 'disease_objects': [{'name': 'No id'}]}, 'disease record without an id'),
+    ({'id': 1, 'disease_objects': [{'id': ['D1']}]}, 'disease id must be a number or a string'),
+    ({'id': [1]}, 'cases id must be a number or a string'),
+    ({'id': 1, 'patient_summary': ['x']}, 'cases.patient_summary must be a plain value'),
+])
+def test_malformed_records_are_rejected(client, vocabulary, record, message):
+    response = client.put('/api/cases', json=[record])
+    assert response.status_code == 400
+    assert response.json['message'] == message